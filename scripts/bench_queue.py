@@ -0,0 +1,79 @@
+"""
+Measure tasks/sec moved through each queue transport available in
+:func:`services.workers.create_queue`, for each task codec.
+
+A producer sends N tasks while C consumer processes drain them in batches,
+as the workers do. The time measured goes from the first send until the last
+task is received by a consumer.
+
+Usage:
+
+    PYTHONPATH=. python scripts/bench_queue.py -n 20000 -c 2
+"""
+import argparse
+import time
+from multiprocessing import Process
+
+from services.workers import QueueConfig, Task, TaskQueue, create_queue
+
+STOP = "__STOP__"
+CODECS = {
+    "json": "services.workers.JSONCodec",
+    "pickle": "services.workers.PickleCodec",
+}
+
+
+def consumer(queue, conf: QueueConfig, batch_size: int):
+    tq = TaskQueue(queue, conf=conf)
+    while True:
+        batch = tq.receive_many(batch_size)
+        stops = [task for task in batch if task.get("name") == STOP]
+        if stops:
+            # one sentinel by consumer, the others go back for the rest
+            for _ in stops[1:]:
+                tq.send(Task(name=STOP))
+            return
+
+
+def bench(
+    transport: str, codec: str, total: int, consumers: int, batch_size: int
+) -> float:
+    conf = QueueConfig(app_name="bench", transport=transport, codec_class=codec)
+    queue = create_queue(transport)
+    tq = TaskQueue(queue, conf=conf)
+    procs = [
+        Process(target=consumer, args=(queue, conf, batch_size))
+        for _ in range(consumers)
+    ]
+    for p in procs:
+        p.start()
+
+    task = Task(name="dummy", params={"do": "bench", "wait": 0})
+    started = time.perf_counter()
+    for _ in range(total):
+        tq.send(task)
+    for _ in range(consumers):
+        tq.send(Task(name=STOP))
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - started
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--tasks", type=int, default=20000)
+    parser.add_argument("-c", "--consumers", type=int, default=2)
+    parser.add_argument("-b", "--batch-size", type=int, default=10)
+    args = parser.parse_args()
+
+    for transport in ("manager", "process"):
+        for codec, codec_class in CODECS.items():
+            rate = bench(
+                transport, codec_class, args.tasks, args.consumers, args.batch_size
+            )
+            print(f"{transport:>10} {codec:>8}: {rate:>10.0f} tasks/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Autoscaling of queue workers, it replaces :func:`services.workers.create`:
+
+.. code-block:: python
+
+    from services import autoscale
+
+    autoscale.create(
+        app,
+        conf,
+        autoscale.AutoscaleConfig(min_workers=1, max_workers=8, target_wait=2.0),
+    )
+
+A thread of the Sanic main process checks the depth of the queue, and how
+long tasks wait in it before starting, every `interval` seconds. Then it
+adds or retires worker processes through the worker manager of Sanic.
+Retired workers get the same signal as in a shutdown, so they finish the
+tasks already taken from the queue, and give back to it the tasks still
+waiting for their eta.
+"""
+import asyncio
+import math
+import threading
+import time
+from itertools import count
+from multiprocessing import Value
+from typing import Callable, List, Optional
+
+from pydantic import BaseModel, root_validator
+from sanic import Sanic
+from sanic.log import logger
+from sanic.worker.manager import WorkerManager
+from sanic.worker.process import Worker
+
+from services import workers
+from services.workers import (
+    CTX_PREFIX,
+    WORKER_PREFIX,
+    QueueConfig,
+    TaskQueue,
+    _get_metrics,
+    _get_queue_from_app,
+    _get_wait_gauge,
+    init_transport,
+    io_worker,
+    is_durable,
+    worker_kwargs,
+)
+
+
+class AutoscaleConfig(BaseModel):
+    """
+    :param min_workers: worker processes always running
+    :param max_workers: upper bound of worker processes
+    :param target_depth: tasks waiting in the queue for each worker
+    :param target_wait: seconds a task could wait in the queue before
+        adding a worker, None to scale only by depth
+    :param interval: seconds between checks
+    :param up_cooldown: seconds from the last change before adding workers
+    :param down_cooldown: seconds from the last change before retiring one
+    """
+
+    min_workers: int = 1
+    max_workers: int = 4
+    target_depth: int = 10
+    target_wait: Optional[float] = None
+    interval: float = 5.0
+    up_cooldown: float = 15.0
+    down_cooldown: float = 120.0
+
+    @root_validator(skip_on_failure=True)
+    def check_bounds(cls, values):
+        if not 0 <= values["min_workers"] <= values["max_workers"]:
+            raise ValueError("min_workers should be between 0 and max_workers")
+        if values["max_workers"] < 1 or values["target_depth"] < 1:
+            raise ValueError("max_workers and target_depth should be positive")
+        return values
+
+
+class Autoscaler:
+    """
+    How many workers should be running. Workers are added at once, as many
+    as needed, but retired one at a time, and every change waits for the
+    cooldown of its direction since the last change, so it doesn't flap
+    between sizes when the load is around a threshold.
+    """
+
+    def __init__(self, conf: AutoscaleConfig, current: int):
+        self.conf = conf
+        self.current = current
+        self._changed_at = float("-inf")
+
+    def desired(self, depth: int, wait: float) -> int:
+        conf = self.conf
+        want = math.ceil(depth / conf.target_depth)
+        # the wait is an average of the tasks started, stale if there is none
+        if conf.target_wait is not None and depth and wait > conf.target_wait:
+            want = max(want, self.current + 1)
+        return min(max(want, conf.min_workers), conf.max_workers)
+
+    def step(self, depth: int, wait: float, now: float) -> int:
+        """
+        :param depth: tasks waiting in the queue
+        :param wait: seconds tasks waited in the queue before starting
+        :param now: monotonic time
+        :return: workers to run
+        """
+        want = self.desired(depth, wait)
+        since = now - self._changed_at
+        if want > self.current and since >= self.conf.up_cooldown:
+            self.current = want
+            self._changed_at = now
+        elif want < self.current and since >= self.conf.down_cooldown:
+            self.current -= 1
+            self._changed_at = now
+        return self.current
+
+
+class WorkerPool:
+    """
+    Workers of a queue in the :class:`WorkerManager` of Sanic, named
+    `Queue-<qname>-<ix>` like the ones of :func:`services.workers.create`.
+
+    The manager doesn't add or remove workers once it is running. Here, its
+    dict of workers is replaced instead of changed, because the monitor of
+    the manager could be iterating over it from the main thread.
+    """
+
+    def __init__(
+        self, app: Sanic, conf: QueueConfig, wk: Callable, jobs_per_worker: int
+    ):
+        self.app = app
+        self.conf = conf
+        self.wk = wk
+        self.jobs_per_worker = jobs_per_worker
+        self.manager: WorkerManager = app.manager
+        self._prefix = f"{WORKER_PREFIX}{conf.qname}-"
+        # terminated but maybe still finishing its tasks
+        self._retiring: List[Worker] = []
+
+    @property
+    def idents(self) -> List[str]:
+        n = len(self._prefix)
+        idents = [
+            ident
+            for ident in self.manager.durable
+            if ident.startswith(self._prefix) and ident[n:].isdigit()
+        ]
+        return sorted(idents, key=lambda ident: int(ident[n:]))
+
+    def add(self):
+        taken = set(self.manager.durable) | {w.ident for w in self._retiring}
+        name = next(
+            f"{self._prefix}{ix}"
+            for ix in count()
+            if f"{self._prefix}{ix}" not in taken
+        )
+        worker = Worker(
+            name,
+            self.wk,
+            worker_kwargs(self.app, self.conf, name, self.jobs_per_worker),
+            self.manager.context,
+            self.manager.worker_state,
+        )
+        self.manager.durable = {**self.manager.durable, name: worker}
+        for process in worker.processes:
+            process.start()
+
+    def retire(self):
+        name = self.idents[-1]
+        worker = self.manager.durable[name]
+        self.manager.durable = {
+            k: w for k, w in self.manager.durable.items() if k != name
+        }
+        for process in worker.processes:
+            process.terminate()
+        self._retiring.append(worker)
+
+    def reap(self):
+        # is_alive joins the processes already finished
+        alive = [w for w in self._retiring if any(p.is_alive() for p in w.processes)]
+        # a worker killed before it shut down leaves its metrics behind
+        metrics = _get_metrics(self.app, self.conf.qname)
+        if metrics is not None:
+            for worker in self._retiring:
+                if worker not in alive:
+                    metrics.pop(worker.ident, None)
+        self._retiring = alive
+
+    def resize(self, size: int):
+        self.reap()
+        while len(self.idents) < size:
+            self.add()
+        while len(self.idents) > size:
+            self.retire()
+
+
+def autoscale_thread(
+    app: Sanic,
+    conf: QueueConfig,
+    scale: AutoscaleConfig,
+    pool: WorkerPool,
+    stop: threading.Event,
+) -> None:
+    loop = asyncio.new_event_loop()
+    if is_durable(conf.transport):
+        tq = TaskQueue(loop.run_until_complete(init_transport(conf)), conf=conf)
+    else:
+        tq = TaskQueue(_get_queue_from_app(app, qname=conf.qname), conf=conf)
+    gauge = _get_wait_gauge(app, conf.qname)
+    scaler = Autoscaler(scale, len(pool.idents))
+    try:
+        while not stop.wait(scale.interval):
+            if pool.manager._shutting_down:
+                break
+            try:
+                depth = loop.run_until_complete(tq.depth())
+                wait = gauge.value if gauge is not None else 0.0
+                size = scaler.step(depth, wait, time.monotonic())
+                current = len(pool.idents)
+                if size != current:
+                    logger.info(
+                        "Scaling queue %s from %s to %s workers "
+                        "(depth %s, wait %.2fs)",
+                        conf.qname,
+                        current,
+                        size,
+                        depth,
+                        wait,
+                    )
+                pool.resize(size)
+            except Exception:
+                logger.exception("Autoscaler of queue %s failed", conf.qname)
+    finally:
+        if tq.durable:
+            loop.run_until_complete(tq.queue.close())
+        loop.close()
+
+
+def create(
+    app: Sanic,
+    conf: QueueConfig,
+    scale: AutoscaleConfig,
+    jobs_per_worker: int = 5,
+    wk: Callable = io_worker,
+) -> None:
+    """
+    Like :func:`services.workers.create`, starting `scale.min_workers`
+    workers, scaled up to `scale.max_workers`. A custom `wk` receives
+    a `wait_gauge` kwarg, to be updated with
+    :func:`services.workers.record_wait`.
+    """
+    stop = threading.Event()
+
+    @app.main_process_start
+    async def start(app: Sanic):
+        setattr(app.shared_ctx, f"{CTX_PREFIX}{conf.qname}_wait", Value("d", 0.0))
+
+    workers.create(
+        app, conf, max_jobs=scale.min_workers, jobs_per_worker=jobs_per_worker, wk=wk
+    )
+
+    @app.main_process_ready
+    async def ready(app: Sanic):
+        pool = WorkerPool(app, conf, wk, jobs_per_worker)
+        threading.Thread(
+            target=autoscale_thread,
+            args=(app, conf, scale, pool, stop),
+            name=f"autoscale-{conf.qname}",
+            daemon=True,
+        ).start()
+
+    @app.main_process_stop
+    async def stop_autoscaler(app: Sanic):
+        stop.set()
@@ -1,7 +1,10 @@
+import json
 import os
 import sys
 from functools import partial
-from typing import List
+from typing import Any, Dict, List, Optional
+from urllib.error import URLError
+from urllib.request import urlopen
 
 import click
 from rich.console import Console
@@ -187,3 +190,58 @@ def clean_tasks(settings_module):
 
     utils.from_sync2async(_clean, settings.TASKS)
     console.print(f"[green]=> Tasks cleaned[/]")
+
+
+def _fetch_stats(url: str) -> Dict[str, Any]:
+    with urlopen(url, timeout=10) as rsp:
+        return json.loads(rsp.read())
+
+
+def _seconds(value: Optional[float]) -> str:
+    if value is None:
+        return "-"
+    if value < 1:
+        return f"<{round(value * 1000)}ms"
+    return f"<{value}s"
+
+
+@tasks_cli.command(name="stats")
+@click.option(
+    "--url",
+    "-u",
+    default="http://127.0.0.1:8000/tasks/metrics",
+    help="metrics_url of the queue in a running app",
+)
+def stats_tasks(url):
+    """Metrics of the workers of a queue"""
+    try:
+        stats = _fetch_stats(url)
+    except (URLError, ValueError) as e:
+        console.print(f"[red bold]Metrics not available at {url}: {e}[/]")
+        sys.exit(-1)
+
+    table = Table(title="Tasks stats")
+    table.add_column("name")
+    table.add_column("done")
+    table.add_column("failed")
+    table.add_column("fail rate")
+    table.add_column("wait p50")
+    table.add_column("wait p95")
+    table.add_column("run p50")
+    table.add_column("run p95")
+    for name, t in sorted(stats["tasks"].items()):
+        table.add_row(
+            name,
+            f"{t['finished'].get(workers.TaskStatus.done.value, 0)}",
+            f"{t['finished'].get(workers.TaskStatus.failed.value, 0)}",
+            f"{t['fail_rate']:.1%}",
+            _seconds(t["wait_p50"]),
+            _seconds(t["wait_p95"]),
+            _seconds(t["run_p50"]),
+            _seconds(t["run_p95"]),
+        )
+    console.print(table)
+    console.print(
+        f"\n [bold]{stats['workers']}[/bold] workers, "
+        f"[bold]{stats['throughput']:.2f}[/bold] tasks/s"
+    )
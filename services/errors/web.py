@@ -28,3 +28,14 @@ class MissingAuthorizationHeader(SanicJWTException):
 
     def __init__(self, message="Authorization header not present.", **kwargs):
         super().__init__(message, **kwargs)
+
+
+class QueueFull(SanicException):
+    """The task queue is full, the client should retry later"""
+
+    status_code = 503
+    quiet = True
+
+    def __init__(self, message="Task queue is full.", **kwargs):
+        kwargs.setdefault("headers", {"Retry-After": "1"})
+        super().__init__(message, **kwargs)
@@ -0,0 +1,390 @@
+import asyncio
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from multiprocessing.managers import BaseManager
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from services.errors import BadConfigurationException
+from services.workers import (
+    EXPIRED_TO_FAILED,
+    FINISHED_STATES,
+    IDEMPOTENT_STATES,
+    PENDING_STATES,
+    IState,
+    Task,
+    TaskStatus,
+    eta_delay,
+)
+
+_state: Optional["MemoryState"] = None
+
+
+class MemoryState:
+    """
+    Tasks kept in a dict. A min-heap of `(expires_at, taskid)` gives the
+    next task to expire, so :meth:`expire` only looks at expired tasks.
+    Entries are not removed from the heap when a task changes, they are
+    skipped when popped if the task has a newer `expires_at`.
+
+    It is thread safe, because a :class:`StateManager` serves each client
+    from its own thread. :meth:`wait_finished` blocks the thread of its
+    client until the task finishes, so waiters in any process are woken up
+    when the result is set.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, Dict[str, Any]] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+        # notified when a task finishes or is deleted
+        self._changed = threading.Condition(self._lock)
+        # name -> (owner, expires_at)
+        self._named_locks: Dict[str, Tuple[str, float]] = {}
+        # idempotency key -> taskid
+        self._keys: Dict[str, str] = {}
+        # group id -> taskids
+        self._groups: Dict[str, Set[str]] = {}
+
+    def _touch(self, data: Dict[str, Any]):
+        pending = data["state"] in PENDING_STATES
+        ttl = data["timeout"] if pending else data["result_ttl"]
+        if data["state"] == TaskStatus.waiting.value:
+            ttl += eta_delay(data.get("eta"))
+        data["expires_at"] = time.time() + ttl
+        heapq.heappush(self._heap, (data["expires_at"], data["id"]))
+
+    def add(self, data: Dict[str, Any]):
+        self.add_many([data])
+
+    def add_many(self, items: List[Dict[str, Any]]):
+        with self._lock:
+            for data in items:
+                data = dict(data, result=None)
+                self._tasks[data["id"]] = data
+                if data.get("group_id"):
+                    self._groups.setdefault(data["group_id"], set()).add(data["id"])
+                self._touch(data)
+
+    def group_progress(self, group_id: str) -> Dict[str, int]:
+        progress: Dict[str, int] = {}
+        with self._lock:
+            for taskid in self._groups.get(group_id, ()):
+                state = self._tasks[taskid]["state"]
+                progress[state] = progress.get(state, 0) + 1
+        return progress
+
+    def _forget(self, data: Dict[str, Any]):
+        del self._tasks[data["id"]]
+        group = self._groups.get(data.get("group_id") or "")
+        if group is not None:
+            group.discard(data["id"])
+            if not group:
+                del self._groups[data["group_id"]]
+
+    def _held(self, key: str) -> Optional[Dict[str, Any]]:
+        data = self._tasks.get(self._keys.get(key, ""))
+        if (
+            data is None
+            or data["state"] not in IDEMPOTENT_STATES
+            or data["expires_at"] <= time.time()
+        ):
+            return None
+        return data
+
+    def add_once(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Add the task unless another one holds its idempotency key
+
+        :return: the task holding the key, None if it was added
+        """
+        key = data["idempotency_key"]
+        with self._lock:
+            held = self._held(key)
+            if held is not None:
+                return dict(held)
+            data = dict(data, result=None)
+            self._tasks[data["id"]] = data
+            self._keys[key] = data["id"]
+            self._touch(data)
+        return None
+
+    def find_by_key(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._held(key)
+            return dict(data) if data else None
+
+    def get(self, taskid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._tasks.get(taskid)
+            return dict(data) if data else None
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(d) for d in self._tasks.values()]
+
+    def update(self, taskid: str, values: Dict[str, Any]) -> bool:
+        with self._lock:
+            data = self._tasks.get(taskid)
+            if data is None:
+                return False
+            data.update(values, updated_at=datetime.utcnow())
+            self._touch(data)
+            if data["state"] in FINISHED_STATES:
+                self._changed.notify_all()
+        return True
+
+    def delete(self, taskid: str) -> bool:
+        with self._lock:
+            data = self._tasks.get(taskid)
+            if data is None:
+                return False
+            self._forget(data)
+            self._changed.notify_all()
+        return True
+
+    def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        now = time.time()
+        with self._lock:
+            current, expires_at = self._named_locks.get(name, (owner, now))
+            if current != owner and expires_at > now:
+                return False
+            self._named_locks[name] = (owner, now + ttl)
+        return True
+
+    def release_lock(self, name: str, owner: str):
+        with self._lock:
+            if self._named_locks.get(name, (None, 0))[0] == owner:
+                del self._named_locks[name]
+
+    def expire(self, now: Optional[float] = None) -> List[Tuple[str, str]]:
+        """
+        Tasks not started, or still running, after their timeout are failed,
+        finished tasks are deleted after their `result_ttl`.
+
+        :return: id and state of the deleted tasks
+        """
+        now = now or time.time()
+        deleted = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, taskid = heapq.heappop(self._heap)
+                data = self._tasks.get(taskid)
+                if data is None or data["expires_at"] != expires_at:
+                    continue
+                if data["state"] in EXPIRED_TO_FAILED:
+                    data.update(
+                        state=TaskStatus.failed.value,
+                        result={"error": "timeout, could be running"},
+                        updated_at=datetime.utcnow(),
+                    )
+                    self._touch(data)
+                elif data["state"] not in PENDING_STATES:
+                    self._forget(data)
+                    if self._keys.get(data["idempotency_key"]) == taskid:
+                        del self._keys[data["idempotency_key"]]
+                    deleted.append((taskid, data["state"]))
+            self._changed.notify_all()
+        return deleted
+
+    def wait_finished(self, taskid: str, timeout: float) -> Optional[bool]:
+        """
+        Block up to `timeout` seconds until the task finishes.
+
+        :return: True if it is finished, False if it doesn't exist and None
+            if it is still pending after `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                data = self._tasks.get(taskid)
+                if data is None or data["state"] in FINISHED_STATES:
+                    return data is not None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+
+def _get_state() -> MemoryState:
+    global _state
+    if _state is None:
+        _state = MemoryState()
+    return _state
+
+
+class StateManager(BaseManager):
+    # added by :meth:`register`, returns a proxy of the :class:`MemoryState`
+    get_state: Callable[[], MemoryState]
+
+
+StateManager.register("get_state", callable=_get_state)
+
+
+def _address(uri: str) -> Optional[Tuple[str, int]]:
+    """
+    :raises BadConfigurationException: if the uri has a host but no port,
+        the workers couldn't find the random port bound by the server.
+    """
+    parsed = urlparse(uri)
+    if not parsed.hostname:
+        return None
+    if parsed.port is None:
+        raise BadConfigurationException(f"port missing in {uri}")
+    return (parsed.hostname, parsed.port)
+
+
+class MemoryBackend(IState):
+    """
+    Tasks state kept in memory, for single node deployments.
+
+    With `memory://` the state lives in the current process. With an
+    address, like `memory://127.0.0.1:7080`, the state lives in a
+    :class:`StateManager` started by :meth:`serve` from the main process
+    of the app, and the web and queue workers connect to it. The port is
+    required, so every process knows where to connect. Calls to the
+    manager are blocking round trips over a local socket, so they run in
+    up to :attr:`max_callers` threads, out of the event loop.
+    :meth:`wait_finished` blocks in up to :attr:`max_waiters` threads of
+    its own, in slices of :attr:`wait_slice` seconds so concurrent
+    long-polls take turns, and wakes up as soon as a worker in any process
+    sets the result.
+    """
+
+    wait_slice = 1.0
+    max_waiters = 8
+    max_callers = 4
+
+    def __init__(self, state: MemoryState, manager: Optional[StateManager] = None):
+        self.state = state
+        self.manager = manager
+        self._waiter: Optional[ThreadPoolExecutor] = None
+        self._caller: Optional[ThreadPoolExecutor] = None
+
+    async def _call(self, method: str, *args):
+        """Call a method of the state, in a thread when it lives in a manager"""
+        fn = getattr(self.state, method)
+        if self.manager is None:
+            return fn(*args)
+        if not self._caller:
+            self._caller = ThreadPoolExecutor(
+                max_workers=self.max_callers, thread_name_prefix="memory-caller"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._caller, partial(fn, *args))
+
+    @classmethod
+    def serve(cls, uri: str, extra: Dict[str, Any] = {}) -> Optional[StateManager]:
+        address = _address(uri)
+        if address is None:
+            return None
+        manager = StateManager(address=address)
+        manager.start()
+        return manager
+
+    @classmethod
+    async def from_uri(cls, uri: str, extra: Dict[str, Any] = {}) -> "IState":
+        address = _address(uri)
+        if address is None:
+            return cls(_get_state())
+        manager = StateManager(address=address)
+
+        def _connect():
+            manager.connect()
+            return manager.get_state()
+
+        loop = asyncio.get_running_loop()
+        return cls(await loop.run_in_executor(None, _connect), manager)
+
+    async def add_task(self, task: Task):
+        await self._call("add", task.dict())
+
+    async def add_tasks(self, tasks: List[Task]):
+        await self._call("add_many", [t.dict() for t in tasks])
+
+    async def group_progress(self, group_id: str) -> Dict[str, int]:
+        return await self._call("group_progress", group_id)
+
+    async def add_task_once(self, task: Task) -> Task:
+        held = await self._call("add_once", task.dict())
+        if held is None:
+            return task
+        return Task(**held)
+
+    async def find_by_key(self, key: str) -> Optional[Task]:
+        data = await self._call("find_by_key", key)
+        if data is None:
+            return None
+        return Task(**data)
+
+    async def get_task(self, taskid: str) -> Optional[Task]:
+        data = await self._call("get", taskid)
+        if data is None:
+            return None
+        return Task(**data)
+
+    async def list_tasks(self) -> List[Task]:
+        return [Task(**d) for d in await self._call("list")]
+
+    async def update_status(self, taskid: str, status: str) -> bool:
+        return await self._call("update", taskid, {"state": status})
+
+    async def delete_task(self, taskid: str) -> bool:
+        return await self._call("delete", taskid)
+
+    async def get_result(self, taskid: str) -> Optional[Dict[str, Any]]:
+        data = await self._call("get", taskid)
+        if data is None:
+            return None
+        return data["result"]
+
+    async def set_result(self, taskid: str, *, result: Dict[str, Any], status: str):
+        await self._call("update", taskid, {"state": status, "result": result})
+
+    async def set_retry(
+        self, taskid: str, *, attempt: int, result: Dict[str, Any], eta: datetime
+    ):
+        values = {"state": TaskStatus.waiting.value, "attempt": attempt}
+        await self._call("update", taskid, dict(values, result=result, eta=eta))
+
+    async def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        return await self._call("acquire_lock", name, owner, ttl)
+
+    async def release_lock(self, name: str, owner: str):
+        await self._call("release_lock", name, owner)
+
+    async def wait_finished(self, taskid: str, timeout: float) -> bool:
+        if not self._waiter:
+            self._waiter = ThreadPoolExecutor(
+                max_workers=self.max_waiters, thread_name_prefix="memory-waiter"
+            )
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            wait = max(min(remaining, self.wait_slice), 0)
+            finished = await loop.run_in_executor(
+                self._waiter, self.state.wait_finished, taskid, wait
+            )
+            if finished is not None:
+                return finished
+            if remaining <= self.wait_slice:
+                return False
+
+    async def close(self):
+        for pool in (self._waiter, self._caller):
+            if pool:
+                pool.shutdown(wait=False)
+        self._waiter = None
+        self._caller = None
+
+    async def clean(self):
+        await self._call("expire")
+
+    async def clean_failed(self) -> List[str]:
+        deleted = await self._call("expire")
+        return [t for t, state in deleted if state == TaskStatus.failed.value]
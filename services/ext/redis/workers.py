@@ -0,0 +1,375 @@
+import json
+import math
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from redis.asyncio import Redis  # type: ignore[import]
+
+from services.redis_conn import create_pool
+from services.workers import (
+    FINISHED_STATES,
+    IDEMPOTENT_STATES,
+    IState,
+    Task,
+    TaskStatus,
+    eta_delay,
+)
+
+# Writes are done only if the task still exists, otherwise an expired task
+# would be created again with partial data. The TTL of the key is refreshed
+# from the values stored in the task.
+_UPDATE_STATUS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[1], 'updated_at', ARGV[2])
+local vals = redis.call('HMGET', KEYS[1], 'timeout', 'result_ttl')
+local ttl = (tonumber(vals[1]) or 0) + (tonumber(vals[2]) or 0)
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+return 1
+"""
+
+# failed tasks are added to the zset KEYS[2], scored by the epoch when
+# their result expires, see :meth:`RedisBackend.clean_failed`.
+_SET_RESULT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[1], 'updated_at', ARGV[2], 'result', ARGV[3])
+local ttl = tonumber(redis.call('HGET', KEYS[1], 'result_ttl'))
+if ttl and ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+if ARGV[1] == ARGV[5] then
+    redis.call('ZADD', KEYS[2], tonumber(ARGV[6]) + (ttl or 0), ARGV[7])
+end
+redis.call('PUBLISH', ARGV[4], ARGV[1])
+return 1
+"""
+
+# like _UPDATE_STATUS, the task waits ARGV[5] seconds before running again
+_SET_RETRY = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call(
+    'HSET', KEYS[1], 'state', ARGV[1], 'updated_at', ARGV[2],
+    'attempt', ARGV[3], 'result', ARGV[4]
+)
+local vals = redis.call('HMGET', KEYS[1], 'timeout', 'result_ttl')
+local ttl = (tonumber(vals[1]) or 0) + (tonumber(vals[2]) or 0)
+redis.call('EXPIRE', KEYS[1], ttl + math.ceil(tonumber(ARGV[5])))
+return 1
+"""
+
+# a lock is a key holding its owner, it can be renewed only by its owner
+_ACQUIRE_LOCK = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# the key of an idempotency key holds the id of the task, it is taken over
+# if that task doesn't exist anymore or it is not in IDEMPOTENT_STATES.
+# KEYS: idempotency key, new task, task holding the key as read by the client.
+# ARGV: id read by the client, states, ttl, taskid, then the task hash fields.
+# It returns 0 if the key changed after it was read, to be read again.
+_ADD_TASK_ONCE = """
+local id = redis.call('GET', KEYS[1])
+if (id or '') ~= ARGV[1] then
+    return 0
+end
+if id then
+    local state = redis.call('HGET', KEYS[3], 'state')
+    if state and string.find(ARGV[2], ',' .. state .. ',', 1, true) then
+        return id
+    end
+end
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('SET', KEYS[1], ARGV[4], 'EX', ARGV[3])
+return false
+"""
+
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisBackend(IState):
+    """
+    Tasks state stored in redis hashes, one hash by task. Instead of sweeping
+    the tasks, each hash expires by itself: `timeout + result_ttl` seconds
+    after it is created or updated, counted from the eta of tasks waiting
+    for it, and `result_ttl` seconds after its result is set.
+
+    The client should be created with `decode_responses=True`,
+    as :func:`services.redis_conn.create_pool` does.
+
+    Scripts declare every key they touch in `KEYS`. On Redis Cluster the keys
+    of a script or a transaction must share a hash slot, so `ns` should be
+    a hash tag, like `{tasks}`, and all the keys live in the same node.
+    """
+
+    def __init__(self, driver: Redis, ns: str = "tasks"):
+        self.driver = driver
+        self.ns = ns
+        self._update_status = driver.register_script(_UPDATE_STATUS)
+        self._set_retry = driver.register_script(_SET_RETRY)
+        self._set_result = driver.register_script(_SET_RESULT)
+        self._acquire_lock = driver.register_script(_ACQUIRE_LOCK)
+        self._release_lock = driver.register_script(_RELEASE_LOCK)
+        self._add_task_once = driver.register_script(_ADD_TASK_ONCE)
+
+    @classmethod
+    async def from_uri(cls, uri: str, extra: Dict[str, Any] = {}) -> "IState":
+        driver = create_pool(uri)
+        return cls(driver, ns=extra.get("ns", "tasks"))
+
+    def _key(self, taskid: str) -> str:
+        return f"{self.ns}:task:{taskid}"
+
+    def _group(self, group_id: str) -> str:
+        return f"{self.ns}:group:{group_id}"
+
+    def _idempotency_key(self, key: str) -> str:
+        return f"{self.ns}:key:{key}"
+
+    def _failed(self) -> str:
+        return f"{self.ns}:failed"
+
+    def _channel(self, taskid: str) -> str:
+        return f"{self.ns}:finished:{taskid}"
+
+    @staticmethod
+    def _ttl(task: Task) -> int:
+        return task.timeout + task.result_ttl + math.ceil(eta_delay(task.eta))
+
+    @staticmethod
+    def _to_hash(task: Task) -> Dict[str, Any]:
+        data = {
+            "id": task.id,
+            "name": task.name,
+            "params": json.dumps(task.params),
+            "state": task.state,
+            "app_name": task.app_name,
+            "timeout": task.timeout,
+            "result_ttl": task.result_ttl,
+            "created_at": task.created_at.isoformat(),
+            "updated_at": task.updated_at.isoformat(),
+            "attempt": task.attempt,
+        }
+        for k in ("idempotency_key", "group_id"):
+            if getattr(task, k) is not None:
+                data[k] = getattr(task, k)
+        return data
+
+    @staticmethod
+    def _from_hash(data: Dict[str, Any]) -> Task:
+        data = dict(data)
+        data.pop("result", None)
+        data["params"] = json.loads(data.get("params") or "{}")
+        return Task(**data)
+
+    async def add_task(self, task: Task):
+        await self.add_tasks([task])
+
+    async def add_tasks(self, tasks: List[Task]):
+        """
+        Tasks are added in one transaction. Tasks of a group are kept in a
+        set, to get their states without scanning all the tasks.
+        """
+        async with self.driver.pipeline(transaction=True) as pipe:
+            for task in tasks:
+                key = self._key(task.id)
+                ttl = self._ttl(task)
+                pipe.hset(key, mapping=self._to_hash(task))
+                pipe.expire(key, ttl)
+                if task.group_id:
+                    pipe.sadd(self._group(task.group_id), task.id)
+                    # it doesn't outlive the last task added
+                    pipe.expire(self._group(task.group_id), ttl)
+            await pipe.execute()
+
+    async def group_progress(self, group_id: str) -> Dict[str, int]:
+        taskids = await self.driver.smembers(self._group(group_id))
+        async with self.driver.pipeline(transaction=False) as pipe:
+            for taskid in taskids:
+                pipe.hget(self._key(taskid), "state")
+            states = await pipe.execute()
+        progress: Dict[str, int] = {}
+        for state in states:
+            # expired tasks are not counted
+            if state is not None:
+                progress[state] = progress.get(state, 0) + 1
+        return progress
+
+    async def add_task_once(self, task: Task) -> Task:
+        """
+        The key and the task are checked and added in one script. The id of
+        the task holding the key is read first, so the script gets its key.
+        """
+        states = f",{','.join(IDEMPOTENT_STATES)},"
+        fields: List[Any] = [states, self._ttl(task), task.id]
+        for k, v in self._to_hash(task).items():
+            fields.extend([k, v])
+        key = self._idempotency_key(task.idempotency_key)
+        while True:
+            held_id = await self.driver.get(key)
+            held_key = self._key(held_id) if held_id else self._key(task.id)
+            held = await self._add_task_once(
+                keys=[key, self._key(task.id), held_key],
+                args=[held_id or "", *fields],
+            )
+            if held is None:
+                return task
+            if held == 0:
+                # another task took the key after it was read
+                continue
+            # it could expire before being read, then the key is free again
+            found = await self.get_task(held)
+            if found is not None:
+                return found
+
+    async def find_by_key(self, key: str) -> Optional[Task]:
+        taskid = await self.driver.get(self._idempotency_key(key))
+        if taskid is None:
+            return None
+        task = await self.get_task(taskid)
+        if task is None or task.state not in IDEMPOTENT_STATES:
+            return None
+        return task
+
+    async def get_task(self, taskid: str) -> Task:
+        data = await self.driver.hgetall(self._key(taskid))
+        if not data:
+            return None
+        return self._from_hash(data)
+
+    async def list_tasks(self) -> List[Task]:
+        keys = [k async for k in self.driver.scan_iter(match=self._key("*"))]
+        async with self.driver.pipeline(transaction=False) as pipe:
+            for k in keys:
+                pipe.hgetall(k)
+            rows = await pipe.execute()
+        return [self._from_hash(r) for r in rows if r]
+
+    async def update_status(self, taskid: str, status: str) -> bool:
+        now = datetime.utcnow().isoformat()
+        rsp = await self._update_status(keys=[self._key(taskid)], args=[status, now])
+        return bool(rsp)
+
+    async def delete_task(self, taskid: str) -> bool:
+        await self.driver.delete(self._key(taskid))
+        return True
+
+    async def get_result(self, taskid: str) -> Optional[Dict[str, Any]]:
+        rsp = await self.driver.hget(self._key(taskid), "result")
+        if rsp is None:
+            return None
+        return json.loads(rsp)
+
+    async def set_result(self, taskid: str, *, result: Dict[str, Any], status: str):
+        now = datetime.utcnow().isoformat()
+        await self._set_result(
+            keys=[self._key(taskid), self._failed()],
+            args=[
+                status,
+                now,
+                json.dumps(result),
+                self._channel(taskid),
+                TaskStatus.failed.value,
+                time.time(),
+                taskid,
+            ],
+        )
+
+    async def set_retry(
+        self, taskid: str, *, attempt: int, result: Dict[str, Any], eta: datetime
+    ):
+        now = datetime.utcnow()
+        delay = max((eta - now).total_seconds(), 0)
+        await self._set_retry(
+            keys=[self._key(taskid)],
+            args=[
+                TaskStatus.waiting.value,
+                now.isoformat(),
+                attempt,
+                json.dumps(result),
+                delay,
+            ],
+        )
+
+    async def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        key = f"{self.ns}:lock:{name}"
+        rsp = await self._acquire_lock(keys=[key], args=[owner, ttl])
+        return bool(rsp)
+
+    async def release_lock(self, name: str, owner: str):
+        await self._release_lock(keys=[f"{self.ns}:lock:{name}"], args=[owner])
+
+    async def wait_finished(self, taskid: str, timeout: float) -> bool:
+        """
+        The result is published to a channel by task when it is set.
+        The state is checked after subscribing, so a result set in between
+        is not lost.
+        """
+        pubsub = self.driver.pubsub()
+        await pubsub.subscribe(self._channel(taskid))
+        try:
+            task = await self.get_task(taskid)
+            if task is None or task.state in FINISHED_STATES:
+                return task is not None
+            deadline = time.monotonic() + timeout
+            remaining = timeout
+            while remaining > 0:
+                msg = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=remaining
+                )
+                if msg:
+                    return True
+                remaining = deadline - time.monotonic()
+            return False
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.close()
+
+    async def close(self):
+        await self.driver.close()
+
+    async def clean(self):
+        """Tasks expire by themselves, nothing to do"""
+
+    async def clean_failed(self) -> List[str]:
+        """
+        Delete failed tasks older than their `result_ttl`, like the hashes
+        expiring by themselves. A `result_ttl` of 0 doesn't set a TTL, so
+        those are only deleted here. Failed tasks are taken from a zset by
+        the time their result expires, instead of scanning all the tasks.
+        """
+        due = await self.driver.zrangebyscore(self._failed(), "-inf", time.time())
+        if not due:
+            return []
+        async with self.driver.pipeline(transaction=False) as pipe:
+            for taskid in due:
+                pipe.hget(self._key(taskid), "state")
+            states = await pipe.execute()
+        # tasks which expired or ran again are only removed from the zset
+        failed = [t for t, s in zip(due, states) if s == TaskStatus.failed.value]
+        async with self.driver.pipeline(transaction=True) as pipe:
+            if failed:
+                pipe.delete(*[self._key(t) for t in failed])
+            pipe.zrem(self._failed(), *due)
+            await pipe.execute()
+        return failed
@@ -1,66 +1,272 @@
+import asyncio
 import contextlib
-from datetime import datetime
+import json
+import time
+from datetime import datetime, timedelta, timezone
 from functools import partial
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+from sanic.log import logger
 from sqlalchemy import (
     JSON,
     Column,
     DateTime,
+    Float,
+    Index,
     Integer,
+    LargeBinary,
     MetaData,
     String,
     Table,
+    and_,
+    bindparam,
+    case,
 )
 from sqlalchemy import delete as sqldelete
-from sqlalchemy import select, update
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import inspect, literal, or_, select, text, update
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.sql import functions
 
 from services.db import async_set_pragma, async_vacuum
+from services.storage import IAsyncStore
+from services.utils import get_class, secure_random_str
 
 # from services.db.utils import CreateTableIfNotExists
 from services.workers import (
+    EXPIRED_TO_FAILED,
+    IDEMPOTENT_STATES,
+    PENDING_STATES,
+    IQueueTransport,
     IState,
+    Priority,
     Task,
     TaskStatus,
-    elapsed_time_from_finish,
-    elapsed_time_from_start,
 )
 
+# the queue is claimed by rank, the epoch when a task was put plus the delay
+# of its priority. Lower lanes are not starved: a task is claimed after the
+# tasks of higher lanes put at most that many seconds after it.
+PRIORITY_DELAY = {
+    Priority.high.value: 0,
+    Priority.default.value: 5,
+    Priority.low.value: 30,
+}
+
+
+def _timestamp(dt: datetime) -> float:
+    """epoch of a naive utc datetime"""
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _missing_columns(conn, tables: List[Table]) -> List[Column]:
+    insp = inspect(conn)
+    missing: List[Column] = []
+    for tbl in tables:
+        if not insp.has_table(tbl.name):
+            continue
+        existing = {c["name"] for c in insp.get_columns(tbl.name)}
+        missing.extend(c for c in tbl.columns if c.name not in existing)
+    return missing
+
+
+def _add_missing_columns(conn, tables: List[Table]) -> List[str]:
+    """
+    Add the columns, and their indexes, missing in tables created by an
+    older version, ``create_all`` doesn't change existing tables. Columns
+    are added as nullable, with their default if it is a constant.
+
+    :return: names of the columns added
+    """
+    added = []
+    for col in _missing_columns(conn, tables):
+        tbl = col.table
+        ddl = f"{col.name} {col.type.compile(dialect=conn.dialect)}"
+        default = getattr(col.server_default, "arg", None)
+        if isinstance(default, str):
+            ddl = f"{ddl} DEFAULT {default}"
+        conn.execute(text(f"ALTER TABLE {tbl.name} ADD COLUMN {ddl}"))
+        if col.unique:
+            conn.execute(
+                text(
+                    f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{tbl.name}_{col.name} "
+                    f"ON {tbl.name} ({col.name})"
+                )
+            )
+        logger.warning("Column %s added to the table %s", col.name, tbl.name)
+        added.append(col.name)
+    if added:
+        for tbl in tables:
+            for index in tbl.indexes:
+                index.create(conn, checkfirst=True)
+    return added
+
+
+async def upgrade_tables(engine: AsyncEngine, tables: List[Table]) -> List[str]:
+    """
+    Add the missing columns of `tables`, see :func:`_add_missing_columns`.
+
+    :return: names of the columns added
+    """
+    try:
+        async with engine.begin() as conn:
+            return await conn.run_sync(_add_missing_columns, tables)
+    except (OperationalError, ProgrammingError):
+        # another worker could be upgrading the same tables
+        async with engine.connect() as conn:
+            missing = await conn.run_sync(_missing_columns, tables)
+        if missing:
+            raise
+        return []
+
 
 class SQLBackend(IState):
+    """
+    State of the tasks stored in a SQL table.
+
+    If `write_behind_ms` is greater than 0, :meth:`update_status` and
+    :meth:`set_result` don't write to the database, the changes are kept in
+    memory and flushed together after `write_behind_ms` milliseconds
+    in a single transaction. Reads made by the same backend instance
+    see the pending changes.
+
+    If a `store` is given, results bigger than `result_max_bytes` are
+    written to it and the table keeps only their key. They are read from
+    the store by :meth:`get_result`, other reads don't load the results.
+    """
+
     def __init__(
         self,
         engine: AsyncEngine,
         meta=MetaData(),
         table_state="tasks_state",
         # table_history="tasks_history",
+        write_behind_ms: int = 0,
+        store: Optional[IAsyncStore] = None,
+        result_max_bytes: int = 64 * 1024,
     ):
         self.meta = meta
         self._tasks = self._create_tasks_table(table_state)
+        # everything but the result, for reads of the tasks
+        self._meta_columns = [c for c in self._tasks.c if c.name != "result"]
+        self._locks = self._create_locks_table(f"{table_state}_locks")
         # self._history = self._create_tasks_table(table_history)
         self.engine = engine
+        self.write_behind = write_behind_ms / 1000
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._flushing: Dict[str, Dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.store = store
+        self.result_max_bytes = result_max_bytes
 
     async def _dispose(self):
         await self.engine.dispose()
 
-    @contextlib.asynccontextmanager
-    async def conn(self):
+    async def close(self):
+        """It raises if the pending updates can't be written"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
         try:
-            async with self.engine.connect() as conn:
-                yield conn
+            await self.flush()
         finally:
-            await self.engine.dispose()
+            await self._dispose()
+
+    def _buffer(self, taskid: str, values: Dict[str, Any]):
+        self._pending.setdefault(taskid, {}).update(values)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _merge_pending(self, taskid: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        for buffer in (self._flushing, self._pending):
+            if taskid in buffer:
+                data.update(buffer[taskid])
+        return data
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.write_behind)
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Writing the pending updates of tasks failed")
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _restore_flushing(self):
+        """Put back a batch not written, updates buffered after it win"""
+        for taskid, values in self._flushing.items():
+            self._pending[taskid] = {**values, **self._pending.get(taskid, {})}
+
+    async def flush(self):
+        """
+        Write pending updates, one ``executemany`` for each group of
+        tasks updating the same columns. If it fails, the updates are kept
+        to be written by the next flush.
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            groups: Dict[tuple, List[Dict[str, Any]]] = {}
+            for taskid, values in self._flushing.items():
+                # the eta is not a column, a retry expires counting from it
+                since = max(
+                    values.get("eta") or values["updated_at"], values["updated_at"]
+                )
+                values = {k: v for k, v in values.items() if k != "eta"}
+                keys = tuple(sorted(values))
+                row = {f"_{k}": v for k, v in values.items()}
+                row["_id"] = taskid
+                row["_ts"] = _timestamp(since)
+                groups.setdefault(keys, []).append(row)
+            try:
+                async with self.begin() as conn:
+                    for keys, rows in groups.items():
+                        values = {k: bindparam(f"_{k}") for k in keys}
+                        values["expires_at"] = self._expires_at(
+                            bindparam("_state"), bindparam("_ts")
+                        )
+                        stmt = (
+                            update(self._tasks)
+                            .where(self._tasks.c.id == bindparam("_id"))
+                            .values(values)
+                        )
+                        await conn.execute(stmt, rows)
+            except Exception:
+                self._restore_flushing()
+                raise
+            finally:
+                self._flushing = {}
+
+    def _expires_at(self, state, ts):
+        """
+        SQL expression of the expiration of a task moving to `state`
+        at the epoch `ts`.
+        """
+        tbl = self._tasks
+        # no IN clause, it can't be expanded by executemany
+        pending = or_(*[state == s for s in PENDING_STATES])
+        ttl = case((pending, tbl.c.timeout), else_=tbl.c.result_ttl)
+        return ts + ttl
+
+    @contextlib.asynccontextmanager
+    async def conn(self):
+        async with self.engine.connect() as conn:
+            yield conn
 
     @contextlib.asynccontextmanager
     async def begin(self):
-        try:
-            async with self.engine.begin() as conn:
-                yield conn
-        finally:
-            await self.engine.dispose()
+        async with self.engine.begin() as conn:
+            yield conn
+
+    def pool_status(self) -> Dict[str, int]:
+        """Checkout stats of the connection pool"""
+        pool = self.engine.pool
+        stats = {}
+        for k in ("size", "checkedin", "checkedout", "overflow"):
+            fn = getattr(pool, k, None)
+            if fn:
+                stats[k] = fn()
+        return stats
 
     async def create_all(self):
         # f = partial(CreateTableIfNotExists, self._tasks)
@@ -71,21 +277,61 @@ class SQLBackend(IState):
                 await conn.run_sync(f)
             except OperationalError:
                 pass
+        added = await upgrade_tables(self.engine, [self._tasks, self._locks])
+        if "expires_at" in added:
+            # tasks of the older version expire a ttl after the upgrade
+            tbl = self._tasks
+            stmt = (
+                update(tbl)
+                .where(tbl.c.expires_at.is_(None))
+                .values(expires_at=self._expires_at(tbl.c.state, time.time()))
+            )
+            async with self.begin() as conn:
+                await conn.execute(stmt)
+
+    @staticmethod
+    def create_engine(uri: str, extra: Dict[str, Any] = {}) -> AsyncEngine:
+        """
+        The engine is kept for the whole life of the worker and disposed
+        on :meth:`close`.
+        """
+        opts = {
+            "echo": extra.get("echo", False),
+            "pool_pre_ping": extra.get("pool_pre_ping", False),
+        }
+        if "sqlite" not in uri.split("://", maxsplit=1)[0]:
+            opts["pool_size"] = extra.get("pool_size", 5)
+            opts["max_overflow"] = extra.get("max_overflow", 5)
+        return create_async_engine(uri, **opts)
 
     @classmethod
     async def from_uri(cls, uri: str, extra: Dict[str, Any] = {}) -> "IState":
-        _echo = extra.get("echo", False)
         _table = extra.get("table_state", "tasks_state")
         _wal = extra.get("wal", True)
-        engine = create_async_engine(uri, echo=_echo)
+        engine = cls.create_engine(uri, extra)
         if _wal:
             await async_set_pragma(engine)
 
-        obj = cls(engine, table_state=_table)
+        store = None
+        store_conf = extra.get("result_store")
+        if store_conf:
+            Store = get_class(store_conf["store_class"])
+            store = await Store.from_uri(store_conf["bucket"])
+
+        obj = cls(
+            engine,
+            table_state=_table,
+            write_behind_ms=extra.get("write_behind_ms", 0),
+            store=store,
+            result_max_bytes=extra.get("result_max_bytes", 64 * 1024),
+        )
         await obj.create_all()
         return obj
 
     def _create_tasks_table(self, name):
+        if name in self.meta.tables:
+            # redefining it would duplicate its indexes
+            return self.meta.tables[name]
         tbl = Table(
             name,
             self.meta,
@@ -95,6 +341,8 @@ class SQLBackend(IState):
             Column("state", String(), index=True),
             Column("app_name", String(), index=True),
             Column("result", JSON, nullable=True),
+            # key of the result in the store, if it was too big for the table
+            Column("result_key", String(), nullable=True),
             Column("timeout", Integer()),
             Column("result_ttl", Integer()),
             Column(
@@ -110,6 +358,26 @@ class SQLBackend(IState):
                 server_default=functions.now(),
                 nullable=False,
             ),
+            # epoch when the task should be expired by :meth:`clean`
+            Column("expires_at", Float(), nullable=True),
+            # only one task holds a key, see :meth:`add_task_once`
+            Column("idempotency_key", String(), nullable=True, unique=True),
+            Column("group_id", String(), nullable=True, index=True),
+            Column("attempt", Integer(), nullable=False, server_default="1"),
+            Index(f"ix_{name}_state_expires_at", "state", "expires_at"),
+            extend_existing=True,
+        )
+        return tbl
+
+    def _create_locks_table(self, name):
+        if name in self.meta.tables:
+            return self.meta.tables[name]
+        tbl = Table(
+            name,
+            self.meta,
+            Column("name", String(), primary_key=True),
+            Column("owner", String(), nullable=False),
+            Column("expires_at", Float(), nullable=False),
             extend_existing=True,
         )
         return tbl
@@ -135,140 +403,538 @@ class SQLBackend(IState):
 
     async def add_task(self, task: Task):
         async with self.begin() as conn:
-            await conn.execute(self._tasks.insert(), [task.dict()])
+            await self._add(conn, task)
             # await conn.commit()
 
-    async def get_task(self, taskid: str) -> Task:
+    def _row(self, task: Task) -> Dict[str, Any]:
+        data = task.dict(include=set(self._tasks.c.keys()))
+        ttl = task.timeout if task.state in PENDING_STATES else task.result_ttl
+        since = task.updated_at
+        if task.state == TaskStatus.waiting.value and task.eta:
+            since = max(since, task.eta)
+        data["expires_at"] = _timestamp(since) + ttl
+        return data
+
+    async def _add(self, conn, task: Task):
+        await conn.execute(self._tasks.insert(), [self._row(task)])
+
+    async def add_tasks(self, tasks: List[Task]):
+        """
+        All the tasks in one executemany, SQLAlchemy sends it as multi-row
+        inserts within the limit of bind parameters of the database.
+        """
+        if not tasks:
+            return
+        rows = [self._row(t) for t in tasks]
+        async with self.begin() as conn:
+            await conn.execute(self._tasks.insert(), rows)
+
+    async def group_progress(self, group_id: str) -> Dict[str, int]:
+        if self.write_behind:
+            await self.flush()
+        tbl = self._tasks
+        stmt = (
+            select(tbl.c.state, functions.count())
+            .where(tbl.c.group_id == group_id)
+            .group_by(tbl.c.state)
+        )
+        async with self.conn() as conn:
+            res = await conn.execute(stmt)
+            return {state: total for state, total in res.fetchall()}
+
+    async def find_by_key(self, key: str) -> Optional[Task]:
+        tbl = self._tasks
+        stmt = select(*self._meta_columns).where(tbl.c.idempotency_key == key)
+        stmt = stmt.limit(1)
         async with self.conn() as conn:
-            stmt = select(self._tasks).where(self._tasks.c.id == taskid).limit(1)
             res = await conn.execute(stmt)
             row = res.fetchone()
-            task = Task(**dict(row._mapping))
+        if row is None:
+            return None
+        data = self._merge_pending(row.id, dict(row._mapping))
+        if data["state"] not in IDEMPOTENT_STATES or data["expires_at"] <= time.time():
+            return None
+        return Task(**data)
+
+    async def add_task_once(self, task: Task) -> Task:
+        """
+        The key is unique in the table. A failed or expired task releases its
+        key when a new task takes it, and if two tasks are added at the same
+        time only one insert succeeds, the other gets the task added.
+        """
+        tbl = self._tasks
+        key = task.idempotency_key
+        if self.write_behind:
+            # the state of the holder could be pending to be written
+            await self.flush()
+        held = await self.find_by_key(key)
+        if held is not None:
+            return held
+        released = or_(
+            tbl.c.state.notin_(IDEMPOTENT_STATES), tbl.c.expires_at <= time.time()
+        )
+        try:
+            async with self.begin() as conn:
+                await conn.execute(
+                    update(tbl)
+                    .where(tbl.c.idempotency_key == key)
+                    .where(released)
+                    .values(idempotency_key=None)
+                )
+                await self._add(conn, task)
+        except IntegrityError:
+            held = await self.find_by_key(key)
+            if held is None:
+                raise
+            return held
         return task
 
+    async def get_task(self, taskid: str) -> Optional[Task]:
+        tbl = self._tasks
+        async with self.conn() as conn:
+            stmt = select(*self._meta_columns).where(tbl.c.id == taskid).limit(1)
+            res = await conn.execute(stmt)
+            row = res.fetchone()
+        if row is None:
+            return None
+        return Task(**self._merge_pending(taskid, dict(row._mapping)))
+
     async def list_tasks(self) -> List[Task]:
         async with self.conn() as conn:
-            stmt = select(self._tasks)
+            stmt = select(*self._meta_columns)
             res = await conn.execute(stmt)
             rows = res.fetchall()
-            tasks = [Task(**dict(r._mapping)) for r in rows]
+            tasks = [Task(**self._merge_pending(r.id, dict(r._mapping))) for r in rows]
         return tasks
 
     async def update_status(self, taskid: str, status: str) -> bool:
         now = datetime.utcnow()
+        if self.write_behind:
+            self._buffer(taskid, {"state": status, "updated_at": now})
+            return True
 
         async with self.begin() as conn:
             stmt = (
                 update(self._tasks)
                 .where(self._tasks.c.id == taskid)
-                .values(state=status, updated_at=now)
+                .values(
+                    state=status,
+                    updated_at=now,
+                    expires_at=self._expires_at(literal(status), _timestamp(now)),
+                )
             )
             await conn.execute(stmt)
 
         return True
 
     async def delete_task(self, taskid: str) -> bool:
+        # a result offloaded by an update not flushed yet
+        pending = self._merge_pending(taskid, {}).get("result_key")
+        self._pending.pop(taskid, None)
         async with self.begin() as conn:
-            r = await self._delete(conn, taskid)
-        return r
-
-    async def _delete(self, conn, taskid: str) -> bool:
-        stmt = sqldelete(self._tasks).where(self._tasks.c.id == taskid)
-        await conn.execute(stmt)
+            keys = await self._delete(conn, taskid)
+        await self._delete_results(list({pending, *keys}))
         return True
 
-    async def get_result(self, taskid: str) -> Dict[str, Any]:
+    async def _delete(self, conn, taskid: str) -> List[Optional[str]]:
+        """:return: keys of the results in the store, to be deleted too"""
+        tbl = self._tasks
+        stmt = sqldelete(tbl).where(tbl.c.id == taskid).returning(tbl.c.result_key)
+        res = await conn.execute(stmt)
+        return [r.result_key for r in res.fetchall()]
+
+    async def _delete_results(self, keys: List[Optional[str]]):
+        for key in keys:
+            if not key or self.store is None:
+                continue
+            try:
+                await self.store.delete(key)
+            except Exception:
+                # an object left in the store doesn't stop the cleaning
+                logger.warning("Result %s not deleted from the store", key)
+
+    async def _result_values(
+        self, taskid: str, result: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Columns to write `result`: inline, or its key when it is too big
+        for the table and it goes to the store.
+        """
+        if self.store is None:
+            return {"result": result, "result_key": None}
+        data = json.dumps(result).encode("utf-8")
+        if len(data) <= self.result_max_bytes:
+            return {"result": result, "result_key": None}
+        key = f"{self._tasks.name}/{taskid}.json"
+        await self.store.put(key, data)
+        return {"result": None, "result_key": key}
+
+    async def get_result(self, taskid: str) -> Optional[Dict[str, Any]]:
+        tbl = self._tasks
         async with self.conn() as conn:
-            stmt = select(self._tasks).where(self._tasks.c.id == taskid).limit(1)
+            stmt = (
+                select(tbl.c.result, tbl.c.result_key)
+                .where(tbl.c.id == taskid)
+                .limit(1)
+            )
             res = await conn.execute(stmt)
             row = res.fetchone()
-            task_dict = dict(row)
+        if row is None:
+            return None
+        task_dict = self._merge_pending(taskid, dict(row._mapping))
+        if task_dict.get("result_key"):
+            data = await self.store.get(task_dict["result_key"])
+            return json.loads(data)
         return task_dict["result"]
 
+    async def _stored_key(self, taskid: str) -> Optional[str]:
+        """Key of the result of the task in the store, from an earlier attempt"""
+        if self.store is None:
+            return None
+        data = self._merge_pending(taskid, {})
+        if "result_key" in data:
+            return data["result_key"]
+        tbl = self._tasks
+        async with self.conn() as conn:
+            res = await conn.execute(select(tbl.c.result_key).where(tbl.c.id == taskid))
+            return res.scalar()
+
     async def set_result(self, taskid: str, *, result: Dict[str, Any], status: str):
-        async with self.begin() as conn:
-            await self._set_result(conn, taskid, result, status)
+        previous = await self._stored_key(taskid)
+        values = await self._result_values(taskid, result)
+        if self.write_behind:
+            values.update(state=status, updated_at=datetime.utcnow())
+            self._buffer(taskid, values)
+        else:
+            async with self.begin() as conn:
+                await self._set_result(conn, taskid, values, status)
+        if values["result_key"] is None:
+            # an inline result replaces the one offloaded by a retry
+            await self._delete_results([previous])
 
     async def _set_result(
         self,
         conn,
         taskid: str,
-        result: Dict[str, Any],
+        values: Dict[str, Any],
         status: str,
     ):
         now = datetime.utcnow()
         stmt = (
             update(self._tasks)
             .where(self._tasks.c.id == taskid)
-            .values(result=result, updated_at=now, state=status)
+            .values(
+                **values,
+                updated_at=now,
+                state=status,
+                expires_at=self._expires_at(literal(status), _timestamp(now)),
+            )
         )
         await conn.execute(stmt)
 
+    async def set_retry(
+        self, taskid: str, *, attempt: int, result: Dict[str, Any], eta: datetime
+    ):
+        now = datetime.utcnow()
+        previous = await self._stored_key(taskid)
+        values = await self._result_values(taskid, result)
+        values.update(state=TaskStatus.waiting.value, attempt=attempt, updated_at=now)
+        if self.write_behind:
+            self._buffer(taskid, dict(values, eta=eta))
+        else:
+            tbl = self._tasks
+            values["expires_at"] = self._expires_at(
+                literal(TaskStatus.waiting.value), _timestamp(max(now, eta))
+            )
+            async with self.begin() as conn:
+                await conn.execute(update(tbl).where(tbl.c.id == taskid).values(values))
+        if values["result_key"] is None:
+            await self._delete_results([previous])
+
+    async def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        now = time.time()
+        tbl = self._locks
+        stmt = (
+            update(tbl)
+            .where(tbl.c.name == name)
+            .where(or_(tbl.c.owner == owner, tbl.c.expires_at < now))
+            .values(owner=owner, expires_at=now + ttl)
+        )
+        try:
+            async with self.begin() as conn:
+                res = await conn.execute(stmt)
+                if res.rowcount == 0:
+                    # nobody took it yet, only one insert can win
+                    await conn.execute(
+                        tbl.insert(),
+                        [{"name": name, "owner": owner, "expires_at": now + ttl}],
+                    )
+        except IntegrityError:
+            return False
+        return True
+
+    async def release_lock(self, name: str, owner: str):
+        tbl = self._locks
+        stmt = sqldelete(tbl).where(tbl.c.name == name).where(tbl.c.owner == owner)
+        async with self.begin() as conn:
+            await conn.execute(stmt)
+
     async def _vacuum(self):
         await async_vacuum(self.engine, self._tasks.name)
 
-    async def clean_failed(self) -> List[str]:
-        async with self.conn() as conn:
-            stmt = select(self._tasks).where(
-                self._tasks.c.state == TaskStatus.failed.value
-            )
+    async def _delete_expired(self, state: str) -> List[str]:
+        tbl = self._tasks
+        stmt = (
+            sqldelete(tbl)
+            .where(tbl.c.state == state)
+            .where(tbl.c.expires_at < time.time())
+            .returning(tbl.c.id, tbl.c.result_key)
+        )
+        async with self.begin() as conn:
             res = await conn.execute(stmt)
             rows = res.fetchall()
-            tasks = [Task(**dict(r._mapping)) for r in rows]
-        # futures = []
-        tasks_ids = []
-        async with self.begin() as conn:
-            for t in tasks:
-                elapsed = elapsed_time_from_finish(t)
-                if elapsed > t.result_ttl:
-                    # futures.append(self.delete_task(t.id))
-                    await self._delete(conn, t.id)
-                    tasks_ids.append(t.id)
+        await self._delete_results([r.result_key for r in rows])
+        return [r.id for r in rows]
 
-        # await asyncio.gather(*futures, return_exceptions=True)
-        return tasks_ids
+    async def clean_failed(self) -> List[str]:
+        return await self._delete_expired(TaskStatus.failed.value)
 
-    async def _clean_done(self):
-        async with self.conn() as conn:
-            stmt = select(self._tasks).where(
-                self._tasks.c.state == TaskStatus.done.value
-            )
-            res = await conn.execute(stmt)
-            rows = res.fetchall()
-            tasks = [Task(**dict(r._mapping)) for r in rows]
+    async def _clean_done(self) -> List[str]:
+        return await self._delete_expired(TaskStatus.done.value)
 
-        # futures = []
+    async def _move_to_failed(self) -> List[str]:
+        """
+        Fail tasks not started before their timeout, or still running after
+        it, when the worker running them died.
+        """
+        now = datetime.utcnow()
+        ts = _timestamp(now)
+        tbl = self._tasks
+        expired = and_(tbl.c.state.in_(EXPIRED_TO_FAILED), tbl.c.expires_at < ts)
         async with self.begin() as conn:
-            for t in tasks:
-                elapsed = elapsed_time_from_finish(t)
-                if elapsed > t.result_ttl:
-                    await self._delete(conn, t.id)
-                # futures.append(self.delete_task(t.id))
-        # await asyncio.gather(*futures, return_exceptions=False)
-
-    async def _move_to_failed(self):
-        async with self.conn() as conn:
-            stmt = select(self._tasks).where(
-                self._tasks.c.state == TaskStatus.created.value
+            # the key is cleared by the update, RETURNING gives the new value
+            res = await conn.execute(select(tbl.c.id, tbl.c.result_key).where(expired))
+            keys = {r.id: r.result_key for r in res.fetchall()}
+            if not keys:
+                return []
+            stmt = (
+                update(tbl)
+                .where(tbl.c.id.in_(list(keys)))
+                .where(expired)
+                .values(
+                    result={"error": "timeout, could be running"},
+                    result_key=None,
+                    state=TaskStatus.failed.value,
+                    updated_at=now,
+                    expires_at=ts + tbl.c.result_ttl,
+                )
+                .returning(tbl.c.id)
             )
             res = await conn.execute(stmt)
-            rows = res.fetchall()
-            tasks = [Task(**dict(r._mapping)) for r in rows]
-
-        # futures = []
-        async with self.begin() as conn:
-            for t in tasks:
-                elapsed = elapsed_time_from_start(t)
-                if elapsed > t.timeout:
-                    _res = {"error": "timeout, could be running"}
-                    # futures.append(
-                    #    self.set_result(t.id, result=_res, status=TaskStatus.failed.value)
-                    # )
-                    await self._set_result(
-                        conn, t.id, result=_res, status=TaskStatus.failed.value
-                    )
-            # await asyncio.gather(*futures, return_exceptions=True)
+            failed = [r.id for r in res.fetchall()]
+        await self._delete_results([keys[taskid] for taskid in failed])
+        return failed
 
     async def clean(self):
+        await self.flush()
         await self._clean_done()
         await self._move_to_failed()
+
+
+class SQLQueue(IQueueTransport):
+    """
+    Durable queue stored in a table, it could live in the same database
+    as :class:`SQLBackend`. Many workers, even in different hosts, can share
+    the same queue.
+
+    Tasks are claimed in order of rank, see :data:`PRIORITY_DELAY`. Tasks
+    with an `eta` stay in the table, and are not claimed until they are due.
+    Workers claim a batch of tasks in one statement: on Postgres the rows are
+    selected with ``FOR UPDATE SKIP LOCKED``, so concurrent workers don't wait
+    for each other; on SQLite the ``UPDATE ... RETURNING`` is atomic by itself.
+    Claimed tasks are deleted when they are acked. If a worker dies, its
+    tasks are claimed again after `visibility_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        meta=MetaData(),
+        qname="default",
+        table_queue="tasks_queue",
+        poll_interval: float = 0.1,
+        visibility_timeout: int = 600,
+    ):
+        self.meta = meta
+        self.engine = engine
+        self.qname = qname
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self._worker = secure_random_str(8)
+        self._queue = self._create_queue_table(table_queue)
+
+    def _create_queue_table(self, name):
+        if name in self.meta.tables:
+            return self.meta.tables[name]
+        tbl = Table(
+            name,
+            self.meta,
+            Column("id", String(), primary_key=True),
+            Column("qname", String(), index=True, nullable=False),
+            Column("payload", LargeBinary(), nullable=False),
+            Column("created_at", DateTime(), index=True, nullable=False),
+            Column("rank", Float(), nullable=False),
+            # epoch since the task can be claimed
+            Column("available_at", Float(), nullable=False),
+            Column("claimed_at", DateTime(), nullable=True),
+            Column("claimed_by", String(), nullable=True),
+            Index(f"ix_{name}_qname_rank", "qname", "rank"),
+            extend_existing=True,
+        )
+        return tbl
+
+    async def create_all(self):
+        f = partial(self.meta.create_all, checkfirst=True)
+        async with self.engine.begin() as conn:
+            try:
+                await conn.run_sync(f)
+            except OperationalError:
+                pass
+        await upgrade_tables(self.engine, [self._queue])
+
+    @classmethod
+    async def from_uri(cls, uri: str, extra: Dict[str, Any] = {}) -> "IQueueTransport":
+        _wal = extra.get("wal", True)
+        engine = SQLBackend.create_engine(uri, extra)
+        if _wal:
+            await async_set_pragma(engine)
+        obj = cls(
+            engine,
+            qname=extra.get("qname", "default"),
+            table_queue=extra.get("table_queue", "tasks_queue"),
+            poll_interval=extra.get("poll_interval", 0.1),
+            visibility_timeout=extra.get("visibility_timeout", 600),
+        )
+        await obj.create_all()
+        return obj
+
+    def _row(self, task: Task, data: Union[str, bytes], now: datetime):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        available_at = _timestamp(task.eta or now)
+        return {
+            "id": task.id,
+            "qname": self.qname,
+            "payload": data,
+            "created_at": now,
+            "rank": available_at + PRIORITY_DELAY[task.priority],
+            "available_at": available_at,
+        }
+
+    async def put(self, task: Task, data: Union[str, bytes]):
+        await self.put_many([(task, data)])
+
+    async def requeue(self, task: Task, data: Union[str, bytes]):
+        """The claimed row is released, it is claimed again after the eta"""
+        row = self._row(task, data, datetime.utcnow())
+        tbl = self._queue
+        stmt = (
+            update(tbl)
+            .where(tbl.c.id == task.id)
+            .values(
+                payload=row["payload"],
+                rank=row["rank"],
+                available_at=row["available_at"],
+                claimed_at=None,
+                claimed_by=None,
+            )
+        )
+        async with self.engine.begin() as conn:
+            res = await conn.execute(stmt)
+            if res.rowcount == 0:
+                await conn.execute(tbl.insert(), [row])
+
+    async def put_many(self, items: List[Tuple[Task, Union[str, bytes]]]):
+        """All the tasks in one executemany, like :meth:`SQLBackend.add_tasks`"""
+        if not items:
+            return
+        now = datetime.utcnow()
+        rows = [self._row(task, data, now) for task, data in items]
+        async with self.engine.begin() as conn:
+            await conn.execute(self._queue.insert(), rows)
+
+    async def _claim(self, max_items: int) -> List[Union[str, bytes]]:
+        now = datetime.utcnow()
+        expired = now - timedelta(seconds=self.visibility_timeout)
+        tbl = self._queue
+        pending = (
+            select(tbl.c.id)
+            .where(tbl.c.qname == self.qname)
+            .where(tbl.c.available_at <= _timestamp(now))
+            .where(or_(tbl.c.claimed_at.is_(None), tbl.c.claimed_at < expired))
+            .order_by(tbl.c.rank)
+            .limit(max_items)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(tbl)
+            .where(tbl.c.id.in_(pending.scalar_subquery()))
+            .values(claimed_at=now, claimed_by=self._worker)
+            .returning(tbl.c.rank, tbl.c.payload)
+        )
+        async with self.engine.begin() as conn:
+            res = await conn.execute(stmt)
+            rows = res.fetchall()
+        return [r.payload for r in sorted(rows, key=lambda r: r.rank)]
+
+    async def get_many(
+        self, max_items: int, max_wait: Optional[float] = None
+    ) -> List[Union[str, bytes]]:
+        started = time.monotonic()
+        while True:
+            rows = await self._claim(max_items)
+            if rows:
+                return rows
+            if max_wait is not None and time.monotonic() - started >= max_wait:
+                return []
+            await asyncio.sleep(self.poll_interval)
+
+    async def drop_oldest(self) -> Optional[bytes]:
+        tbl = self._queue
+        oldest = (
+            select(tbl.c.id)
+            .where(tbl.c.qname == self.qname)
+            .where(tbl.c.claimed_at.is_(None))
+            .order_by(tbl.c.rank)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            sqldelete(tbl)
+            .where(tbl.c.id.in_(oldest.scalar_subquery()))
+            .returning(tbl.c.payload)
+        )
+        async with self.engine.begin() as conn:
+            res = await conn.execute(stmt)
+            row = res.fetchone()
+        return row.payload if row else None
+
+    async def ack(self, taskids: List[str]):
+        stmt = sqldelete(self._queue).where(self._queue.c.id.in_(taskids))
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt)
+
+    async def qsize(self) -> int:
+        stmt = (
+            select(functions.count())
+            .select_from(self._queue)
+            .where(self._queue.c.qname == self.qname)
+            .where(self._queue.c.claimed_at.is_(None))
+            .where(self._queue.c.available_at <= _timestamp(datetime.utcnow()))
+        )
+        async with self.engine.connect() as conn:
+            res = await conn.execute(stmt)
+            return res.scalar_one()
+
+    async def close(self):
+        await self.engine.dispose()
@@ -0,0 +1,236 @@
+"""
+Metrics of the tasks run by the workers: how long tasks wait in the queue,
+how long they run and how many finish in each state, by task name.
+
+Each worker counts in its own memory and, at most every `interval` seconds,
+publishes a snapshot to a dict shared with the main process of the app,
+see :class:`MetricsPublisher`. Snapshots of all the workers are merged
+when they are read, by :func:`merge`. A worker removes its snapshot when
+it shuts down, so only the workers alive are counted.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, MutableMapping, Optional
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    float("inf"),
+)
+
+
+class Histogram:
+    """Counts of values by bucket, like a prometheus histogram"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Histogram":
+        h = cls()
+        h.counts = list(data["counts"])
+        h.sum = data["sum"]
+        h.count = data["count"]
+        return h
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the quantile `q`"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            if total >= rank:
+                # the last bucket has no bound, report the previous one
+                return bound if bound != float("inf") else self.buckets[-2]
+        return self.buckets[-2]
+
+
+class _NameMetrics:
+    def __init__(self):
+        self.finished: Dict[str, int] = {}
+        self.wait = Histogram()
+        self.run = Histogram()
+
+
+class TaskMetrics:
+    """
+    Metrics of the tasks run by a worker. It is thread safe, tasks of
+    process pools are counted from the callbacks of the pool.
+    """
+
+    def __init__(self):
+        self._names: Dict[str, _NameMetrics] = {}
+        self._lock = threading.Lock()
+        self.since = time.time()
+
+    def _get(self, name: str) -> _NameMetrics:
+        m = self._names.get(name)
+        if m is None:
+            m = self._names[name] = _NameMetrics()
+        return m
+
+    def started(self, name: str, wait: float):
+        with self._lock:
+            self._get(name).wait.observe(wait)
+
+    def finished(self, name: str, state: str, run_time: float):
+        with self._lock:
+            m = self._get(name)
+            m.finished[state] = m.finished.get(state, 0) + 1
+            m.run.observe(run_time)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            tasks = {
+                name: {
+                    "finished": dict(m.finished),
+                    "wait": m.wait.to_dict(),
+                    "run": m.run.to_dict(),
+                }
+                for name, m in self._names.items()
+            }
+        return {"since": self.since, "updated_at": time.time(), "tasks": tasks}
+
+
+class MetricsPublisher:
+    """
+    Publish the :class:`TaskMetrics` of a worker to `shared`, a dict from
+    a :class:`multiprocessing.Manager`, under the name of the worker.
+    Each publication is a round trip to the manager, so it is done at most
+    every `interval` seconds.
+    """
+
+    def __init__(
+        self,
+        shared: MutableMapping[str, Any],
+        worker: str,
+        interval: float = 5.0,
+    ):
+        self.metrics = TaskMetrics()
+        self.shared = shared
+        self.worker = worker
+        self.interval = interval
+        self._published_at = 0.0
+
+    def maybe_publish(self, force=False):
+        now = time.monotonic()
+        if force or now - self._published_at >= self.interval:
+            self._published_at = now
+            self.shared[self.worker] = self.metrics.snapshot()
+
+    def retire(self):
+        """Remove the snapshot of the worker, when it shuts down"""
+        try:
+            self.shared.pop(self.worker, None)
+        except (OSError, EOFError):
+            # the manager could be shutting down with the app
+            pass
+
+
+def merge(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge snapshots of many workers, adding quantiles, the rate of
+    failed tasks and the throughput in tasks by second.
+    """
+    now = time.time()
+    merged: Dict[str, Dict[str, Any]] = {}
+    throughput = 0.0
+    workers = 0
+    for snap in snapshots:
+        workers += 1
+        elapsed = max(snap["updated_at"] - snap["since"], 1.0)
+        for name, data in snap["tasks"].items():
+            item = merged.setdefault(
+                name, {"finished": {}, "wait": Histogram(), "run": Histogram()}
+            )
+            for state, n in data["finished"].items():
+                item["finished"][state] = item["finished"].get(state, 0) + n
+            item["wait"].merge(Histogram.from_dict(data["wait"]))
+            item["run"].merge(Histogram.from_dict(data["run"]))
+            throughput += sum(data["finished"].values()) / elapsed
+    tasks = {}
+    for name, item in merged.items():
+        total = sum(item["finished"].values())
+        wait: Histogram = item["wait"]
+        run: Histogram = item["run"]
+        tasks[name] = {
+            "finished": item["finished"],
+            "fail_rate": item["finished"].get("FAILED", 0) / total if total else 0.0,
+            "wait_p50": wait.quantile(0.5),
+            "wait_p95": wait.quantile(0.95),
+            "run_p50": run.quantile(0.5),
+            "run_p95": run.quantile(0.95),
+            "wait": wait.to_dict(),
+            "run": run.to_dict(),
+        }
+    return {
+        "workers": workers,
+        "throughput": throughput,
+        "generated_at": now,
+        "buckets": [str(b) for b in BUCKETS],
+        "tasks": tasks,
+    }
+
+
+def _labels(**labels: str) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+
+def to_prometheus(merged: Dict[str, Any], qname: str) -> str:
+    """Text exposition format of the metrics merged by :func:`merge`"""
+    lines: List[str] = [
+        "# TYPE tasks_finished_total counter",
+    ]
+    for name, data in merged["tasks"].items():
+        for state, n in data["finished"].items():
+            labels = _labels(queue=qname, task=name, state=state)
+            lines.append(f"tasks_finished_total{{{labels}}} {n}")
+    for metric in ("wait", "run"):
+        lines.append(f"# TYPE tasks_{metric}_seconds histogram")
+        for name, data in merged["tasks"].items():
+            hist = data[metric]
+            labels = _labels(queue=qname, task=name)
+            total = 0
+            for bound, n in zip(BUCKETS, hist["counts"]):
+                total += n
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(
+                    f'tasks_{metric}_seconds_bucket{{{labels},le="{le}"}} {total}'
+                )
+            lines.append(f"tasks_{metric}_seconds_sum{{{labels}}} {hist['sum']}")
+            lines.append(f"tasks_{metric}_seconds_count{{{labels}}} {hist['count']}")
+    lines.append("# TYPE tasks_workers gauge")
+    lines.append(f"tasks_workers{{{_labels(queue=qname)}}} {merged['workers']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,342 @@
+"""
+Periodic tasks, sent to a queue on an interval or a cron expression.
+
+They are registered next to :func:`services.workers.create`:
+
+.. code-block:: python
+
+    from services import periodic, workers
+
+    workers.create(app, conf)
+    periodic.create(
+        app,
+        conf,
+        [
+            periodic.PeriodicTask(name="reports.daily", cron="0 6 * * *"),
+            periodic.PeriodicTask(name="cache.refresh", every=30),
+        ],
+    )
+
+The scheduler runs in its own process managed by Sanic. When many apps
+share the same backend, only the one holding the lock of the queue in the
+backend sends the tasks, see :meth:`services.workers.IState.acquire_lock`.
+"""
+import asyncio
+import heapq
+import logging
+import socket
+import time
+from datetime import datetime, timedelta
+from itertools import count
+from os import getpid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel, Field, root_validator
+from sanic import Sanic
+from sanic.log import LOGGING_CONFIG_DEFAULTS, logger
+
+from services.errors.web import QueueFull
+from services.utils import secure_random_str
+from services.workers import (
+    WORKER_PREFIX,
+    IState,
+    Priority,
+    QueueConfig,
+    TaskQueue,
+    _get_queue_from_app,
+    init_backend,
+    init_transport,
+    is_durable,
+)
+
+# (name, min, max) of each field of a cron expression
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 6),
+)
+
+
+class CronExpr:
+    """
+    Minimal cron expression: five fields, `minute hour day month weekday`,
+    each one could be ``*``, a number, a range ``a-b``, a step ``*/n`` or
+    ``a-b/n``, or a list of them separated by commas. Weekday 0 and 7 are
+    sunday. Like cron, when day and weekday are both restricted, a time
+    matching any of them is valid.
+    """
+
+    def __init__(self, expr: str):
+        parts = expr.split()
+        if len(parts) != len(CRON_FIELDS):
+            raise ValueError(f"cron expression should have 5 fields: {expr}")
+        self.expr = expr
+        fields = [
+            self._parse(part, name, low, high)
+            for part, (name, low, high) in zip(parts, CRON_FIELDS)
+        ]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = fields
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(part: str, name: str, low: int, high: int) -> Set[int]:
+        values: Set[int] = set()
+        for item in part.split(","):
+            rng, _, step = item.partition("/")
+            if rng == "*":
+                start, end = low, high
+            elif "-" in rng:
+                start, end = (int(x) for x in rng.split("-"))
+            else:
+                start = end = int(rng)
+            if name == "weekday":
+                # 7 is sunday too
+                end = min(end, 7)
+            elif start < low or end > high:
+                raise ValueError(f"{name} out of range: {item}")
+            values.update(range(start, end + 1, int(step or 1)))
+        if name == "weekday" and 7 in values:
+            values.discard(7)
+            values.add(0)
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day = dt.day in self.days
+        # python weekdays start on monday, cron weekdays on sunday
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt: datetime) -> datetime:
+        """First time matching the expression, after `dt`"""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # four years, to cover leap days
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in self.months:
+                month = dt.month % 12 + 1
+                dt = dt.replace(
+                    year=dt.year + (month == 1), month=month, day=1, hour=0, minute=0
+                )
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f"cron expression never matches: {self.expr}")
+
+
+class PeriodicTask(BaseModel):
+    """
+    :param name: task name, as in :meth:`services.workers.TaskQueue.submit`
+    :param every: seconds between runs
+    :param cron: cron expression in utc, see :class:`CronExpr`
+    """
+
+    name: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+    every: Optional[float] = None
+    cron: Optional[str] = None
+    timeout: int = 60
+    result_ttl: int = 900
+    priority: Priority = Priority.default
+
+    class Config:
+        use_enum_values = True
+
+    @root_validator(skip_on_failure=True)
+    def check_schedule(cls, values):
+        every, cron = values.get("every"), values.get("cron")
+        if (every is None) == (cron is None):
+            raise ValueError("one of every or cron should be set")
+        if cron is not None:
+            CronExpr(cron)
+        return values
+
+    def next_run(self, after: datetime) -> datetime:
+        if self.cron:
+            return CronExpr(self.cron).next_after(after)
+        return after + timedelta(seconds=self.every)
+
+
+class PeriodicScheduler:
+    """
+    Send each :class:`PeriodicTask` to the queue when it is due.
+
+    If there is a backend, tasks are sent only while this scheduler holds
+    the lock `periodic:<app_name>:<qname>`, renewed every third of `lock_ttl`.
+    When the leader dies, another scheduler takes over after `lock_ttl`
+    seconds. Runs missed while there wasn't a leader are not sent again.
+
+    Errors of the backend or the queue are logged, they don't stop the
+    scheduler. A backend error drops the leadership until the lock is
+    acquired again, a run rejected by a full queue is skipped.
+    """
+
+    def __init__(
+        self,
+        queue: TaskQueue,
+        tasks: List[PeriodicTask],
+        backend: Optional[IState] = None,
+        lock_ttl: int = 30,
+    ):
+        self.queue = queue
+        self.tasks = tasks
+        self.backend = backend
+        self.lock_ttl = lock_ttl
+        self.lock_name = f"periodic:{queue._app_name}:{queue.qname}"
+        self.owner = f"{socket.gethostname()}-{getpid()}-{secure_random_str(4)}"
+        self.is_leader = False
+        self._heap: List[Tuple[datetime, int, int]] = []
+        self._seq = count()
+
+    def reset(self, now: datetime):
+        """Schedule every task from `now`"""
+        self._heap = []
+        for ix, ptask in enumerate(self.tasks):
+            heapq.heappush(self._heap, (ptask.next_run(now), next(self._seq), ix))
+
+    def next_in(self, now: datetime) -> Optional[float]:
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+    async def elect(self, now: datetime) -> bool:
+        was_leader = self.is_leader
+        if self.backend is None:
+            self.is_leader = True
+        else:
+            try:
+                self.is_leader = await self.backend.acquire_lock(
+                    self.lock_name, self.owner, self.lock_ttl
+                )
+            except Exception:
+                # not sure it still holds the lock, another one could take it
+                logger.exception("Periodic scheduler %s lost the lock", self.owner)
+                self.is_leader = False
+        if self.is_leader and not was_leader:
+            logger.info("Periodic scheduler %s is the leader", self.owner)
+            self.reset(now)
+        return self.is_leader
+
+    async def tick(self, now: datetime) -> List[str]:
+        """
+        Send the tasks due at `now`
+
+        :return: ids of the tasks sent
+        """
+        sent = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, ix = heapq.heappop(self._heap)
+            ptask = self.tasks[ix]
+            try:
+                task = await self.queue.submit(
+                    name=ptask.name,
+                    params=ptask.params,
+                    timeout=ptask.timeout,
+                    result_ttl=ptask.result_ttl,
+                    priority=ptask.priority,
+                )
+                sent.append(task.id)
+            except QueueFull:
+                logger.warning("Queue full, periodic task %s skipped", ptask.name)
+            except Exception:
+                # it is scheduled again from scratch when it leads again
+                logger.exception("Periodic task %s not sent", ptask.name)
+                self.is_leader = False
+                break
+            # skip the runs lost while it was blocked
+            next_run = ptask.next_run(when)
+            if next_run <= now:
+                next_run = ptask.next_run(now)
+            heapq.heappush(self._heap, (next_run, next(self._seq), ix))
+        return sent
+
+    async def run(self):
+        renew_every = self.lock_ttl / 3
+        renew_at = 0.0
+        while True:
+            now = datetime.utcnow()
+            try:
+                if time.monotonic() >= renew_at:
+                    renew_at = time.monotonic() + renew_every
+                    await self.elect(now)
+                if self.is_leader:
+                    await self.tick(now)
+            except Exception:
+                logger.exception("Periodic scheduler %s failed", self.owner)
+                self.is_leader = False
+            wait = renew_at - time.monotonic()
+            if self.is_leader and self._heap:
+                wait = min(wait, self.next_in(datetime.utcnow()))
+            await asyncio.sleep(max(wait, 0))
+
+    async def close(self):
+        if self.backend:
+            if self.is_leader:
+                await self.backend.release_lock(self.lock_name, self.owner)
+            await self.backend.close()
+        if self.queue.durable:
+            await self.queue.queue.close()
+
+
+def periodic_worker(
+    name: str,
+    queue,
+    conf: QueueConfig,
+    tasks: List[PeriodicTask],
+    lock_ttl: int = 30,
+) -> None:
+    logging.config.dictConfig(LOGGING_CONFIG_DEFAULTS)
+    pid = getpid()
+    logger.info(">> Periodic scheduler reporting for duty: %s [%s]", name, pid)
+    loop = asyncio.new_event_loop()
+    if is_durable(conf.transport):
+        queue = loop.run_until_complete(init_transport(conf))
+    backend = None
+    if conf.backend:
+        backend = loop.run_until_complete(init_backend(conf.backend))
+    tq = TaskQueue(queue, conf=conf, backend=backend)
+    scheduler = PeriodicScheduler(tq, tasks, backend=backend, lock_ttl=lock_ttl)
+    try:
+        loop.run_until_complete(scheduler.run())
+    except KeyboardInterrupt:
+        logger.info("Shutting down %s", pid)
+    finally:
+        loop.run_until_complete(scheduler.close())
+    logger.info("Stopping periodic scheduler [%s]. Goodbye", pid)
+
+
+def create(
+    app: Sanic,
+    conf: QueueConfig,
+    tasks: List[PeriodicTask],
+    lock_ttl: int = 30,
+) -> None:
+    """
+    Run a :class:`PeriodicScheduler` for the queue of `conf`, the queue
+    should be created by :func:`services.workers.create`.
+    """
+
+    @app.main_process_ready
+    async def ready(app: Sanic):
+        q = _get_queue_from_app(app, qname=conf.qname)
+        _name = f"{WORKER_PREFIX}{conf.qname}-periodic"
+        app.manager.manage(
+            _name,
+            periodic_worker,
+            {
+                "name": _name,
+                "queue": q,
+                "conf": conf,
+                "tasks": tasks,
+                "lock_ttl": lock_ttl,
+            },
+        )
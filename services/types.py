@@ -59,16 +59,38 @@ class MigrationType(BaseModel):
     version_table: str
 
 
-class TasksBackend(BaseModel):
-    uri: str = "sqlite+aiosqlite:///tasks.db"
-    backend_class: str = "services.ext.sql.workers.SQLBackend"
-
-
 class Storage(BaseModel):
     bucket: str = ".storage"
     store_class: str = "services.storage.AsyncLocal"
 
 
+class TasksBackend(BaseModel):
+    """
+    :param uri: uri of the backend
+    :param backend_class: full path of the :class:`services.workers.IState`
+    :param pool_size: connections kept open by the backend, if it has a pool.
+        Ignored by sqlite.
+    :param max_overflow: connections allowed over `pool_size`
+    :param pool_pre_ping: check connections before using them
+    :param write_behind_ms: when greater than 0, state and result updates
+        are buffered for this many milliseconds and written together
+        in one transaction.
+    :param result_store: results bigger than `result_max_bytes` are written
+        to this storage, and the backend keeps only their key. Results are
+        read from it when they are asked for.
+    :param result_max_bytes: size of a result, as JSON, kept in the backend
+    """
+
+    uri: str = "sqlite+aiosqlite:///tasks.db"
+    backend_class: str = "services.ext.sql.workers.SQLBackend"
+    pool_size: int = 5
+    max_overflow: int = 5
+    pool_pre_ping: bool = False
+    write_behind_ms: int = 0
+    result_store: Optional[Storage] = None
+    result_max_bytes: int = 64 * 1024
+
+
 class SecuritySettings(BaseSettings):
     JWT_PUBLIC: Optional[str] = None
     JWT_PRIVATE: Optional[str] = None
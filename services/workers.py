@@ -1,21 +1,54 @@
 import asyncio
+import hashlib
+import heapq
 import inspect
 import json
 import logging
+import pickle
+import random
+import signal
+import sys
+import threading
+import time
 import traceback
 from abc import ABC, abstractclassmethod, abstractmethod
-from datetime import datetime
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from functools import partial
-from multiprocessing import Manager, Queue
+from importlib import import_module
+from itertools import count, islice
+from multiprocessing import Manager, Queue, Semaphore, get_context
 from os import getpid
-from queue import Empty
-from typing import Any, Callable, Dict, List, Optional, Union
+from queue import Empty, Full
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 from pydantic import BaseModel, Field
-from sanic import Sanic
+from sanic import HTTPResponse, Sanic
 from sanic.log import LOGGING_CONFIG_DEFAULTS, logger
-
+from sanic.response import json as json_response
+from sanic.response import text as text_response
+
+from services.errors import BadConfigurationException
+from services.errors.web import QueueFull
+from services.metrics import MetricsPublisher, TaskMetrics
+from services.metrics import merge as merge_metrics
+from services.metrics import to_prometheus
 from services.types import TasksBackend
 from services.utils import get_class, get_function, secure_random_str
 
@@ -27,6 +60,41 @@ class QueueConfig(BaseModel):
     app_name: str
     qname: str = "default"
     backend: Optional[TasksBackend] = None
+    # max number of tasks taken from the queue by a worker in one wakeup
+    batch_size: int = 10
+    # max tasks waiting in each lane of the queue, None is unbounded
+    max_depth: Optional[int] = None
+    # what submit does when the queue is full: "reject" raises
+    # :class:`services.errors.web.QueueFull`, "wait" waits up to
+    # `overflow_timeout` seconds for space and "drop_oldest" cancels
+    # the oldest task of the lane.
+    overflow: str = "reject"
+    overflow_timeout: float = 5.0
+    # seconds between expirations of old tasks in the backend
+    clean_interval: float = 60.0
+    # how tasks travel between processes, see :func:`create_queue`
+    # and :class:`IQueueTransport`
+    transport: str = "process"
+    # uri for durable transports, by default the uri of the backend
+    transport_uri: Optional[str] = None
+    # durable transports: seconds before a task not acked is claimed again,
+    # so it should be longer than the timeout of any task
+    visibility_timeout: int = 600
+    # durable transports: seconds between polls of an empty queue
+    poll_interval: float = 0.1
+    # how tasks are encoded in the queue, see :class:`ITaskCodec`
+    codec_class: str = "services.workers.JSONCodec"
+    # where sync task functions run, see :func:`create_executor`
+    execution: str = "thread"
+    # recycle pool processes after this number of tasks (python >= 3.11)
+    max_tasks_per_child: Optional[int] = None
+    # task modules imported when a worker starts, ex: ["myapp.tasks"]
+    preload: List[str] = Field(default_factory=list)
+    # collect metrics of the workers and serve them at this url,
+    # ex: "/tasks/metrics", see :mod:`services.metrics`
+    metrics_url: Optional[str] = None
+    # seconds between publications of the metrics of each worker
+    metrics_interval: float = 5.0
 
 
 class TaskStatus(str, Enum):
@@ -38,22 +106,172 @@ class TaskStatus(str, Enum):
     done = "DONE"
 
 
+# states in which a task expires after `timeout` seconds,
+# finished tasks expire after `result_ttl` seconds.
+PENDING_STATES = (
+    TaskStatus.created.value,
+    TaskStatus.waiting.value,
+    TaskStatus.running.value,
+)
+# pending states failed by the backends when they expire, WAITING tasks
+# expire counting from their eta
+EXPIRED_TO_FAILED = (
+    TaskStatus.created.value,
+    TaskStatus.waiting.value,
+    TaskStatus.running.value,
+)
+FINISHED_STATES = (
+    TaskStatus.done.value,
+    TaskStatus.failed.value,
+    TaskStatus.cancelled.value,
+)
+# states in which a task holds its idempotency key, a new task with the
+# same key gets this one instead of running again.
+IDEMPOTENT_STATES = PENDING_STATES + (TaskStatus.done.value,)
+
+
+class Priority(str, Enum):
+    high = "high"
+    default = "default"
+    low = "low"
+
+
+# share of the tasks taken from each lane while all of them have tasks,
+# low lanes keep moving even when the high lane is flooded.
+LANE_WEIGHTS = {
+    Priority.high.value: 6,
+    Priority.default.value: 3,
+    Priority.low.value: 1,
+}
+
+
+class RetryPolicy(BaseModel):
+    """
+    How a failed task is retried, see :meth:`TaskQueue.submit`.
+
+    :param max_attempts: runs of the task, counting the first one
+    :param backoff: seconds before the first retry, doubled on each retry
+    :param backoff_max: upper bound of the seconds between retries
+    :param jitter: wait a random time between 0 and the backoff, so tasks
+        failing at the same time don't retry at the same time
+    :param retry_on: full path of the exceptions retried, like
+        "builtins.TimeoutError", other errors fail the task at once
+    """
+
+    max_attempts: int = 3
+    backoff: float = 1.0
+    backoff_max: float = 300.0
+    jitter: bool = True
+    retry_on: List[str] = Field(default_factory=lambda: ["builtins.Exception"])
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after the failed `attempt`, starting from 1"""
+        delay = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        if attempt >= self.max_attempts:
+            return False
+        return isinstance(error, tuple(get_class(e) for e in self.retry_on))
+
+
 class Task(BaseModel):
     name: str
     params: Dict[str, Any] = Field(default={})
-    id: str = Field(default=secure_random_str())
+    id: str = Field(default_factory=secure_random_str)
     state: str = TaskStatus.created
     app_name: str = "test"
     timeout: int = 10
     result_ttl: int = 120
-    created_at: datetime = Field(default=datetime.utcnow())
-    updated_at: datetime = Field(default=datetime.utcnow())
+    priority: Priority = Priority.default
+    # utc time when the task should run, None runs it as soon as possible
+    eta: Optional[datetime] = None
+    # tasks with the same key are not run twice, see TaskQueue.submit
+    idempotency_key: Optional[str] = None
+    # tasks sent together by TaskQueue.submit_many
+    group_id: Optional[str] = None
+    retry: Optional[RetryPolicy] = None
+    # number of the current run, it grows on each retry
+    attempt: int = 1
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
 
     class Config:
         use_enum_values = True
         arbitrary_types_allowed = True
 
 
+class Step(BaseModel):
+    """
+    A task of a pipeline, see :meth:`TaskQueue.submit_pipeline`.
+
+    :param key: name of the step in the pipeline. Its result is passed to
+        the steps after it, in their params under this key.
+    :param after: keys of the steps it waits for
+    """
+
+    key: str
+    name: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+    after: List[str] = Field(default_factory=list)
+    timeout: int = 60
+
+
+def chain(*steps: Step) -> List[Step]:
+    """Steps running one after another"""
+    chained = list(steps[:1])
+    for prev, step in zip(steps, steps[1:]):
+        chained.append(step.copy(update={"after": [prev.key]}))
+    return chained
+
+
+def pipeline_order(steps: List[Step]) -> List[Step]:
+    """
+    Steps in an order where each one comes after the steps it waits for.
+
+    :raises ValueError: if keys are repeated, unknown or there is a cycle.
+    """
+    keys = [s.key for s in steps]
+    if len(set(keys)) != len(keys):
+        raise ValueError(f"repeated keys in pipeline: {keys}")
+    for step in steps:
+        missing = set(step.after) - set(keys)
+        if missing:
+            raise ValueError(f"step {step.key} after unknown steps: {missing}")
+    order: List[Step] = []
+    done: Set[str] = set()
+    pending = list(steps)
+    while pending:
+        ready = [s for s in pending if done.issuperset(s.after)]
+        if not ready:
+            raise ValueError(f"cycle in pipeline: {[s.key for s in pending]}")
+        order.extend(ready)
+        done.update(s.key for s in ready)
+        pending = [s for s in pending if s.key not in done]
+    return order
+
+
+def _step_task(task: Task, step: Step, results: Dict[str, Any]) -> Task:
+    params = dict(step.params)
+    params.update({key: results[key] for key in step.after})
+    return Task(
+        id=f"{task.id}.{step.key}",
+        name=step.name,
+        params=params,
+        app_name=task.app_name,
+        timeout=step.timeout,
+        result_ttl=task.result_ttl,
+    )
+
+
+def task_key(name: str, params: Dict[str, Any]) -> str:
+    """Idempotency key of a task, a hash of its name and params"""
+    data = json.dumps([name, params], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
 class _Task(BaseModel):
     task: Task
     future: asyncio.Task
@@ -63,6 +281,44 @@ class _Task(BaseModel):
         arbitrary_types_allowed = True
 
 
+class ResultWaiters:
+    """
+    Futures waiting for tasks to finish in this process. The scheduler
+    notifies them after setting the result, so a wait started in the same
+    process wakes up without asking the backend again. It is used only by
+    the default :meth:`IState.wait_finished`, waits on other processes
+    still poll. The memory and Redis backends wake up waiters of any
+    process, see their `wait_finished`.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    def wait(self, taskid: str) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(taskid, []).append(fut)
+        return fut
+
+    def discard(self, taskid: str, fut: asyncio.Future):
+        waiters = self._waiters.get(taskid, [])
+        if fut in waiters:
+            waiters.remove(fut)
+        if not waiters:
+            self._waiters.pop(taskid, None)
+
+    def notify(self, taskid: str):
+        for fut in self._waiters.pop(taskid, []):
+            fut.get_loop().call_soon_threadsafe(_resolve, fut)
+
+
+def _resolve(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(True)
+
+
+result_waiters = ResultWaiters()
+
+
 class IState(ABC):
     @abstractmethod
     async def add_task(self, task: Task):
@@ -104,6 +360,408 @@ class IState(ABC):
     async def clean_failed(self) -> List[str]:
         raise NotImplementedError()
 
+    async def close(self):
+        """Release connections, called when the process is shutting down"""
+
+    @classmethod
+    def serve(cls, uri: str, extra: Dict[str, Any] = {}) -> Optional[Any]:
+        """
+        Start the server holding the state, for backends living in memory.
+        It is called once from the main process of the app, before the
+        workers start. The object returned is shutdown when the app stops.
+        """
+        return None
+
+    async def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        """
+        Take or renew the lock `name` for `ttl` seconds. It is used to elect
+        a leader between processes, like the one running periodic tasks.
+        By default there is nothing to coordinate and it is always acquired.
+
+        :return: True if `owner` holds the lock.
+        """
+        return True
+
+    async def release_lock(self, name: str, owner: str):
+        """Release the lock if it is held by `owner`"""
+
+    async def add_tasks(self, tasks: List[Task]):
+        """
+        Add many tasks at once. By default they are added one by one,
+        backends should override it with a bulk insert.
+        """
+        for task in tasks:
+            await self.add_task(task)
+
+    async def group_progress(self, group_id: str) -> Dict[str, int]:
+        """
+        Tasks of a group by state. By default it counts them from
+        :meth:`list_tasks`, backends should override it with one query.
+        """
+        progress: Dict[str, int] = {}
+        for task in await self.list_tasks():
+            if task.group_id == group_id:
+                progress[task.state] = progress.get(task.state, 0) + 1
+        return progress
+
+    async def set_retry(
+        self, taskid: str, *, attempt: int, result: Dict[str, Any], eta: datetime
+    ):
+        """
+        The task failed and runs again at `eta`: it goes back to WAITING with
+        the number of the next `attempt`, and the error of the last one as
+        result. By default only the state is updated.
+        """
+        await self.update_status(taskid, TaskStatus.waiting.value)
+
+    async def find_by_key(self, key: str) -> Optional[Task]:
+        """
+        Task holding the idempotency `key`, in one of :data:`IDEMPOTENT_STATES`.
+        By default it looks for it in :meth:`list_tasks`, backends should
+        override it with a lookup by key.
+        """
+        for task in await self.list_tasks():
+            if task.idempotency_key == key and task.state in IDEMPOTENT_STATES:
+                return task
+        return None
+
+    async def add_task_once(self, task: Task) -> Task:
+        """
+        Add `task` unless another task holds its idempotency key. By default
+        it isn't atomic: tasks with the same key added at the same time
+        could be added twice.
+
+        :return: the task holding the key, `task` if it was added.
+        """
+        held = await self.find_by_key(task.idempotency_key)
+        if held is not None:
+            return held
+        await self.add_task(task)
+        return task
+
+    async def wait_finished(self, taskid: str, timeout: float) -> bool:
+        """
+        Wait until a task is finished. By default it polls :meth:`get_task`,
+        doubling the delay between queries up to one second, and wakes up
+        earlier if the task finishes in this process.
+        Backends with a notification channel should override it.
+
+        :return: False if the task is not finished after `timeout` seconds
+            or if it doesn't exist.
+        """
+        fut = result_waiters.wait(taskid)
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        try:
+            while True:
+                task = await self.get_task(taskid)
+                if task is None or task.state in FINISHED_STATES:
+                    return task is not None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                await asyncio.wait([fut], timeout=min(delay, remaining))
+                delay = min(delay * 2, 1.0)
+        finally:
+            result_waiters.discard(taskid, fut)
+
+
+class ITaskCodec(ABC):
+    """
+    Encode and decode tasks to be sent through the queue.
+    """
+
+    @abstractmethod
+    def dumps(self, task: Task) -> Union[str, bytes]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def loads(self, data: Union[str, bytes]) -> Dict[str, Any]:
+        raise NotImplementedError()
+
+
+class JSONCodec(ITaskCodec):
+    """Default codec, params should be json serializable"""
+
+    def dumps(self, task: Task) -> Union[str, bytes]:
+        return task.json()
+
+    def loads(self, data: Union[str, bytes]) -> Dict[str, Any]:
+        return json.loads(data)
+
+
+class PickleCodec(ITaskCodec):
+    """
+    Binary codec using pickle protocol 5. Datetimes and bytes in params are
+    kept as they are, without converting them to strings and back.
+
+    Only use it when the queue is shared between trusted processes.
+    """
+
+    protocol = 5
+
+    def dumps(self, task: Task) -> Union[str, bytes]:
+        return pickle.dumps(task.dict(), protocol=self.protocol)
+
+    def loads(self, data: Union[str, bytes]) -> Dict[str, Any]:
+        if not isinstance(data, bytes):
+            raise TypeError("pickled tasks are bytes, check the codec of the queue")
+        return pickle.loads(data)
+
+
+class IQueueTransport(ABC):
+    """
+    Transport for tasks living outside of the app processes, like a table in
+    a database. Tasks are kept until a worker acks them, so they survive
+    restarts and can be shared by workers in different hosts.
+    """
+
+    # tasks not acked after this many seconds are claimed again, None if
+    # claims don't expire
+    visibility_timeout: Optional[int] = None
+
+    @abstractmethod
+    async def put(self, task: Task, data: Union[str, bytes]):
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def get_many(
+        self, max_items: int, max_wait: Optional[float] = None
+    ) -> List[Union[str, bytes]]:
+        """
+        Claim up to `max_items` tasks, waiting up to `max_wait` seconds
+        for the first one. None waits until a task arrives.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def ack(self, taskids: List[str]):
+        """Remove tasks already executed"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def qsize(self) -> int:
+        raise NotImplementedError()
+
+    @classmethod
+    @abstractmethod
+    async def from_uri(cls, uri: str, extra: Dict[str, Any] = {}) -> "IQueueTransport":
+        raise NotImplementedError()
+
+    async def drop_oldest(self) -> Optional[Union[str, bytes]]:
+        """Remove the oldest task not claimed yet, and return it"""
+        raise NotImplementedError()
+
+    async def requeue(self, task: Task, data: Union[str, bytes]):
+        """
+        Put back a task already claimed, to be claimed again after its eta.
+        By default it is put as a new task, transports keeping claimed tasks
+        until the ack should release them instead.
+        """
+        await self.put(task, data)
+
+    async def put_many(self, items: List[Tuple[Task, Union[str, bytes]]]):
+        """Put many tasks at once, by default one by one"""
+        for task, data in items:
+            await self.put(task, data)
+
+    async def close(self):
+        """Release connections, called when the process is shutting down"""
+
+
+class ILocalTransport(ABC):
+    """
+    Transport for tasks shared in memory between the processes of the app,
+    see :func:`create_queue` and :func:`create_lanes`. Calls are sync, the
+    blocking ones are done by :class:`TaskQueue` in its waiter thread.
+    Each task goes to the lane returned by :meth:`lane`.
+    """
+
+    @abstractmethod
+    def lane(self, task: Task) -> Queue:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_many(
+        self, max_items: int, max_wait: Optional[float] = None
+    ) -> List[Union[str, bytes]]:
+        """
+        Take up to `max_items` tasks, waiting up to `max_wait` seconds for
+        the first one. None waits until a task arrives and 0 doesn't wait.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def qsize(self) -> int:
+        """Tasks waiting (not available on macOS)"""
+        raise NotImplementedError()
+
+    def ring(self):
+        """Called after a task is put, to wake up a worker"""
+
+    def unring(self):
+        """Called after a task is taken out of the queue by a producer"""
+
+    def put_nowait(self, task: Task, data: Union[str, bytes]):
+        """
+        :raises queue.Full: if the lane of the task is full.
+        """
+        self.lane(task).put_nowait(data)
+        self.ring()
+
+    def put(self, task: Task, data: Union[str, bytes], timeout: Optional[float]):
+        """
+        Block up to `timeout` seconds until there is room for the task.
+
+        :raises queue.Full: if the lane is still full.
+        """
+        self.lane(task).put(data, True, timeout)
+        self.ring()
+
+    def put_dropping_oldest(
+        self, task: Task, data: Union[str, bytes]
+    ) -> Tuple[bool, Optional[Union[str, bytes]]]:
+        """
+        Put the task in its lane, taking out the oldest task of that lane
+        to make room.
+
+        :return: if the task was queued, and the task dropped to be
+            cancelled, if any. If another producer took the room, the oldest
+            task is put back when it still fits.
+        """
+        lane = self.lane(task)
+        try:
+            # a full queue could still be flushing its last task to the pipe
+            old = lane.get(True, 0.1)
+        except Empty:
+            old = None
+        try:
+            lane.put_nowait(data)
+        except Full:
+            if old is None:
+                return False, None
+            try:
+                lane.put_nowait(old)
+            except Full:
+                # it is out of the queue, nobody will take it
+                self.unring()
+                return False, old
+            return False, None
+        if old is None:
+            self.ring()
+        # else one task out and one in, nothing to ring
+        return True, old
+
+    async def close(self):
+        """Nothing to release, the queues live as long as the app"""
+
+
+class SingleQueue(ILocalTransport):
+    """A queue for all the tasks, whatever their priority"""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def lane(self, task: Task) -> Queue:
+        return self.queue
+
+    def get_many(
+        self, max_items: int, max_wait: Optional[float] = None
+    ) -> List[Union[str, bytes]]:
+        try:
+            if max_wait == 0:
+                first = self.queue.get_nowait()
+            else:
+                first = self.queue.get(timeout=max_wait)
+        except Empty:
+            return []
+        batch = [first]
+        while len(batch) < max_items:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+
+class PriorityLanes(ILocalTransport):
+    """
+    A queue for each :class:`Priority`. The doorbell is a semaphore released
+    for each task put in any lane, so workers block on it instead of polling
+    every lane. Lanes are drained by a smooth weighted round robin with the
+    weights of :data:`LANE_WEIGHTS`.
+    """
+
+    def __init__(self, doorbell, lanes: Dict[str, Any]):
+        self.doorbell = doorbell
+        self.lanes = lanes
+        self._credits = {lane: 0 for lane in LANE_WEIGHTS}
+
+    def lane(self, task: Task) -> Queue:
+        return self.lanes[task.priority]
+
+    def ring(self):
+        self.doorbell.release()
+
+    def unring(self):
+        self.doorbell.acquire(False)
+
+    def _next_lane(self) -> str:
+        for lane, weight in LANE_WEIGHTS.items():
+            self._credits[lane] += weight
+        lane = max(self._credits, key=lambda k: self._credits[k])
+        self._credits[lane] -= sum(LANE_WEIGHTS.values())
+        return lane
+
+    def _get_from_lanes(self) -> Union[str, bytes]:
+        first = self._next_lane()
+        order = [first] + [lane for lane in LANE_WEIGHTS if lane != first]
+        while True:
+            for lane in order:
+                try:
+                    return self.lanes[lane].get_nowait()
+                except Empty:
+                    pass
+            # the doorbell rang but the task is still on its way to the pipe
+            time.sleep(0.001)
+
+    def get_many(
+        self, max_items: int, max_wait: Optional[float] = None
+    ) -> List[Union[str, bytes]]:
+        if max_wait == 0:
+            rung = self.doorbell.acquire(False)
+        else:
+            rung = self.doorbell.acquire(True, max_wait)
+        if not rung:
+            return []
+        ready = 1
+        while ready < max_items and self.doorbell.acquire(False):
+            ready += 1
+        return [self._get_from_lanes() for _ in range(ready)]
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.lanes.values())
+
+
+OVERFLOW_POLICIES = ("reject", "wait", "drop_oldest")
+
+# seconds waited for a pool process to interrupt a task by itself
+CHILD_TIMEOUT_GRACE = 1.0
+
+# upper bound of the seconds waited after a durable transport fails,
+# doubled from 0.2 on each error in a row
+TRANSPORT_RETRY_MAX = 10.0
+
+# name of the tasks running a pipeline of steps
+PIPELINE_TASK = "__pipeline__"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURABLE_TRANSPORTS = {"sql": "services.ext.sql.workers.SQLQueue"}
+
 
 def elapsed_time_from_finish(task: Task):
     n = datetime.utcnow()
@@ -115,64 +773,563 @@ def elapsed_time_from_start(task: Task):
     return (n - task.created_at).total_seconds()
 
 
-def _get_kwargs(task: Task, fn: Callable) -> Dict[str, BaseModel]:
-    annot = list(fn.__annotations__.keys())
-    kwargs = {}
-    if annot:
-        params_key = annot[0]
-        params = fn.__annotations__[params_key](**task.params)
-        kwargs = {params_key: params}
-    return kwargs
+def eta_delay(eta: Optional[datetime]) -> float:
+    """
+    Seconds until `eta`, 0 if it is None or already due. Backends add it
+    to the expiration of WAITING tasks, which count from their eta.
+    """
+    if eta is None:
+        return 0.0
+    return max((eta - datetime.utcnow()).total_seconds(), 0.0)
 
 
-def _get_function(base_package, task: Task) -> Callable:
-    _name = task.name
-    if "." not in _name:
-        fn = get_function(f"{base_package}.tasks.{_name}")
-    else:
-        fn = get_function(_name)
-    return fn
+def queue_wait(task: Task) -> float:
+    """Seconds since the task could start, from its eta if it has one"""
+    since = task.eta or task.created_at
+    return max((datetime.utcnow() - since).total_seconds(), 0.0)
+
+
+def record_wait(gauge, task: Task, weight: float = 0.2):
+    """
+    Update `gauge`, a shared ``multiprocessing.Value("d")``, with the
+    moving average of the seconds tasks wait in the queue before starting.
+    Tasks with an eta are counted from their eta.
+    """
+    if gauge is None:
+        return
+    wait = queue_wait(task)
+    with gauge.get_lock():
+        gauge.value = gauge.value * (1 - weight) + wait * weight
+
+
+@dataclass
+class TaskGroup:
+    """Handle of the tasks sent by :meth:`TaskQueue.submit_many`"""
+
+    id: str
+    ids: List[str]
+    backend: Optional[IState] = None
+
+    async def progress(self) -> Dict[str, int]:
+        """Tasks of the group by state, expired tasks are not counted"""
+        if not self.backend:
+            raise BadConfigurationException("group progress without backend")
+        return await self.backend.group_progress(self.id)
+
+    async def finished(self) -> bool:
+        progress = await self.progress()
+        return sum(progress.get(s, 0) for s in FINISHED_STATES) == len(self.ids)
+
+
+@dataclass
+class TaskDef:
+    """A task function resolved once, with what is needed to call it"""
+
+    fn: Callable
+    params_key: Optional[str] = None
+    params_model: Optional[Type[BaseModel]] = None
+    is_coroutine: bool = False
+
+    @classmethod
+    def from_function(cls, fn: Callable) -> "TaskDef":
+        annot = [k for k in fn.__annotations__.keys() if k != "return"]
+        params_key = annot[0] if annot else None
+        params_model = fn.__annotations__[params_key] if params_key else None
+        return cls(
+            fn=fn,
+            params_key=params_key,
+            params_model=params_model,
+            is_coroutine=inspect.iscoroutinefunction(fn),
+        )
+
+    def get_kwargs(self, task: Task) -> Dict[str, BaseModel]:
+        if not self.params_key:
+            return {}
+        return {self.params_key: self.params_model(**task.params)}
+
+
+class TaskRegistry:
+    """
+    Cache of task functions by name. Each process (web server, worker or
+    pool process) has its own registry, so a task name is imported and
+    inspected only the first time it is used in that process.
+    """
+
+    def __init__(self):
+        self._defs: Dict[str, TaskDef] = {}
+
+    @staticmethod
+    def fullname(base_package: str, name: str) -> str:
+        if "." not in name:
+            return f"{base_package}.tasks.{name}"
+        return name
+
+    def get(self, base_package: str, name: str) -> TaskDef:
+        fullname = self.fullname(base_package, name)
+        try:
+            return self._defs[fullname]
+        except KeyError:
+            fn = get_function(fullname)
+            self._defs[fullname] = TaskDef.from_function(fn)
+        return self._defs[fullname]
+
+    def preload(self, modules: List[str]) -> int:
+        """
+        Import task modules and register the functions defined on them,
+        so the first execution of a task doesn't pay the import time.
+
+        :param modules: full path of the modules: ["myapp.tasks"]
+        :return: number of functions registered
+        """
+        total = 0
+        for mod_name in modules:
+            mod = import_module(mod_name)
+            for name, fn in inspect.getmembers(mod, inspect.isfunction):
+                if fn.__module__ == mod_name and not name.startswith("_"):
+                    self._defs[f"{mod_name}.{name}"] = TaskDef.from_function(fn)
+                    total += 1
+        return total
+
+    def __contains__(self, fullname: str) -> bool:
+        return fullname in self._defs
+
+
+registry = TaskRegistry()
+
+
+def preload_tasks(modules: List[str]):
+    """Preload `modules` in the registry of the current process"""
+    if modules:
+        total = registry.preload(modules)
+        logger.info("%s tasks preloaded from %s", total, modules)
+
+
+def _exec_pipeline(base_package, task: Task) -> Dict[str, Any]:
+    """
+    Steps of a pipeline one after another, for workers running tasks
+    in a pool process. See :meth:`Scheduler.run_pipeline`.
+    """
+    results: Dict[str, Any] = {}
+    for step in pipeline_order([Step(**s) for s in task.params["steps"]]):
+        result = _exec_task(base_package, _step_task(task, step, results))
+        if inspect.iscoroutine(result):
+            result = asyncio.run(result)
+        results[step.key] = result
+    return results
 
 
 def _exec_task(base_package, task: Task):
+    if task.name == PIPELINE_TASK:
+        return _exec_pipeline(base_package, task)
     _name = task.name
     logger.info("Starting task %s", _name)
-    fn = _get_function(base_package, task)
-    kwargs = _get_kwargs(task, fn)
-    result = fn(**kwargs)
+    taskdef = registry.get(base_package, _name)
+    result = taskdef.fn(**taskdef.get_kwargs(task))
     logger.info("Finished task %s", _name)
     return result
 
 
+def _raise_timeout(signum, frame):
+    raise TimeoutError("task timeout")
+
+
+def _exec_task_in_child(base_package, task: Task):
+    """
+    :func:`_exec_task` for pool processes. A SIGALRM interrupts the task
+    after `task.timeout` seconds, so the process is free for the next task.
+    A task stuck in a single C call doesn't see the signal, the worker kills
+    the pool after :data:`CHILD_TIMEOUT_GRACE` more seconds, see
+    :meth:`TaskPool.replace`.
+    """
+    if not task.timeout or not hasattr(signal, "setitimer"):
+        return _exec_task(base_package, task)
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, task.timeout)
+    try:
+        return _exec_task(base_package, task)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def is_durable(transport: str) -> bool:
+    return transport not in ("process", "manager")
+
+
+async def init_transport(conf: QueueConfig) -> IQueueTransport:
+    """
+    Create a durable transport. `conf.transport` could be a name from
+    `DURABLE_TRANSPORTS` or the full path of a :class:`IQueueTransport` class.
+    """
+    Cls: IQueueTransport = get_class(
+        DURABLE_TRANSPORTS.get(conf.transport, conf.transport)
+    )
+    uri = conf.transport_uri
+    if not uri:
+        if not conf.backend:
+            raise BadConfigurationException("transport_uri")
+        uri = conf.backend.uri
+    extra = {
+        "qname": conf.qname,
+        "visibility_timeout": conf.visibility_timeout,
+        "poll_interval": conf.poll_interval,
+    }
+    return await Cls.from_uri(uri, extra)
+
+
+def create_queue(transport: str = "process", maxsize: int = 0) -> SingleQueue:
+    """
+    Create the queue shared between the web server and the workers.
+
+    :param transport: "process" uses a :class:`multiprocessing.Queue`, tasks
+        are written directly to a pipe between processes. "manager" uses a queue
+        living in a :class:`multiprocessing.Manager` server, each call is a
+        round trip to that server process, but the queue can be shared with
+        processes not started by the app.
+        For durable transports see :func:`init_transport`.
+    :param maxsize: max tasks in the queue, 0 is unbounded.
+    """
+    if transport == "process":
+        return SingleQueue(Queue(maxsize))
+    if transport == "manager":
+        return SingleQueue(Manager().Queue(maxsize))
+    raise BadConfigurationException(f"transport={transport}")
+
+
+def create_lanes(transport: str = "process", maxsize: int = 0) -> PriorityLanes:
+    """
+    Like :func:`create_queue` but with a queue for each :class:`Priority`,
+    see :class:`PriorityLanes`. `maxsize` is the size of each lane.
+    """
+    if transport == "process":
+        lanes: Dict[str, Any] = {lane: Queue(maxsize) for lane in LANE_WEIGHTS}
+        return PriorityLanes(Semaphore(0), lanes)
+    if transport == "manager":
+        manager = Manager()
+        lanes = {lane: manager.Queue(maxsize) for lane in LANE_WEIGHTS}
+        return PriorityLanes(manager.Semaphore(0), lanes)
+    raise BadConfigurationException(f"transport={transport}")
+
+
+class TaskPool(ProcessPoolExecutor):
+    """
+    Process pool that can be replaced by a new one, when a task is stuck in
+    a call that a SIGALRM can't interrupt and it would hold its process
+    forever.
+    """
+
+    def __init__(self, **opts):
+        self._opts = opts
+        super().__init__(**opts)
+
+    def replace(self) -> "TaskPool":
+        """
+        Kill the processes of this pool and return a new pool like it. Other
+        tasks still running in this pool fail with ``BrokenProcessPool``.
+        """
+        for process in list((self._processes or {}).values()):
+            process.kill()
+        self.shutdown(wait=False)
+        return TaskPool(**self._opts)
+
+
+def create_executor(conf: QueueConfig, max_workers: int) -> Optional[Executor]:
+    """
+    Create the executor used to run sync task functions.
+
+    :param conf: when `conf.execution` is "thread" it returns None, so the
+        default executor of the loop is used. When it is "process" it returns a
+        :class:`TaskPool` of `max_workers` processes, then
+        CPU bound functions are not serialized by the GIL.
+    :param max_workers: size of the pool.
+    """
+    if conf.execution == "thread":
+        return None
+    if conf.execution != "process":
+        raise BadConfigurationException(f"execution={conf.execution}")
+    opts: Dict[str, Any] = {}
+    if conf.max_tasks_per_child:
+        if sys.version_info >= (3, 11):
+            opts["max_tasks_per_child"] = conf.max_tasks_per_child
+        else:
+            logger.warning("max_tasks_per_child requires python 3.11, ignoring it")
+    return TaskPool(
+        max_workers=max_workers,
+        mp_context=get_context("spawn"),
+        initializer=preload_tasks,
+        initargs=(conf.preload,),
+        **opts,
+    )
+
+
 async def init_backend(conf: TasksBackend) -> IState:
     Cls: IState = get_class(conf.backend_class)
-    backend = await Cls.from_uri(conf.uri)
+    extra = conf.dict(exclude={"uri", "backend_class"})
+    backend = await Cls.from_uri(conf.uri, extra)
     return backend
 
 
 class TaskQueue:
     def __init__(
-        self, queue: Queue, *, backend: Optional[IState] = None, conf: QueueConfig
+        self,
+        queue: Union[Queue, ILocalTransport, IQueueTransport],
+        *,
+        backend: Optional[IState] = None,
+        conf: QueueConfig,
     ) -> None:
-        self.queue = queue
+        if not isinstance(queue, (ILocalTransport, IQueueTransport)):
+            queue = SingleQueue(queue)
+        self.queue: Union[ILocalTransport, IQueueTransport] = queue
+        # durable transports are async and tasks should be acked after running
+        self.durable = isinstance(queue, IQueueTransport)
         self.qname = conf.qname
         self._app_name = conf.app_name
         self.backend = backend
+        self.codec: ITaskCodec = get_class(conf.codec_class)()
+        # blocking gets are done in its own thread, so they don't
+        # compete with sync tasks for the default executor of the loop
+        self._waiter: Optional[ThreadPoolExecutor] = None
+        # errors in a row of a durable transport, for the backoff
+        self._errors = 0
+        # wait in progress of the waiter thread, see :meth:`take_received`
+        self._receiving: Optional[asyncio.Future] = None
+        if conf.overflow not in OVERFLOW_POLICIES:
+            raise BadConfigurationException(f"overflow={conf.overflow}")
+        self.max_depth = conf.max_depth
+        self.overflow = conf.overflow
+        self.overflow_timeout = conf.overflow_timeout
+
+    def _local(self) -> ILocalTransport:
+        if not isinstance(self.queue, ILocalTransport):
+            raise TypeError(f"queue {self.qname} is durable, use the async methods")
+        return self.queue
 
     def send(self, task: Task) -> None:
-        self.queue.put_nowait(task.json())
+        """
+        :raises queue.Full: if the queue is bounded and full, the overflow
+            policy is applied only by :meth:`asend`.
+        """
+        self._local().put_nowait(task, self.codec.dumps(task))
+
+    async def depth(self) -> int:
+        """
+        Tasks waiting in the queue, to shed load before submitting. For
+        in-memory queues it reads the size of each lane, without any
+        round trip to the workers (not available on macOS).
+        """
+        if isinstance(self.queue, IQueueTransport):
+            return await self.queue.qsize()
+        return self.queue.qsize()
+
+    async def _cancel_dropped(self, data: Union[str, bytes]):
+        dropped = self.codec.loads(data)
+        logger.warning("Queue %s full, task %s dropped", self.qname, dropped["id"])
+        if self.backend:
+            await self.backend.set_result(
+                dropped["id"],
+                result={"error": "dropped, the queue was full"},
+                status=TaskStatus.cancelled.value,
+            )
 
-    def receive(self, wait=True) -> Dict[str, Any]:
-        if wait:
-            rsp = self.queue.get()
-            data = json.loads(rsp)
+    async def _overflow(self, queue: ILocalTransport, task: Task):
+        data = self.codec.dumps(task)
+        if self.overflow == "wait":
+            loop = asyncio.get_running_loop()
+            put = partial(queue.put, task, data, self.overflow_timeout)
+            try:
+                await loop.run_in_executor(None, put)
+            except Full:
+                raise QueueFull()
+        elif self.overflow == "drop_oldest":
+            queued, old = queue.put_dropping_oldest(task, data)
+            if old is not None:
+                await self._cancel_dropped(old)
+            if not queued:
+                raise QueueFull()
         else:
+            raise QueueFull()
+
+    async def _make_room(self, queue: IQueueTransport):
+        """Overflow policies for durable queues"""
+        if await queue.qsize() < self.max_depth:
+            return
+        if self.overflow == "wait":
+            deadline = time.monotonic() + self.overflow_timeout
+            while await queue.qsize() >= self.max_depth:
+                if time.monotonic() >= deadline:
+                    raise QueueFull()
+                await asyncio.sleep(0.1)
+        elif self.overflow == "drop_oldest":
+            old = await queue.drop_oldest()
+            if old is not None:
+                await self._cancel_dropped(old)
+        else:
+            raise QueueFull()
+
+    def _check_visibility(self, queue: IQueueTransport, task: Task):
+        """
+        A task running longer than the visibility timeout of the queue
+        would be claimed again by another worker while it is running.
+        """
+        if queue.visibility_timeout and task.timeout >= queue.visibility_timeout:
+            raise BadConfigurationException(
+                f"timeout={task.timeout} >= visibility_timeout="
+                f"{queue.visibility_timeout}"
+            )
+
+    async def asend(self, task: Task) -> None:
+        """
+        Send a task applying the overflow policy when the queue is full.
+
+        :raises services.errors.web.QueueFull: if the task can't be queued.
+        :raises BadConfigurationException: if the timeout of the task is
+            not shorter than the visibility timeout of a durable queue.
+        """
+        if isinstance(self.queue, IQueueTransport):
+            self._check_visibility(self.queue, task)
+            if self.max_depth:
+                await self._make_room(self.queue)
+            await self.queue.put(task, self.codec.dumps(task))
+            return
+        try:
+            self.send(task)
+        except Full:
+            await self._overflow(self.queue, task)
+
+    async def asend_many(self, tasks: List[Task]) -> int:
+        """
+        Send many tasks, durable transports put them in one batch when the
+        queue is not bounded. It stops at the first task that can't be
+        queued.
+
+        :return: how many tasks were sent, from the start of `tasks`.
+        """
+        if isinstance(self.queue, IQueueTransport) and not self.max_depth:
+            for task in tasks:
+                self._check_visibility(self.queue, task)
+            await self.queue.put_many([(t, self.codec.dumps(t)) for t in tasks])
+            return len(tasks)
+        for ix, task in enumerate(tasks):
             try:
-                rsp = self.queue.get_nowait()
-                data = json.loads(rsp)
-            except Empty:
-                return {}
-        return data
+                await self.asend(task)
+            except QueueFull:
+                return ix
+        return len(tasks)
+
+    async def requeue(self, task: Task):
+        """Send again a task already received, like a retry waiting for its eta"""
+        if isinstance(self.queue, IQueueTransport):
+            await self.queue.requeue(task, self.codec.dumps(task))
+        else:
+            await self.asend(task)
+
+    def receive(self, wait=True, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Get a task from the queue.
+
+        :param wait: if False, it returns an empty dict when the queue is empty.
+        :param timeout: when waiting, how many seconds to block before giving up
+            and returning an empty dict. None blocks until a task arrives.
+        """
+        batch = self.receive_many(1, timeout if wait else 0)
+        return batch[0] if batch else {}
+
+    def receive_many(
+        self, max_items: int = 10, max_wait: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Drain up to `max_items` tasks from the queue. It blocks up to `max_wait`
+        seconds for the first task, the rest are taken only if they are
+        already in the queue.
+
+        :param max_items: max number of tasks to return.
+        :param max_wait: how many seconds to wait for the first task,
+            None blocks until a task arrives and 0 doesn't wait at all.
+        """
+        rsp = self._local().get_many(max_items, max_wait)
+        return [self.codec.loads(data) for data in rsp]
+
+    async def areceive(self, timeout: float = 1.0) -> Dict[str, Any]:
+        """
+        Loop friendly version of :meth:`receive`. It blocks in a waiter thread
+        until a task arrives or `timeout` expires, so the task is dispatched as
+        soon as it is put in the queue and an idle worker doesn't spin.
+        """
+        batch = await self.areceive_many(1, timeout)
+        return batch[0] if batch else {}
+
+    async def areceive_many(
+        self, max_items: int = 10, max_wait: float = 1.0
+    ) -> List[Dict[str, Any]]:
+        """
+        Loop friendly version of :meth:`receive_many`. If a durable transport
+        fails, the error is logged and no task is returned after a backoff.
+        """
+        if isinstance(self.queue, IQueueTransport):
+            try:
+                rsp = await self.queue.get_many(max_items, max_wait)
+            except Exception:
+                self._errors += 1
+                delay = min(0.1 * 2**self._errors, TRANSPORT_RETRY_MAX)
+                logger.exception(
+                    "Receiving from queue %s failed, retrying in %.1fs",
+                    self.qname,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+                return []
+            self._errors = 0
+            return [self.codec.loads(data) for data in rsp]
+        loop = asyncio.get_running_loop()
+        receiving = loop.run_in_executor(
+            self._get_waiter(), partial(self.receive_many, max_items, max_wait)
+        )
+        # if the caller is cancelled, the tasks taken by the waiter thread
+        # are kept for :meth:`take_received`
+        self._receiving = receiving
+        batch = await asyncio.shield(receiving)
+        self._receiving = None
+        return batch
+
+    async def take_received(self) -> List[Dict[str, Any]]:
+        """
+        Tasks taken from the queue by a call of :meth:`areceive_many`
+        cancelled while it was waiting, they were not returned to anyone.
+        """
+        receiving, self._receiving = self._receiving, None
+        if receiving is None:
+            return []
+        try:
+            return await receiving
+        except Exception:
+            logger.exception("Receiving from queue %s failed", self.qname)
+            return []
+
+    async def ack(self, taskids: List[str]) -> bool:
+        """
+        Confirm tasks are executed, only needed by durable transports.
+
+        :return: False if the transport failed, the error is logged and the
+            tasks should be acked again later.
+        """
+        if isinstance(self.queue, IQueueTransport) and taskids:
+            try:
+                await self.queue.ack(taskids)
+            except Exception:
+                logger.exception("Acking tasks of queue %s failed", self.qname)
+                return False
+        return True
+
+    def _get_waiter(self) -> ThreadPoolExecutor:
+        if not self._waiter:
+            self._waiter = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"{WORKER_PREFIX}{self.qname}"
+            )
+        return self._waiter
+
+    def close(self):
+        if self._waiter:
+            self._waiter.shutdown(wait=False)
+            self._waiter = None
 
     async def submit(
         self,
@@ -181,24 +1338,180 @@ class TaskQueue:
         params: Dict[str, Any],
         timeout: int = 60,
         result_ttl: int = 900,
+        priority: str = Priority.default.value,
+        eta: Optional[datetime] = None,
+        countdown: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
+        dedupe: bool = False,
+        retry: Optional[RetryPolicy] = None,
         debug=False,
     ) -> Task:
+        """
+        Send a task to the workers.
+
+        :param priority: lane of the task, see :class:`Priority`. Workers take
+            tasks from every lane in the proportion of :data:`LANE_WEIGHTS`.
+        :param eta: run the task at this time, naive datetimes are taken as utc.
+        :param countdown: run the task after this many seconds, instead of `eta`.
+        :param idempotency_key: while a task with the same key is pending, or
+            done and its result not expired, that task is returned and
+            nothing is sent. Failed tasks run again. It needs a backend.
+        :param dedupe: use :func:`task_key` as `idempotency_key`.
+        :param retry: retry the task when it fails. Retries go back to the
+            queue with an eta, they don't take a worker slot while waiting.
+        """
+        if dedupe and idempotency_key is None:
+            idempotency_key = task_key(name, params)
+        if idempotency_key is not None and not self.backend:
+            raise BadConfigurationException("idempotency_key without backend")
+        if countdown is not None:
+            eta = datetime.utcnow() + timedelta(seconds=countdown)
+        elif eta is not None and eta.tzinfo is not None:
+            eta = eta.astimezone(timezone.utc).replace(tzinfo=None)
         task = Task(
             name=name,
             params=params,
             app_name=self._app_name,
             timeout=timeout,
             result_ttl=result_ttl,
+            priority=Priority(priority),
+            eta=eta,
+            idempotency_key=idempotency_key,
+            retry=retry,
         )
-        if self.backend:
+        if eta is not None:
+            task.state = TaskStatus.waiting.value
+        if idempotency_key is not None:
+            held = await self.backend.add_task_once(task)
+            if held.id != task.id:
+                logger.info("Task %s [%s] already sent", held.name, held.id)
+                return held
+        elif self.backend:
             await self.backend.add_task(task)
         if debug:
             _exec_task(self._app_name, task)
-        else:
-            self.send(task)
+            return task
+        try:
+            await self.asend(task)
+        except (QueueFull, BadConfigurationException):
+            if self.backend:
+                await self.backend.delete_task(task.id)
+            raise
 
         return task
 
+    async def submit_many(
+        self,
+        name: str,
+        params_iter: Iterable[Dict[str, Any]],
+        *,
+        chunk_size: int = 500,
+        timeout: int = 60,
+        result_ttl: int = 900,
+        priority: str = Priority.default.value,
+    ) -> TaskGroup:
+        """
+        Send a task for each params of `params_iter`, as a group. Each chunk
+        of `chunk_size` tasks is added to the backend in one insert and
+        sent to the queue in one batch.
+
+        :raises services.errors.web.QueueFull: if the queue is full, tasks of
+            previous chunks stay queued and the rest are removed.
+        """
+        group = TaskGroup(id=secure_random_str(), ids=[], backend=self.backend)
+        params_iter = iter(params_iter)
+        while True:
+            chunk = [
+                Task(
+                    name=name,
+                    params=params,
+                    app_name=self._app_name,
+                    timeout=timeout,
+                    result_ttl=result_ttl,
+                    priority=Priority(priority),
+                    group_id=group.id,
+                )
+                for params in islice(params_iter, chunk_size)
+            ]
+            if not chunk:
+                return group
+            if self.backend:
+                await self.backend.add_tasks(chunk)
+            try:
+                sent = await self.asend_many(chunk)
+            except BadConfigurationException:
+                await self._delete_unsent(chunk)
+                raise
+            group.ids.extend(t.id for t in chunk[:sent])
+            if sent < len(chunk):
+                await self._delete_unsent(chunk[sent:])
+                raise QueueFull()
+
+    async def _delete_unsent(self, tasks: List[Task]):
+        if self.backend:
+            for task in tasks:
+                await self.backend.delete_task(task.id)
+
+    async def submit_pipeline(
+        self,
+        steps: List[Step],
+        *,
+        result_ttl: int = 900,
+        priority: str = Priority.default.value,
+        eta: Optional[datetime] = None,
+        countdown: Optional[float] = None,
+    ) -> Task:
+        """
+        Send a pipeline of steps as a single task. One worker runs all the
+        steps: each one starts when the steps in its `after` finish, with
+        their results in its params, so results don't travel through the
+        queue or the backend. Independent branches run at the same time.
+        The result of the task is a dict with the result of each step.
+
+        .. code-block:: python
+
+            await tq.submit_pipeline(
+                [
+                    Step(key="users", name="fetch_users"),
+                    Step(key="orders", name="fetch_orders"),
+                    Step(key="report", name="report", after=["users", "orders"]),
+                ]
+            )
+
+        :raises ValueError: if the steps don't make a DAG.
+        """
+        order = pipeline_order(steps)
+        # the longest path of timeouts
+        finish: Dict[str, int] = {}
+        for step in order:
+            finish[step.key] = step.timeout + max(
+                (finish[k] for k in step.after), default=0
+            )
+        return await self.submit(
+            name=PIPELINE_TASK,
+            params={"steps": [s.dict() for s in order]},
+            timeout=max(finish.values()),
+            result_ttl=result_ttl,
+            priority=priority,
+            eta=eta,
+            countdown=countdown,
+        )
+
+    async def wait_result(
+        self, taskid: str, timeout: float = 30.0
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Wait for a task to finish and return its result, see
+        :meth:`IState.wait_finished`.
+
+        :raises asyncio.TimeoutError: if the task doesn't finish in time.
+        """
+        if not self.backend:
+            raise BadConfigurationException("wait_result without backend")
+        if not await self.backend.wait_finished(taskid, timeout):
+            raise asyncio.TimeoutError(f"task {taskid} not finished")
+        return await self.backend.get_result(taskid)
+
     @classmethod
     def setup(cls, app: Sanic, conf: QueueConfig):
         @app.after_server_start
@@ -206,16 +1519,67 @@ class TaskQueue:
             back = None
             if conf.backend:
                 back = await init_backend(conf.backend)
-            q = getattr(app.shared_ctx, f"{CTX_PREFIX}{conf.qname}")
-            tq = cls(q, conf=conf, backend=back)
+            if is_durable(conf.transport):
+                tq = cls(await init_transport(conf), conf=conf, backend=back)
+            else:
+                tq = cls(_get_queue_from_app(app, conf.qname), conf=conf, backend=back)
             setattr(app.ctx, f"{CTX_PREFIX}{conf.qname}", tq)
 
+        @app.before_server_stop
+        async def _close_taskqueue(app: Sanic):
+            tq = getattr(app.ctx, f"{CTX_PREFIX}{conf.qname}")
+            if tq.backend:
+                await tq.backend.close()
+            if tq.durable:
+                await tq.queue.close()
+
     @staticmethod
     def get_from_request(request, qname: str) -> "TaskQueue":
         q = getattr(request.app.ctx, f"{CTX_PREFIX}{qname}")
         return q
 
 
+class Timers:
+    """
+    Tasks waiting for their `eta`, kept in a min-heap, so pushing and popping
+    a task are O(log n) and many thousands of tasks can wait in a worker
+    without holding its slots.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int, Task]] = []
+        self._seq = count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @staticmethod
+    def is_due(task: Task, now: Optional[datetime] = None) -> bool:
+        return task.eta is None or task.eta <= (now or datetime.utcnow())
+
+    def push(self, task: Task):
+        heapq.heappush(self._heap, (task.eta, next(self._seq), task))
+
+    def pop_due(self, now: Optional[datetime] = None) -> List[Task]:
+        now = now or datetime.utcnow()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def drain(self) -> List[Task]:
+        """Remove all the tasks, in order of eta"""
+        tasks = [heapq.heappop(self._heap)[2] for _ in range(len(self._heap))]
+        return tasks
+
+    def next_in(self, now: Optional[datetime] = None) -> Optional[float]:
+        """Seconds until the next task is due, None if there are no tasks"""
+        if not self._heap:
+            return None
+        now = now or datetime.utcnow()
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+
 class Scheduler:
     STOP = "__STOP__"
     backend: Optional[IState] = None
@@ -228,17 +1592,44 @@ class Scheduler:
         timeout=60,
         max_jobs=5,
         backend: Optional[TasksBackend] = None,
+        idle_timeout: float = 1.0,
+        batch_size: int = 10,
+        executor: Optional[Executor] = None,
+        registry: TaskRegistry = registry,
+        clean_interval: float = 60.0,
+        wait_gauge=None,
+        metrics: Optional[MetricsPublisher] = None,
     ):
         self.queue = queue
         self._loop = loop
         self._base_package = base_package
         self.timeout = timeout
+        # how long to wait for a task before running the sentinel
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        # the backend is cleaned from the sentinel, at most once by interval
+        self.clean_interval = clean_interval
+        self._last_clean = 0.0
+        # sync functions run in the executor, None is the loop's default
+        self.executor = executor
+        self._in_process = isinstance(executor, ProcessPoolExecutor)
+        self.registry = registry
         # self.sem = asyncio.BoundedSemaphore(max_jobs)
-        self.sem = None
+        self.sem: Optional[asyncio.Semaphore] = None
+        # tasks waiting for their eta, they don't take a slot until due
+        self.timers = Timers()
+        self._timers_changed: Optional[asyncio.Event] = None
         self._max_jobs = max_jobs
         self.tasks: Dict[str, _Task] = {}
+        # finished tasks to be acked to durable transports
+        self._to_ack: List[str] = []
         self._backend = backend
         self.backend: Optional[IState] = None
+        # queue wait of the tasks, read by the autoscaler
+        self.wait_gauge = wait_gauge
+        self.metrics = metrics
+        # task of :meth:`run`, cancelled when shutting down
+        self._runner: Optional[asyncio.Task] = None
 
     async def add_task(self, task: Task):
         if self._backend:
@@ -257,47 +1648,174 @@ class Scheduler:
         if self.backend:
             logger.info("BACKEND SET RESULT")
             await self.backend.set_result(task.id, result=result, status=status)
+            result_waiters.notify(task.id)
 
     async def _delete_task(self, task: Task):
         if self.backend and task.state == TaskStatus.done.value:
             await self.backend.delete_task(task.id)
 
+    async def _run_sync(self, task: Task, taskdef: TaskDef):
+        if self._in_process:
+            return await self._run_in_pool(task)
+        kwargs = taskdef.get_kwargs(task)
+        return await self._loop.run_in_executor(
+            self.executor, partial(taskdef.fn, **kwargs)
+        )
+
+    async def _run_in_pool(self, task: Task):
+        # the function is resolved by the registry of the pool process
+        fut = self.executor.submit(_exec_task_in_child, self._base_package, task)
+        started = time.monotonic()
+        try:
+            return await asyncio.wrap_future(fut)
+        except asyncio.CancelledError:
+            # cancelled by the time limit, the pool process didn't interrupt it
+            overdue = task.timeout and time.monotonic() - started >= task.timeout
+            if overdue and not fut.done():
+                self._replace_pool(task)
+            raise
+
+    def _replace_pool(self, task: Task):
+        logger.error(
+            "Task %s [%s] stuck after its timeout, replacing the process pool",
+            task.name,
+            task.id,
+        )
+        if isinstance(self.executor, TaskPool):
+            self.executor = self.executor.replace()
+
+    def _call(self, task: Task) -> Awaitable:
+        taskdef = self.registry.get(self._base_package, task.name)
+        if taskdef.is_coroutine:
+            return taskdef.fn(**taskdef.get_kwargs(task))
+        return self._run_sync(task, taskdef)
+
+    async def run_pipeline(self, task: Task) -> Dict[str, Any]:
+        """
+        Each step starts as soon as the steps before it finish, and gets
+        their results from memory. All of them share the slot of the task.
+        If a step fails, the steps still running are cancelled.
+        """
+        results: Dict[str, Any] = {}
+        runs: Dict[str, asyncio.Task] = {}
+
+        async def run_step(step: Step):
+            if step.after:
+                await asyncio.gather(*[runs[k] for k in step.after])
+            step_task = _step_task(task, step, results)
+            try:
+                run = self._call(step_task)
+                results[step.key] = await asyncio.wait_for(
+                    run, self._time_limit(step_task)
+                )
+            except Exception as e:
+                raise RuntimeError(f"step {step.key} failed: {e!r}") from e
+
+        for step in pipeline_order([Step(**s) for s in task.params["steps"]]):
+            runs[step.key] = self._loop.create_task(run_step(step))
+        try:
+            await asyncio.gather(*runs.values())
+        finally:
+            for run in runs.values():
+                run.cancel()
+            await asyncio.gather(*runs.values(), return_exceptions=True)
+        return results
+
+    def _time_limit(self, task: Task) -> Optional[float]:
+        if not task.timeout:
+            return None
+        if self._in_process:
+            # let the pool process interrupt the task first
+            return task.timeout + CHILD_TIMEOUT_GRACE
+        return task.timeout
+
     async def exec_task(self, task: Task):
-        # ctx = get_context("fork")
-        # with concurrent.futures.ProcessPoolExecutor(mp_context=ctx) as pool:
+        """
+        Run a task up to `task.timeout` seconds. When the time is over,
+        coroutines are cancelled and the task is failed, so its slot is
+        released. Threads can't be stopped: the function keeps running in
+        the executor but the scheduler doesn't wait for it. Tasks in a
+        process pool are interrupted inside the pool process.
+        """
         logger.info("Executing task %s [%s]", task.name, task.id)
-        result = None
-        fn = _get_function(self._base_package, task)
-        kwargs = _get_kwargs(task, fn)
         status = TaskStatus.running.value
         result = None
+        error: Optional[BaseException] = None
+        started = time.monotonic()
         try:
             await self._update_status(task, status)
-            if inspect.iscoroutinefunction(fn):
-                result = await fn(**kwargs)
+            run: Awaitable[Any]
+            if task.name == PIPELINE_TASK:
+                run = self.run_pipeline(task)
             else:
-                result = await self._loop.run_in_executor(None, partial(fn, **kwargs))
+                run = self._call(task)
+            result = await asyncio.wait_for(run, self._time_limit(task))
             status = TaskStatus.done.value
-        except asyncio.exceptions.TimeoutError as e:
+        except (asyncio.TimeoutError, TimeoutError) as e:
             err = traceback.format_exc()
             logger.error("Task timeout error %s [%s]: %s", task.name, task.id, e)
             result = {"error": err}
             status = TaskStatus.failed.value
+            error = e
         except Exception as e:
             err = traceback.format_exc()
             logger.error("Task error %s [%s]: %s", task.name, task.id, e)
             result = {"error": err}
+            status = TaskStatus.failed.value
+            error = e
         finally:
-            logger.info("SETTING RESULT")
-            await self._set_result(task, result=result, status=status)
+            if task.retry and error and task.retry.should_retry(error, task.attempt):
+                status = TaskStatus.waiting.value
+                await self._retry(task, result)
+            else:
+                logger.info("SETTING RESULT")
+                await self._set_result(task, result=result, status=status)
+            if self.metrics:
+                self.metrics.metrics.finished(
+                    task.name, status, time.monotonic() - started
+                )
+                self.metrics.maybe_publish()
 
         return result
 
+    async def _retry(self, task: Task, result: Dict[str, Any]):
+        """
+        Send the task back to the queue to run after the backoff. The worker
+        receiving it keeps it in its timers, without taking a slot.
+        """
+        _next_attempt(task)
+        if self.backend:
+            await self.backend.set_retry(
+                task.id, attempt=task.attempt, result=result, eta=task.eta
+            )
+        try:
+            await self.queue.requeue(task)
+        except Exception as e:
+            if not isinstance(e, QueueFull):
+                logger.exception("Requeue of task %s failed", task.id)
+            # there is no room in the queue, or it failed: it waits here
+            self.timers.push(task)
+            if self._timers_changed:
+                self._timers_changed.set()
+
+    def _ack_later(self, task: Task):
+        # retries are still in the queue, released by requeue
+        if task.state != TaskStatus.waiting.value:
+            self._to_ack.append(task.id)
+
     def start_task(self, task: Task) -> asyncio.Task:
         _task = self._loop.create_task(self.exec_task(task))
         self.tasks[task.id] = _Task(task=task, future=_task)
+        if self.queue.durable:
+            _task.add_done_callback(lambda _: self._ack_later(task))
         return _task
 
+    async def _ack_done(self):
+        if self._to_ack:
+            taskids, self._to_ack = self._to_ack, []
+            if not await self.queue.ack(taskids):
+                self._to_ack = taskids + self._to_ack
+
     async def _sentinel(self):
         logger.debug("> Cleaning")
         to_delete = []
@@ -306,73 +1824,369 @@ class Scheduler:
                 to_delete.append(k)
         for x in to_delete:
             del self.tasks[x]
-        if self.backend:
-            await self.backend.clean()
+        if self.metrics:
+            self.metrics.maybe_publish()
+        now = time.monotonic()
+        if self.backend and now - self._last_clean >= self.clean_interval:
+            self._last_clean = now
+            try:
+                await self.backend.clean()
+            except Exception:
+                logger.exception("Cleaning the tasks backend failed")
 
     async def init_backend(self):
         if self._backend:
-            Cls: IState = get_class(self._backend.backend_class)
-            self.backend = await Cls.from_uri(self._backend.uri)
+            self.backend = await init_backend(self._backend)
+
+    async def close(self):
+        if self.backend:
+            await self.backend.close()
+        if self.queue.durable:
+            await self.queue.queue.close()
 
     async def run(self):
         logger.info("> Starting scheduler")
         await self.init_backend()
         print("BACKEND CONF: ", self._backend)
         print("BACKEND OBJ: ", self.backend)
-        sem = asyncio.Semaphore(self._max_jobs)
+        self._runner = asyncio.current_task()
+        self.sem = sem = asyncio.Semaphore(self._max_jobs)
+        self._timers_changed = asyncio.Event()
+        timers = self._loop.create_task(self._run_timers())
+        try:
+            await self._run(sem)
+        finally:
+            timers.cancel()
+            await asyncio.gather(timers, return_exceptions=True)
+
+    async def _run(self, sem: asyncio.Semaphore):
         while True:
-            async with sem:
-                task_dict = self.queue.receive(wait=False)
-                if not task_dict:
-                    await self._sentinel()
-                    await asyncio.sleep(0.8)
-                else:
-                    task = Task(**task_dict)
+            # tasks are not pulled while all the jobs are busy: it waits for
+            # a free slot and takes as many tasks as free slots. The slots are
+            # not held while waiting for the queue, so a due timer can start.
+            await sem.acquire()
+            slots = 1
+            while slots < self.batch_size and not sem.locked():
+                await sem.acquire()
+                slots += 1
+            for _ in range(slots):
+                sem.release()
+            await self._ack_done()
+            rsp = await self.queue.areceive_many(slots, self.idle_timeout)
+            if not rsp:
+                await self._sentinel()
+            batch = [Task(**task_dict) for task_dict in rsp]
+            for ix, task in enumerate(batch):
+                if not self.timers.is_due(task):
+                    self.timers.push(task)
+                    self._timers_changed.set()
+                    continue
+                try:
+                    # free unless a timer took it while receiving
                     await sem.acquire()
-                    _task = self.start_task(task)
-                    logger.info("task %s [%s] added", task.name, task.id)
-                    _task.add_done_callback(lambda _: sem.release())
+                except asyncio.CancelledError:
+                    # not started, they are requeued on shutdown
+                    for waiting in batch[ix:]:
+                        self.timers.push(waiting)
+                    raise
+                self._start_in_slot(task)
+
+    def _start_in_slot(self, task: Task):
+        record_wait(self.wait_gauge, task)
+        if self.metrics:
+            self.metrics.metrics.started(task.name, queue_wait(task))
+        _task = self.start_task(task)
+        logger.info("task %s [%s] added", task.name, task.id)
+        _task.add_done_callback(lambda _: self.sem.release())
+
+    async def _run_timers(self):
+        while True:
+            self._timers_changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self._timers_changed.wait(), self.timers.next_in()
+                )
+            except asyncio.TimeoutError:
+                pass
+            due = self.timers.pop_due()
+            for ix, task in enumerate(due):
+                try:
+                    await self.sem.acquire()
+                except asyncio.CancelledError:
+                    # not started, they are requeued on shutdown
+                    for waiting in due[ix:]:
+                        self.timers.push(waiting)
+                    raise
+                self._start_in_slot(task)
+
+    async def stop_receiving(self):
+        """
+        Cancel :meth:`run`, so no more tasks are taken from the queue.
+        Tasks received by a wait in progress go to the timers, to be
+        requeued with the others by :meth:`finish_pending_tasks`.
+        """
+        runner, self._runner = self._runner, None
+        if runner is not None and not runner.done():
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+        for task_dict in await self.queue.take_received():
+            self.timers.push(Task(**task_dict))
 
     def finish_pending_tasks(self):
+        """
+        Stop receiving, wait for the tasks already started and give back
+        the ones not started yet.
+        """
+        self._loop.run_until_complete(self.stop_receiving())
         if self.tasks:
             tasks = [t.future for t in self.tasks.values()]
             drain = asyncio.wait_for(asyncio.gather(*tasks), timeout=60)
             self._loop.run_until_complete(drain)
+        waiting = self.timers.drain()
+        self._loop.run_until_complete(requeue_waiting(self.queue, waiting))
+        self._loop.run_until_complete(self._ack_done())
+        self._loop.run_until_complete(self.close())
+
+
+async def requeue_waiting(tq: TaskQueue, tasks: List[Task]):
+    """
+    Give back the tasks waiting for their eta in a worker shutting down,
+    so another worker runs them when they are due.
+    """
+    for task in tasks:
+        try:
+            if tq.durable:
+                await tq.requeue(task)
+            else:
+                tq.send(task)
+        except (Full, QueueFull):
+            logger.error(
+                "Task %s [%s] lost on shutdown, the queue is full", task.name, task.id
+            )
 
 
-def cpu_worker(name, queue: Queue, conf: QueueConfig, max_jobs=1) -> None:
-    """based on https://amhopkins.com/background-job-worker"""
+def _next_attempt(task: Task):
+    """Move a failed task to its next attempt, after the backoff"""
+    delay = task.retry.delay(task.attempt)
+    task.attempt += 1
+    task.eta = datetime.utcnow() + timedelta(seconds=delay)
+    task.state = TaskStatus.waiting.value
+    task.updated_at = datetime.utcnow()
+    logger.warning(
+        "Task %s [%s] failed, attempt %s in %.2fs",
+        task.name,
+        task.id,
+        task.attempt,
+        delay,
+    )
+
+
+def _cpu_task_done(
+    task: Task,
+    slots: threading.Semaphore,
+    done: Deque[str],
+    requeue: Callable[[Task], None],
+    metrics: Optional[TaskMetrics],
+    started: float,
+    fut: Future,
+):
+    slots.release()
+    err = fut.exception()
+    status = TaskStatus.done.value
+    if err:
+        logger.error("Task error %s [%s]: %s", task.name, task.id, err)
+        status = TaskStatus.failed.value
+        if task.retry and task.retry.should_retry(err, task.attempt):
+            _next_attempt(task)
+            status = task.state
+            requeue(task)
+    if status != TaskStatus.waiting.value:
+        done.append(task.id)
+    if metrics:
+        metrics.finished(task.name, status, time.monotonic() - started)
+
+
+def cpu_worker(
+    name,
+    queue: Union[ILocalTransport, IQueueTransport],
+    conf: QueueConfig,
+    max_jobs=1,
+    wait_gauge=None,
+    metrics=None,
+) -> None:
+    """
+    based on https://amhopkins.com/background-job-worker
+    Tasks run in a pool of `max_jobs` processes.
+    """
     logging.config.dictConfig(LOGGING_CONFIG_DEFAULTS)
     pid = getpid()
-    logger.debug("max_jobs=%s unused variable", max_jobs)
     logger.info(">> CPU Bound worker reporting for duty: %s [%s]", name, pid)
+    loop = asyncio.new_event_loop()
+    if is_durable(conf.transport):
+        queue = loop.run_until_complete(init_transport(conf))
     tq = TaskQueue(queue, conf=conf)
+    preload_tasks(conf.preload)
+    pool = create_executor(conf.copy(update={"execution": "process"}), max_jobs)
+    slots = threading.Semaphore(max_jobs)
+    # finished tasks, appended from the pool threads
+    done: Deque[str] = deque()
+    timers = Timers()
+    publisher = None
+    if metrics is not None:
+        publisher = MetricsPublisher(metrics, name, conf.metrics_interval)
+    task_metrics = publisher.metrics if publisher else None
+    # retries to be requeued from the loop
+    retries: Deque[Task] = deque()
+
+    def requeue(task: Task):
+        # called from the threads of the pool
+        if not tq.durable:
+            try:
+                tq.send(task)
+                return
+            except Full:
+                pass
+        retries.append(task)
+
+    # deadlines of the running tasks, to kill the pool if one is stuck
+    deadlines: Dict[Future, Tuple[float, Task]] = {}
+
+    def submit(task: Task):
+        record_wait(wait_gauge, task)
+        if task_metrics:
+            task_metrics.started(task.name, queue_wait(task))
+        fut = pool.submit(_exec_task_in_child, conf.app_name, task)
+        if task.timeout:
+            deadline = time.monotonic() + task.timeout + CHILD_TIMEOUT_GRACE
+            deadlines[fut] = (deadline, task)
+        done_cb = partial(
+            _cpu_task_done, task, slots, done, requeue, task_metrics, time.monotonic()
+        )
+        fut.add_done_callback(lambda f: deadlines.pop(f, None))
+        fut.add_done_callback(done_cb)
+
+    def check_deadlines() -> Optional[float]:
+        """
+        Replace the pool if a task is stuck after its deadline, its slot is
+        released when its future fails.
+
+        :return: seconds until the next deadline, None if there is none
+        """
+        nonlocal pool
+        now = time.monotonic()
+        running = list(deadlines.values())
+        stuck = [task for deadline, task in running if deadline <= now]
+        if stuck:
+            for task in stuck:
+                logger.error(
+                    "Task %s [%s] stuck after its timeout, replacing the pool",
+                    task.name,
+                    task.id,
+                )
+            # all the futures of the old pool fail
+            deadlines.clear()
+            if isinstance(pool, TaskPool):
+                pool = pool.replace()
+            return None
+        if not running:
+            return None
+        return max(min(deadline for deadline, _ in running) - now, 0)
+
+    def acquire_slot():
+        while not slots.acquire(timeout=check_deadlines()):
+            pass
 
     try:
         while True:
-            task_dict = tq.receive()
-            task = Task(**task_dict)
-            _exec_task(conf.app_name, task)
+            if publisher:
+                publisher.maybe_publish()
+            while retries:
+                task = retries.popleft()
+                if tq.durable:
+                    try:
+                        loop.run_until_complete(tq.requeue(task))
+                        continue
+                    except Exception:
+                        logger.exception("Requeue of task %s failed", task.id)
+                # it waits in this worker
+                timers.push(task)
+            for task in timers.pop_due():
+                acquire_slot()
+                submit(task)
+            acquire_slot()
+            free = 1
+            while free < conf.batch_size and slots.acquire(blocking=False):
+                free += 1
+            # don't block on the queue beyond the next timer or deadline
+            wait = timers.next_in()
+            next_deadline = check_deadlines()
+            if next_deadline is not None:
+                wait = next_deadline if wait is None else min(wait, next_deadline)
+            if tq.durable:
+                acks = [done.popleft() for _ in range(len(done))]
+                if not loop.run_until_complete(tq.ack(acks)):
+                    done.extend(acks)
+                wait = 1.0 if wait is None else min(wait, 1.0)
+                batch = loop.run_until_complete(tq.areceive_many(free, wait))
+            else:
+                batch = tq.receive_many(free, wait)
+            for _ in range(free - len(batch)):
+                slots.release()
+            for task_dict in batch:
+                task = Task(**task_dict)
+                if not timers.is_due(task):
+                    timers.push(task)
+                    slots.release()
+                else:
+                    submit(task)
 
     except KeyboardInterrupt:
         logger.info("Shutting down %s", pid)
     finally:
+        pool.shutdown(wait=True)
+        # retries of the last tasks are added by the pool callbacks
+        waiting = timers.drain() + list(retries)
+        loop.run_until_complete(requeue_waiting(tq, waiting))
+        if tq.durable:
+            loop.run_until_complete(tq.ack(list(done)))
+            loop.run_until_complete(tq.queue.close())
+        if publisher:
+            publisher.retire()
         logger.info("Stopping CPU bound worker [%s]. Goodbye", pid)
 
 
-def io_worker(name: str, queue: Queue, conf: QueueConfig, max_jobs=5) -> None:
+def io_worker(
+    name: str,
+    queue: Union[ILocalTransport, IQueueTransport],
+    conf: QueueConfig,
+    max_jobs=5,
+    wait_gauge=None,
+    metrics=None,
+) -> None:
     """based on https://amhopkins.com/background-job-worker"""
     logging.config.dictConfig(LOGGING_CONFIG_DEFAULTS)
     pid = getpid()
     logger.info(">> IO Bound worker reporting for duty: %s [%s]", name, pid)
-    tq = TaskQueue(queue, conf=conf)
     loop = asyncio.new_event_loop()
+    if is_durable(conf.transport):
+        queue = loop.run_until_complete(init_transport(conf))
+    tq = TaskQueue(queue, conf=conf)
+    preload_tasks(conf.preload)
+    executor = create_executor(conf, max_jobs)
+    publisher = None
+    if metrics is not None:
+        publisher = MetricsPublisher(metrics, name, conf.metrics_interval)
     scheduler = Scheduler(
         tq,
         loop,
         base_package=conf.app_name,
         max_jobs=max_jobs,
         backend=conf.backend,
+        batch_size=conf.batch_size,
+        executor=executor,
+        clean_interval=conf.clean_interval,
+        wait_gauge=wait_gauge,
+        metrics=publisher,
     )
 
     try:
@@ -383,6 +2197,13 @@ def io_worker(name: str, queue: Queue, conf: QueueConfig, max_jobs=5) -> None:
         logger.info("Shutting down %s", pid)
     finally:
         scheduler.finish_pending_tasks()
+        # after the scheduler took back a wait in progress of its thread
+        tq.close()
+        if scheduler.executor:
+            # it could be replaced by the scheduler
+            scheduler.executor.shutdown(wait=False)
+        if publisher:
+            publisher.retire()
     logger.info("Stopping IO bound worker [%s]. Goodbye", pid)
 
 
@@ -414,6 +2235,7 @@ def standalone_cpu_worker(conf: QueueConfig, task: Task):
             loop.run_until_complete(
                 backend.set_result(task.id, result=result, status=status)
             )
+            loop.run_until_complete(backend.close())
 
         logger.info("Stopping CPU bound worker [%s]. Goodbye", pid)
 
@@ -438,12 +2260,68 @@ def standalone_io_worker(conf: QueueConfig, task: Task):
     logger.info("Stopping IO bound worker [%s]. Goodbye", pid)
 
 
-def _get_queue_from_app(app, qname) -> Union[Queue, None]:
-    try:
-        q = getattr(app.shared_ctx, f"{CTX_PREFIX}{qname}")
-    except AttributeError:
+def _share_queue(app, qname: str, queue: PriorityLanes):
+    """
+    Put the doorbell and the lanes of `queue` in `app.shared_ctx`, one by one
+    so Sanic knows they are multiprocessing objects.
+    """
+    setattr(app.shared_ctx, f"{CTX_PREFIX}{qname}", queue.doorbell)
+    for lane, q in queue.lanes.items():
+        setattr(app.shared_ctx, f"{CTX_PREFIX}{qname}_{lane}", q)
+
+
+def _get_queue_from_app(app, qname: str) -> Optional[PriorityLanes]:
+    """The lanes put in `app.shared_ctx` by :func:`_share_queue`"""
+    doorbell = getattr(app.shared_ctx, f"{CTX_PREFIX}{qname}", None)
+    if doorbell is None:
         return None
-    return q
+    lanes = {
+        lane: getattr(app.shared_ctx, f"{CTX_PREFIX}{qname}_{lane}")
+        for lane in LANE_WEIGHTS
+    }
+    return PriorityLanes(doorbell, lanes)
+
+
+def _get_wait_gauge(app, qname):
+    return getattr(app.shared_ctx, f"{CTX_PREFIX}{qname}_wait", None)
+
+
+def _get_metrics(app, qname):
+    return getattr(app.shared_ctx, f"{CTX_PREFIX}{qname}_metrics", None)
+
+
+def worker_kwargs(app: Sanic, conf: QueueConfig, name: str, jobs: int):
+    """kwargs of a queue worker process managed by Sanic"""
+    kwargs = {
+        "name": name,
+        "queue": _get_queue_from_app(app, qname=conf.qname),
+        "conf": conf,
+        "max_jobs": jobs,
+    }
+    gauge = _get_wait_gauge(app, conf.qname)
+    if gauge is not None:
+        kwargs["wait_gauge"] = gauge
+    metrics = _get_metrics(app, conf.qname)
+    if metrics is not None:
+        kwargs["metrics"] = metrics
+    return kwargs
+
+
+def _serve_backend(app: Sanic, conf: TasksBackend):
+    # many queues could share the same backend
+    if not hasattr(app.ctx, "tasks_state_servers"):
+        app.ctx.tasks_state_servers = {}
+    if conf.uri not in app.ctx.tasks_state_servers:
+        Cls: Type[IState] = get_class(conf.backend_class)
+        extra = conf.dict(exclude={"uri", "backend_class"})
+        app.ctx.tasks_state_servers[conf.uri] = Cls.serve(conf.uri, extra)
+
+
+def _shutdown_backend(app: Sanic, conf: TasksBackend):
+    servers = getattr(app.ctx, "tasks_state_servers", {})
+    server = servers.pop(conf.uri, None)
+    if server is not None:
+        server.shutdown()
 
 
 def create(
@@ -455,29 +2333,95 @@ def create(
 ) -> None:
     @app.main_process_start
     async def start(app: Sanic):
-        manager = Manager()
+        if conf.backend:
+            _serve_backend(app, conf.backend)
+        if conf.metrics_url:
+            # workers publish their metrics to a dict in a manager process
+            if not hasattr(app.ctx, "tasks_metrics_managers"):
+                app.ctx.tasks_metrics_managers = {}
+            manager = Manager()
+            app.ctx.tasks_metrics_managers[conf.qname] = manager
+            setattr(app.shared_ctx, f"{CTX_PREFIX}{conf.qname}_metrics", manager.dict())
+        if is_durable(conf.transport):
+            # each process opens its own connection to the transport
+            return
         if not _get_queue_from_app(app, conf.qname):
-            q = manager.Queue()
-            setattr(app.shared_ctx, f"{CTX_PREFIX}{conf.qname}", q)
+            q = create_lanes(conf.transport, conf.max_depth or 0)
+            _share_queue(app, conf.qname, q)
         # app.shared_ctx.queue = manager.Queue()
 
+    @app.main_process_stop
+    async def stop(app: Sanic):
+        if conf.backend:
+            _shutdown_backend(app, conf.backend)
+        managers = getattr(app.ctx, "tasks_metrics_managers", {})
+        if conf.qname in managers:
+            managers.pop(conf.qname).shutdown()
+
+    if conf.metrics_url:
+
+        async def tasks_metrics(request):
+            return await metrics_response(request, conf.qname)
+
+        app.add_route(
+            tasks_metrics, conf.metrics_url, name=f"tasks_metrics_{conf.qname}"
+        )
+
     @app.main_process_ready
     async def ready(app: Sanic):
-        q = _get_queue_from_app(app, qname=conf.qname)
         for ix in range(0, max_jobs):
             _name = f"{WORKER_PREFIX}{conf.qname}-{ix}"
             app.manager.manage(
-                _name,
-                wk,
-                {
-                    "name": _name,
-                    "queue": q,
-                    "conf": conf,
-                    "max_jobs": jobs_per_worker,
-                },
+                _name, wk, worker_kwargs(app, conf, _name, jobs_per_worker)
             )
 
 
 def get_queue(request, qname="default") -> TaskQueue:
     q = getattr(request.app.ctx, f"{CTX_PREFIX}{qname}")
     return q
+
+
+async def metrics_response(request, qname="default") -> HTTPResponse:
+    """
+    Metrics of the workers of a queue, see :func:`services.metrics.merge`.
+    With ``?format=prometheus`` they are in the text format of prometheus.
+    Served at `metrics_url` of :class:`QueueConfig` by :func:`create`.
+    """
+    shared = _get_metrics(request.app, qname)
+    if shared is None:
+        raise BadConfigurationException("metrics_response without metrics_url")
+    # a copy of the dict, in one round trip to the manager
+    merged = merge_metrics(dict(shared).values())
+    if request.args.get("format") == "prometheus":
+        return text_response(
+            to_prometheus(merged, qname), content_type=PROMETHEUS_CONTENT_TYPE
+        )
+    return json_response(merged)
+
+
+async def result_response(
+    request, taskid: str, qname="default", timeout: float = 30.0
+) -> HTTPResponse:
+    """
+    Long poll for the result of a task, to be returned from a handler.
+    It answers as soon as the task finishes with a 200, or with a 202 if
+    it is still pending after `timeout` seconds, so the client can ask again.
+
+    .. code-block:: python
+
+        @bp.get("/tasks/<taskid:str>")
+        async def task_result(request, taskid: str):
+            return await result_response(request, taskid, timeout=20)
+    """
+    q = get_queue(request, qname)
+    if not q.backend:
+        raise BadConfigurationException("result_response without backend")
+    finished = await q.backend.wait_finished(taskid, timeout)
+    task = await q.backend.get_task(taskid)
+    if task is None:
+        return json_response({"msg": f"task {taskid} not found"}, 404)
+    rsp: Dict[str, Any] = {"id": task.id, "state": task.state, "result": None}
+    if not finished:
+        return json_response(rsp, 202)
+    rsp["result"] = await q.backend.get_result(taskid)
+    return json_response(rsp, 200)
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import signal
+import time
+from typing import Dict
+
+from pydantic import BaseModel
+
+
+class Numbers(BaseModel):
+    a: int
+    b: int = 0
+
+
+class Totals(BaseModel):
+    left: Dict[str, int]
+    right: Dict[str, int]
+
+
+class Wait(BaseModel):
+    seconds: float = 0.1
+
+
+def add(n: Numbers):
+    return {"total": n.a + n.b}
+
+
+async def async_add(n: Numbers):
+    await asyncio.sleep(0)
+    return {"total": n.a + n.b}
+
+
+def merge(t: Totals):
+    return {"total": t.left["total"] + t.right["total"]}
+
+
+def sleep(w: Wait):
+    time.sleep(w.seconds)
+    return {"slept": w.seconds}
+
+
+def stuck(w: Wait):
+    # like a long C call, the alarm of the timeout is not seen
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+    time.sleep(w.seconds)
+    return {"slept": w.seconds}
+
+
+async def async_sleep(w: Wait):
+    await asyncio.sleep(w.seconds)
+    return {"slept": w.seconds}
+
+
+def fail():
+    raise ValueError("failing on purpose")
+
+
+def pid():
+    return {"pid": os.getpid()}
@@ -0,0 +1,111 @@
+import time
+from multiprocessing import Value, get_context
+from types import SimpleNamespace
+
+import pytest
+from pydantic import ValidationError
+
+from services.autoscale import AutoscaleConfig, Autoscaler, WorkerPool
+from services.workers import (
+    QueueConfig,
+    Task,
+    _share_queue,
+    create_lanes,
+    io_worker,
+    record_wait,
+    worker_kwargs,
+)
+
+conf = QueueConfig(app_name="tests", qname="testing")
+
+
+def test_autoscale_config_invalid():
+    with pytest.raises(ValidationError):
+        AutoscaleConfig(min_workers=3, max_workers=2)
+    with pytest.raises(ValidationError):
+        AutoscaleConfig(target_depth=0)
+
+
+def test_autoscale_step():
+    scaler = Autoscaler(
+        AutoscaleConfig(
+            min_workers=1,
+            max_workers=4,
+            target_depth=10,
+            up_cooldown=10,
+            down_cooldown=60,
+        ),
+        current=1,
+    )
+    # up at once, bounded by max_workers
+    assert scaler.step(depth=25, wait=0, now=0) == 3
+    assert scaler.step(depth=100, wait=0, now=5) == 3
+    assert scaler.step(depth=100, wait=0, now=10) == 4
+    # down one at a time, after the cooldown
+    assert scaler.step(depth=0, wait=0, now=30) == 4
+    assert scaler.step(depth=0, wait=0, now=70) == 3
+    assert scaler.step(depth=0, wait=0, now=100) == 3
+    assert scaler.step(depth=0, wait=0, now=130) == 2
+
+
+def test_autoscale_step_wait():
+    scaler = Autoscaler(
+        AutoscaleConfig(target_depth=10, target_wait=1.0, up_cooldown=0), current=1
+    )
+    assert scaler.step(depth=2, wait=3.0, now=0) == 2
+    assert scaler.step(depth=2, wait=3.0, now=1) == 3
+    # a stale wait of an empty queue doesn't count
+    assert scaler.desired(depth=0, wait=3.0) == 1
+
+
+def test_autoscale_record_wait():
+    gauge = Value("d", 0.0)
+    task = Task(name="add")
+    task.created_at = task.created_at.replace(year=task.created_at.year - 1)
+    record_wait(gauge, task, weight=1.0)
+    assert gauge.value > 3600
+    record_wait(None, task)
+
+
+def _alive(pool: WorkerPool):
+    return [
+        p.is_alive()
+        for ident in pool.idents
+        for p in pool.manager.durable[ident].processes
+    ]
+
+
+def test_autoscale_worker_pool():
+    metrics = {}
+    app = SimpleNamespace(
+        shared_ctx=SimpleNamespace(
+            queue_testing_wait=Value("d"), queue_testing_metrics=metrics
+        ),
+        manager=SimpleNamespace(
+            durable={}, context=get_context("fork"), worker_state={}
+        ),
+    )
+    _share_queue(app, conf.qname, create_lanes("process"))
+    pool = WorkerPool(app, conf, io_worker, jobs_per_worker=1)
+    assert "wait_gauge" in worker_kwargs(app, conf, "Queue-testing-0", 1)
+    try:
+        pool.resize(2)
+        assert pool.idents == ["Queue-testing-0", "Queue-testing-1"]
+        assert all(_alive(pool))
+        # let the workers start before the signal
+        time.sleep(1)
+        pool.resize(1)
+        assert pool.idents == ["Queue-testing-0"]
+        retired = pool._retiring[0]
+        for p in retired.processes:
+            p._current_process.join(10)
+        # as if it was killed before removing its metrics
+        metrics.update({"Queue-testing-0": {}, "Queue-testing-1": {}})
+        pool.reap()
+        assert pool._retiring == []
+        assert list(metrics) == ["Queue-testing-0"]
+    finally:
+        for ident in pool.idents:
+            for p in app.manager.durable[ident].processes:
+                p.terminate()
+                p._current_process.join(10)
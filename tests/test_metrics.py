@@ -0,0 +1,86 @@
+import asyncio
+import json
+from queue import Queue
+from types import SimpleNamespace
+
+import pytest
+
+from services.metrics import (
+    Histogram,
+    MetricsPublisher,
+    TaskMetrics,
+    merge,
+    to_prometheus,
+)
+from services.workers import QueueConfig, Scheduler, TaskQueue, metrics_response
+
+conf = QueueConfig(app_name="tests", qname="testing")
+
+
+def test_metrics_histogram():
+    h = Histogram()
+    assert h.quantile(0.5) is None
+    for value in (0.001, 0.02, 0.02, 0.3, 400):
+        h.observe(value)
+    assert h.count == 5
+    assert h.quantile(0.5) == 0.025
+    assert h.quantile(0.8) == 0.5
+    # beyond the last bound
+    assert h.quantile(1) == 300.0
+
+
+def test_metrics_merge():
+    first, second = TaskMetrics(), TaskMetrics()
+    first.started("add", 0.01)
+    first.finished("add", "DONE", 0.2)
+    second.finished("add", "FAILED", 2)
+    second.finished("fail", "FAILED", 0.001)
+    merged = merge([first.snapshot(), second.snapshot()])
+    assert merged["workers"] == 2
+    add = merged["tasks"]["add"]
+    assert add["finished"] == {"DONE": 1, "FAILED": 1}
+    assert add["fail_rate"] == 0.5
+    assert add["wait_p50"] == 0.01
+    assert add["run"]["count"] == 2
+    # it goes as json to the clients
+    json.dumps(merged)
+
+    text = to_prometheus(merged, "default")
+    assert 'tasks_finished_total{queue="default",task="add",state="DONE"} 1' in text
+    assert 'tasks_run_seconds_bucket{queue="default",task="add",le="+Inf"} 2' in text
+    assert 'tasks_workers{queue="default"} 2' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_scheduler():
+    shared = {}
+    publisher = MetricsPublisher(shared, "Queue-testing-0", interval=0)
+    tq = TaskQueue(Queue(), conf=conf)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", metrics=publisher)
+    runner = loop.create_task(scheduler.run())
+    await tq.submit(name="add", params={"a": 1})
+    await tq.submit(name="fail", params={})
+    while len(shared.get("Queue-testing-0", {}).get("tasks", {})) < 2:
+        await asyncio.sleep(0.01)
+    runner.cancel()
+    tq.close()
+    other = MetricsPublisher(shared, "Queue-testing-1", interval=0)
+    other.maybe_publish()
+    # a retired worker is not counted anymore
+    other.retire()
+    assert list(shared) == ["Queue-testing-0"]
+
+    request = SimpleNamespace(
+        app=SimpleNamespace(shared_ctx=SimpleNamespace(queue_testing_metrics=shared)),
+        args={},
+    )
+    rsp = await metrics_response(request, "testing")
+    stats = json.loads(rsp.body)
+    assert stats["tasks"]["add"]["finished"] == {"DONE": 1}
+    assert stats["tasks"]["fail"]["fail_rate"] == 1.0
+
+    request.args = {"format": "prometheus"}
+    rsp = await metrics_response(request, "testing")
+    assert rsp.content_type.startswith("text/plain")
+    assert b'task="fail",state="FAILED"} 1' in rsp.body
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from queue import Queue
+
+import pytest
+from pydantic import ValidationError
+
+from services.ext.memory.workers import MemoryBackend, MemoryState
+from services.periodic import CronExpr, PeriodicScheduler, PeriodicTask
+from services.workers import QueueConfig, TaskQueue
+
+conf = QueueConfig(app_name="tests", qname="testing")
+
+
+@pytest.mark.parametrize(
+    "expr,after,expected",
+    [
+        ("*/15 * * * *", datetime(2023, 1, 1, 10, 7), datetime(2023, 1, 1, 10, 15)),
+        ("0 6 * * *", datetime(2023, 1, 1, 6, 0), datetime(2023, 1, 2, 6, 0)),
+        ("30 9 * * 1-5", datetime(2023, 1, 6, 10), datetime(2023, 1, 9, 9, 30)),
+        ("0 0 1 */3 *", datetime(2023, 2, 10), datetime(2023, 4, 1)),
+        ("0 0 29 2 *", datetime(2023, 3, 1), datetime(2024, 2, 29)),
+        # day or weekday: the 13th or any friday
+        ("0 0 13 * 5", datetime(2023, 1, 1), datetime(2023, 1, 6)),
+        ("0 12 * * 7", datetime(2023, 1, 1, 13), datetime(2023, 1, 8, 12)),
+    ],
+)
+def test_periodic_cron(expr, after, expected):
+    assert CronExpr(expr).next_after(after) == expected
+
+
+def test_periodic_task_invalid():
+    with pytest.raises(ValidationError):
+        PeriodicTask(name="add")
+    with pytest.raises(ValidationError):
+        PeriodicTask(name="add", every=1, cron="* * * * *")
+    with pytest.raises(ValidationError):
+        PeriodicTask(name="add", cron="61 * * * *")
+
+
+@pytest.mark.asyncio
+async def test_periodic_scheduler_tick():
+    tq = TaskQueue(Queue(), conf=conf)
+    scheduler = PeriodicScheduler(
+        tq, [PeriodicTask(name="add", params={"a": 1}, every=10)]
+    )
+    now = datetime.utcnow()
+    await scheduler.elect(now)
+    assert await scheduler.tick(now + timedelta(seconds=9)) == []
+    assert len(await scheduler.tick(now + timedelta(seconds=10))) == 1
+    # runs lost while blocked are skipped
+    assert len(await scheduler.tick(now + timedelta(seconds=45))) == 1
+    assert scheduler.next_in(now + timedelta(seconds=45)) == 10
+    assert tq.receive(wait=False)["params"] == {"a": 1}
+
+
+@pytest.mark.asyncio
+async def test_periodic_scheduler_leader():
+    backend = MemoryBackend(MemoryState())
+    tasks = [PeriodicTask(name="add", every=1)]
+    first = PeriodicScheduler(TaskQueue(Queue(), conf=conf), tasks, backend=backend)
+    second = PeriodicScheduler(TaskQueue(Queue(), conf=conf), tasks, backend=backend)
+    now = datetime.utcnow()
+    assert await first.elect(now)
+    assert not await second.elect(now)
+    assert await first.elect(now)
+
+    await backend.release_lock(first.lock_name, first.owner)
+    assert await second.elect(now)
+
+
+class _FailingBackend(MemoryBackend):
+    async def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        raise ConnectionError("database is gone")
+
+    async def add_task(self, task):
+        raise ConnectionError("database is gone")
+
+
+@pytest.mark.asyncio
+async def test_periodic_scheduler_errors():
+    tq = TaskQueue(Queue(maxsize=1), conf=conf)
+    tasks = [PeriodicTask(name="add", every=10), PeriodicTask(name="fail", every=10)]
+    scheduler = PeriodicScheduler(tq, tasks)
+    now = datetime.utcnow()
+    await scheduler.elect(now)
+    # the full queue rejects the second run, the scheduler goes on
+    assert len(await scheduler.tick(now + timedelta(seconds=10))) == 1
+    assert scheduler.is_leader
+    assert scheduler.next_in(now + timedelta(seconds=10)) == 10
+
+    backend = _FailingBackend(MemoryState())
+    failing = PeriodicScheduler(tq, tasks, backend=backend)
+    failing.is_leader = True
+    assert not await failing.elect(now)
+    # a backend error while sending drops the leadership
+    failing = PeriodicScheduler(TaskQueue(Queue(), conf=conf, backend=backend), tasks)
+    await failing.elect(now)
+    assert await failing.tick(now + timedelta(seconds=10)) == []
+    assert not failing.is_leader
@@ -0,0 +1,572 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from queue import Full, Queue
+from types import SimpleNamespace
+
+import pytest
+
+from services.errors import BadConfigurationException
+from services.errors.web import QueueFull
+from services.ext.memory.workers import MemoryBackend, MemoryState
+from services.workers import (
+    LANE_WEIGHTS,
+    Priority,
+    PriorityLanes,
+    QueueConfig,
+    RetryPolicy,
+    Scheduler,
+    Step,
+    Task,
+    TaskQueue,
+    TaskRegistry,
+    TaskStatus,
+    Timers,
+    _exec_task,
+    _exec_task_in_child,
+    _get_queue_from_app,
+    _share_queue,
+    chain,
+    create_executor,
+    create_lanes,
+    create_queue,
+    task_key,
+)
+from tests import tasks
+
+conf = QueueConfig(app_name="tests", qname="testing")
+
+
+def test_workers_task_defaults():
+    t1 = Task(name="add")
+    t2 = Task(name="add")
+    assert t1.id != t2.id
+    assert t1.state == TaskStatus.created.value
+
+
+def test_workers_receive_timeout():
+    tq = TaskQueue(Queue(), conf=conf)
+    started = time.monotonic()
+    rsp = tq.receive(wait=True, timeout=0.05)
+    assert rsp == {}
+    assert time.monotonic() - started >= 0.05
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_wakeup():
+    tq = TaskQueue(Queue(), conf=conf)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", idle_timeout=0.5)
+    runner = loop.create_task(scheduler.run())
+    await asyncio.sleep(0.05)
+
+    task = Task(name="async_add", params={"a": 1, "b": 2})
+    sent_at = time.monotonic()
+    tq.send(task)
+    while task.id not in scheduler.tasks:
+        await asyncio.sleep(0.001)
+    rsp = await scheduler.tasks[task.id].future
+    elapsed = time.monotonic() - sent_at
+
+    runner.cancel()
+    tq.close()
+    assert rsp == {"total": 3}
+    # it shouldn't wait for the idle timeout to pick the task
+    assert elapsed < 1
+
+
+def test_workers_receive_many():
+    tq = TaskQueue(Queue(), conf=conf)
+    for x in range(5):
+        tq.send(Task(name="add", params={"a": x}))
+
+    first = tq.receive_many(3, max_wait=0)
+    rest = tq.receive_many(10, max_wait=0)
+    empty = tq.receive_many(10, max_wait=0.01)
+    assert [t["params"]["a"] for t in first] == [0, 1, 2]
+    assert len(rest) == 2
+    assert empty == []
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_batch():
+    tq = TaskQueue(Queue(), conf=conf)
+    loop = asyncio.get_running_loop()
+    # the sentinel doesn't clean the finished tasks while the test runs
+    scheduler = Scheduler(
+        tq, loop, base_package="tests", max_jobs=2, idle_timeout=2, batch_size=10
+    )
+    for _ in range(4):
+        tq.send(Task(name="sleep", params={"seconds": 0.1}))
+    runner = loop.create_task(scheduler.run())
+    await asyncio.sleep(0.05)
+    # only as many tasks as free jobs are taken from the queue
+    running = [t for t in scheduler.tasks.values() if not t.future.done()]
+    assert len(running) == 2
+    assert tq.queue.qsize() == 2
+
+    # tasks could be on their way from the waiter thread, the queue is empty
+    while len(scheduler.tasks) < 4 or not all(
+        t.future.done() for t in scheduler.tasks.values()
+    ):
+        await asyncio.sleep(0.01)
+    runner.cancel()
+    tq.close()
+    assert len(scheduler.tasks) == 4
+
+
+@pytest.mark.parametrize("transport", ["process", "manager"])
+def test_workers_create_queue(transport):
+    tq = TaskQueue(create_queue(transport), conf=conf)
+    tq.send(Task(name="add", params={"a": 1}))
+    rsp = tq.receive(wait=True, timeout=1)
+    assert rsp["params"] == {"a": 1}
+
+
+def test_workers_shared_lanes():
+    app = SimpleNamespace(shared_ctx=SimpleNamespace())
+    assert _get_queue_from_app(app, conf.qname) is None
+    _share_queue(app, conf.qname, create_lanes("process"))
+    # each attribute is a multiprocessing object, as Sanic expects
+    assert not [
+        v
+        for v in vars(app.shared_ctx).values()
+        if not type(v).__module__.startswith("multiprocessing")
+    ]
+    tq = TaskQueue(_get_queue_from_app(app, conf.qname), conf=conf)
+    tq.send(Task(name="add", params={"a": 1}, priority="low"))
+    assert tq.receive(wait=True, timeout=1)["params"] == {"a": 1}
+
+
+@pytest.mark.parametrize("transport", ["process", "manager"])
+def test_workers_priority_lanes(transport):
+    tq = TaskQueue(create_lanes(transport), conf=conf)
+    for x in range(10):
+        tq.send(Task(name="add", params={"a": x}, priority="low"))
+    for x in range(20):
+        tq.send(Task(name="add", params={"a": x}))
+    tq.send(Task(name="add", priority="high"))
+    # let the queues flush the tasks to their pipes
+    time.sleep(0.05)
+
+    batch = tq.receive_many(10, max_wait=1)
+    lanes = [t["priority"] for t in batch]
+    # high goes first, then lanes are drained by weight and low is not starved
+    assert lanes[0] == "high"
+    assert lanes.count("low") == 1
+    rest = tq.receive_many(100, max_wait=0)
+    assert len(batch) + len(rest) == 31
+    assert tq.receive(wait=False) == {}
+
+
+def test_workers_create_queue_invalid():
+    with pytest.raises(BadConfigurationException):
+        create_queue("carrier-pigeon")
+
+
+def test_workers_pickle_codec():
+    _conf = QueueConfig(
+        app_name="tests", qname="testing", codec_class="services.workers.PickleCodec"
+    )
+    tq = TaskQueue(Queue(), conf=_conf)
+    when = datetime(2023, 1, 2, 3, 4, 5)
+    task = Task(name="add", params={"blob": b"\x00\xff", "when": when})
+    tq.send(task)
+    rsp = tq.receive(wait=False)
+    assert rsp["params"] == {"blob": b"\x00\xff", "when": when}
+    assert rsp["created_at"] == task.created_at
+    assert Task(**rsp) == task
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_process_pool():
+    _conf = QueueConfig(app_name="tests", execution="process")
+    tq = TaskQueue(Queue(), conf=_conf)
+    loop = asyncio.get_running_loop()
+    executor = create_executor(_conf, max_workers=2)
+    scheduler = Scheduler(tq, loop, base_package="tests", executor=executor)
+    try:
+        rsp = await scheduler.exec_task(Task(name="pid"))
+        added = await scheduler.exec_task(Task(name="add", params={"a": 2, "b": 2}))
+    finally:
+        executor.shutdown()
+    assert rsp["pid"] != os.getpid()
+    assert added == {"total": 4}
+    assert create_executor(conf, max_workers=2) is None
+
+
+def test_workers_registry():
+    reg = TaskRegistry()
+    total = reg.preload(["tests.tasks"])
+    assert total >= 4
+    assert "tests.tasks.add" in reg
+
+    taskdef = reg.get("tests", "add")
+    assert taskdef is reg.get("tests", "tests.tasks.add")
+    assert taskdef.params_key == "n"
+    assert taskdef.get_kwargs(Task(name="add", params={"a": 1})) == {
+        "n": tasks.Numbers(a=1)
+    }
+    assert reg.get("tests", "async_add").is_coroutine
+    assert reg.get("tests", "fail").params_key is None
+
+
+def test_workers_timers():
+    timers = Timers()
+    now = datetime.utcnow()
+    for x in (3, 1, 2):
+        timers.push(Task(name="add", params={"a": x}, eta=now + timedelta(seconds=x)))
+    assert timers.next_in(now) == 1
+    due = timers.pop_due(now + timedelta(seconds=2))
+    assert [t.params["a"] for t in due] == [1, 2]
+    assert len(timers) == 1
+    assert Timers.is_due(Task(name="add"))
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_countdown():
+    tq = TaskQueue(Queue(), conf=conf)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", max_jobs=1)
+    runner = loop.create_task(scheduler.run())
+    delayed = await tq.submit(name="async_add", params={"a": 1}, countdown=0.2)
+    now = await tq.submit(name="async_add", params={"a": 2})
+    assert delayed.state == TaskStatus.waiting.value
+
+    # the delayed task doesn't hold the only slot of the scheduler
+    while now.id not in scheduler.tasks:
+        await asyncio.sleep(0.01)
+    assert delayed.id not in scheduler.tasks
+    assert len(scheduler.timers) == 1
+    while delayed.id not in scheduler.tasks:
+        await asyncio.sleep(0.01)
+    assert datetime.utcnow() >= delayed.eta
+    runner.cancel()
+    tq.close()
+
+
+def test_workers_scheduler_shutdown_timers():
+    loop = asyncio.new_event_loop()
+    tq = TaskQueue(Queue(), conf=conf)
+    scheduler = Scheduler(tq, loop, base_package="tests")
+    later = Task(name="add", eta=datetime.utcnow() + timedelta(seconds=60))
+    scheduler.timers.push(later)
+    scheduler.finish_pending_tasks()
+    loop.close()
+    # it goes back to the queue for the other workers
+    assert len(scheduler.timers) == 0
+    assert tq.receive(timeout=1)["id"] == later.id
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_timer_slot():
+    tq = TaskQueue(Queue(), conf=conf)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", max_jobs=1, idle_timeout=2)
+    runner = loop.create_task(scheduler.run())
+    await asyncio.sleep(0.05)
+    # the only slot is free while the scheduler waits for the queue
+    due = Task(name="async_add", params={"a": 1, "b": 2})
+    due.eta = datetime.utcnow() + timedelta(seconds=0.1)
+    scheduler.timers.push(due)
+    scheduler._timers_changed.set()
+    await asyncio.sleep(0.5)
+    assert due.id in scheduler.tasks
+    runner.cancel()
+    tq.close()
+
+
+def test_workers_scheduler_shutdown_receiving():
+    loop = asyncio.new_event_loop()
+    tq = TaskQueue(Queue(), conf=conf)
+    scheduler = Scheduler(tq, loop, base_package="tests", max_jobs=2)
+    loop.create_task(scheduler.run())
+    slow = Task(name="sleep", params={"seconds": 0.3})
+    tq.send(slow)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    # a producer keeps sending while the worker drains its running task
+    sent = [Task(name="add", params={"a": x}) for x in range(4)]
+
+    def send_later():
+        time.sleep(0.05)
+        for task in sent:
+            tq.send(task)
+
+    producer = threading.Thread(target=send_later)
+    producer.start()
+    scheduler.finish_pending_tasks()
+    producer.join()
+    tq.close()
+    loop.close()
+    # only the slow task was run, the others are still in the queue
+    assert list(scheduler.tasks) == [slow.id]
+    assert scheduler.tasks[slow.id].future.done()
+    left = tq.receive_many(10, max_wait=1)
+    assert {t["id"] for t in left} == {t.id for t in sent}
+
+
+@pytest.mark.asyncio
+async def test_workers_wait_result():
+    backend = MemoryBackend(MemoryState())
+    tq = TaskQueue(Queue(), conf=conf, backend=backend)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests")
+    scheduler.backend = backend
+    runner = loop.create_task(scheduler.run())
+
+    task = await tq.submit(name="async_add", params={"a": 1, "b": 2})
+    rsp = await tq.wait_result(task.id, timeout=2)
+    slow = await tq.submit(name="sleep", params={"seconds": 0.3})
+    with pytest.raises(asyncio.TimeoutError):
+        await tq.wait_result(slow.id, timeout=0.05)
+    runner.cancel()
+    tq.close()
+    assert rsp == {"total": 3}
+
+
+def test_workers_retry_policy():
+    policy = RetryPolicy(backoff=2, backoff_max=5, jitter=False)
+    assert [policy.delay(n) for n in (1, 2, 3)] == [2, 4, 5]
+    assert 0 <= RetryPolicy(backoff=2).delay(3) <= 8
+    assert policy.should_retry(ValueError(), attempt=2)
+    assert not policy.should_retry(ValueError(), attempt=3)
+    policy = RetryPolicy(retry_on=["builtins.KeyError"])
+    assert not policy.should_retry(ValueError(), attempt=1)
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_retry():
+    backend = MemoryBackend(MemoryState())
+    tq = TaskQueue(Queue(), conf=conf, backend=backend)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", max_jobs=1)
+    scheduler.backend = backend
+    runner = loop.create_task(scheduler.run())
+    policy = RetryPolicy(max_attempts=2, backoff=0.2, jitter=False)
+    task = await tq.submit(name="fail", params={}, retry=policy)
+    while not scheduler.timers:
+        await asyncio.sleep(0.01)
+    # waiting for the backoff without a slot
+    stored = await backend.get_task(task.id)
+    assert (stored.state, stored.attempt) == (TaskStatus.waiting.value, 2)
+    await tq.wait_result(task.id, timeout=2)
+    runner.cancel()
+    tq.close()
+    stored = await backend.get_task(task.id)
+    assert (stored.state, stored.attempt) == (TaskStatus.failed.value, 2)
+
+
+@pytest.mark.asyncio
+async def test_workers_submit_idempotent():
+    backend = MemoryBackend(MemoryState())
+    tq = TaskQueue(Queue(), conf=conf, backend=backend)
+    first = await tq.submit(name="add", params={"a": 1, "b": 2}, dedupe=True)
+    again = await tq.submit(name="add", params={"b": 2, "a": 1}, dedupe=True)
+    other = await tq.submit(name="add", params={"a": 2}, dedupe=True)
+    assert first.idempotency_key == task_key("add", {"b": 2, "a": 1})
+    assert again.id == first.id
+    assert other.id != first.id
+    # done results are served, failed tasks run again
+    await backend.set_result(first.id, result={"total": 3}, status="DONE")
+    done = await tq.submit(name="add", params={"a": 1, "b": 2}, dedupe=True)
+    assert (done.id, done.state) == (first.id, "DONE")
+    await backend.set_result(first.id, result={}, status="FAILED")
+    retried = await tq.submit(name="add", params={"a": 1, "b": 2}, dedupe=True)
+    assert retried.id != first.id
+    sent = [t["id"] for t in tq.receive_many(10, max_wait=0.1)]
+    assert sent == [first.id, other.id, retried.id]
+    with pytest.raises(BadConfigurationException):
+        await TaskQueue(Queue(), conf=conf).submit(name="add", params={}, dedupe=True)
+
+
+@pytest.mark.asyncio
+async def test_workers_submit_many():
+    backend = MemoryBackend(MemoryState())
+    tq = TaskQueue(Queue(), conf=conf, backend=backend)
+    group = await tq.submit_many("add", ({"a": x} for x in range(7)), chunk_size=3)
+    assert len(group.ids) == 7
+    assert await group.progress() == {"CREATED": 7}
+    sent = tq.receive_many(10, max_wait=0.1)
+    assert [t["id"] for t in sent] == group.ids
+    assert {t["group_id"] for t in sent} == {group.id}
+    for taskid in group.ids:
+        await backend.set_result(taskid, result={}, status="DONE")
+    assert await group.finished()
+
+
+@pytest.mark.asyncio
+async def test_workers_submit_many_full():
+    backend = MemoryBackend(MemoryState())
+    _conf = QueueConfig(app_name="tests", max_depth=2)
+    tq = TaskQueue(create_lanes("process", maxsize=2), conf=_conf, backend=backend)
+    with pytest.raises(QueueFull):
+        await tq.submit_many("add", [{"a": x} for x in range(5)])
+    # tasks not queued are removed
+    assert len(await backend.list_tasks()) == 2
+
+
+PIPELINE = [
+    Step(key="left", name="add", params={"a": 1, "b": 2}),
+    Step(key="right", name="async_add", params={"a": 3, "b": 4}),
+    Step(key="merged", name="merge", after=["left", "right"]),
+]
+
+
+@pytest.mark.asyncio
+async def test_workers_pipeline():
+    tq = TaskQueue(Queue(), conf=conf)
+    task = await tq.submit_pipeline(PIPELINE)
+    assert task.timeout == 120
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests")
+    sent = Task(**tq.receive(timeout=1))
+    rsp = await scheduler.exec_task(sent)
+    assert rsp["merged"] == {"total": 10}
+    # as in a pool process, steps one after another
+    assert await loop.run_in_executor(None, _exec_task, "tests", sent) == rsp
+    tq.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_pipeline_failed():
+    tq = TaskQueue(Queue(), conf=conf)
+    steps = chain(
+        Step(key="a", name="add", params={"a": 1}), Step(key="b", name="fail")
+    )
+    assert steps[1].after == ["a"]
+    task = await tq.submit_pipeline(steps)
+    scheduler = Scheduler(tq, asyncio.get_running_loop(), base_package="tests")
+    rsp = await scheduler.exec_task(Task(**tq.receive(timeout=1)))
+    assert "step b failed" in rsp["error"]
+    assert task.state == "CREATED"
+    with pytest.raises(ValueError):
+        await tq.submit_pipeline([Step(key="a", name="add", after=["a"])])
+    with pytest.raises(ValueError):
+        await tq.submit_pipeline([Step(key="a", name="add", after=["x"])])
+    tq.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_timeout():
+    tq = TaskQueue(Queue(), conf=conf)
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", max_jobs=1)
+    runner = loop.create_task(scheduler.run())
+    hung = await tq.submit(name="async_sleep", params={"seconds": 30}, timeout=1)
+    after = await tq.submit(name="async_add", params={"a": 1})
+
+    # the hung task releases the only slot when its timeout expires
+    while after.id not in scheduler.tasks:
+        await asyncio.sleep(0.05)
+    rsp = await scheduler.tasks[hung.id].future
+    runner.cancel()
+    tq.close()
+    assert "TimeoutError" in rsp["error"]
+    assert scheduler.tasks[hung.id].task.state == TaskStatus.failed.value
+
+
+@pytest.mark.asyncio
+async def test_workers_scheduler_process_pool_stuck():
+    _conf = QueueConfig(app_name="tests", execution="process")
+    tq = TaskQueue(Queue(), conf=_conf)
+    loop = asyncio.get_running_loop()
+    executor = create_executor(_conf, max_workers=1)
+    scheduler = Scheduler(tq, loop, base_package="tests", executor=executor)
+    try:
+        stuck = Task(name="stuck", params={"seconds": 30}, timeout=1)
+        rsp = await scheduler.exec_task(stuck)
+        started = time.monotonic()
+        added = await scheduler.exec_task(Task(name="add", params={"a": 2}))
+    finally:
+        scheduler.executor.shutdown()
+    assert "TimeoutError" in rsp["error"]
+    # the stuck process was killed with its pool, a new one runs the next task
+    assert scheduler.executor is not executor
+    assert added == {"total": 2}
+    assert time.monotonic() - started < 5
+
+
+def test_workers_exec_task_in_child_timeout():
+    task = Task(name="sleep", params={"seconds": 30}, timeout=1)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        _exec_task_in_child("tests", task)
+    assert time.monotonic() - started < 2
+
+
+@pytest.mark.asyncio
+async def test_workers_backpressure_reject():
+    _conf = QueueConfig(app_name="tests", max_depth=2)
+    tq = TaskQueue(create_lanes("process", maxsize=2), conf=_conf)
+    for x in range(2):
+        await tq.submit(name="add", params={"a": x})
+    with pytest.raises(QueueFull) as e:
+        await tq.submit(name="add", params={"a": 2})
+    assert e.value.status_code == 503
+    assert await tq.depth() == 2
+
+
+@pytest.mark.asyncio
+async def test_workers_backpressure_drop_oldest():
+    _conf = QueueConfig(app_name="tests", max_depth=2, overflow="drop_oldest")
+    backend = MemoryBackend(MemoryState())
+    tq = TaskQueue(create_lanes("process", maxsize=2), conf=_conf, backend=backend)
+    tasks = [await tq.submit(name="add", params={"a": x}) for x in range(3)]
+    time.sleep(0.05)
+
+    dropped = await backend.get_task(tasks[0].id)
+    assert dropped.state == TaskStatus.cancelled.value
+    batch = tq.receive_many(10, max_wait=0)
+    assert [t["id"] for t in batch] == [t.id for t in tasks[1:]]
+
+
+class _RacyLane(Queue):
+    """Another producer fills the room made for the task, `racers` times"""
+
+    def __init__(self, racers: int):
+        super().__init__(maxsize=1)
+        self.racers = racers
+
+    def put_nowait(self, item):
+        if self.racers:
+            self.racers -= 1
+            raise Full()
+        super().put_nowait(item)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("racers,kept", [(1, True), (2, False)])
+async def test_workers_backpressure_drop_oldest_race(racers, kept):
+    _conf = QueueConfig(app_name="tests", max_depth=1, overflow="drop_oldest")
+    backend = MemoryBackend(MemoryState())
+    doorbell = threading.Semaphore(0)
+    lanes = {lane: _RacyLane(0) for lane in LANE_WEIGHTS}
+    tq = TaskQueue(PriorityLanes(doorbell, lanes), conf=_conf, backend=backend)
+    old = await tq.submit(name="add", params={"a": 1})
+    # the first put fails because the lane is full, the next ones are races
+    lanes[Priority.default.value].racers = racers + 1
+    with pytest.raises(QueueFull):
+        await tq.submit(name="add", params={"a": 2})
+    # the oldest task is put back, or cancelled with its doorbell
+    state = (await backend.get_task(old.id)).state
+    assert (state == TaskStatus.cancelled.value) is not kept
+    assert doorbell.acquire(blocking=False) is kept
+
+
+@pytest.mark.asyncio
+async def test_workers_backpressure_wait():
+    _conf = QueueConfig(
+        app_name="tests", max_depth=1, overflow="wait", overflow_timeout=0.1
+    )
+    tq = TaskQueue(create_lanes("process", maxsize=1), conf=_conf)
+    await tq.submit(name="add", params={"a": 1})
+    with pytest.raises(QueueFull):
+        await tq.submit(name="add", params={"a": 2})
+
+    asyncio.get_running_loop().call_later(0.05, tq.receive, False)
+    tq.overflow_timeout = 1
+    await tq.submit(name="add", params={"a": 3})
+    time.sleep(0.05)
+    assert tq.receive(wait=False)["params"] == {"a": 3}
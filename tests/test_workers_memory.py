@@ -0,0 +1,136 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from services.errors import BadConfigurationException
+from services.ext.memory.workers import MemoryBackend, MemoryState
+from services.workers import Task, TaskStatus
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_lifecycle():
+    backend = MemoryBackend(MemoryState())
+    task = Task(name="add", params={"a": 1})
+    await backend.add_task(task)
+    await backend.update_status(task.id, TaskStatus.running.value)
+    assert (await backend.get_task(task.id)).state == TaskStatus.running.value
+
+    await backend.set_result(task.id, result={"total": 1}, status="DONE")
+    assert await backend.get_result(task.id) == {"total": 1}
+    assert [t.id for t in await backend.list_tasks()] == [task.id]
+    assert await backend.get_task("missing") is None
+    assert not await backend.update_status("missing", TaskStatus.running.value)
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_expire():
+    state = MemoryState()
+    backend = MemoryBackend(state)
+    stale = Task(name="add", timeout=0, result_ttl=0)
+    done = Task(name="add", result_ttl=0)
+    kept = Task(name="add")
+    for t in (stale, done, kept):
+        await backend.add_task(t)
+    await backend.set_result(done.id, result={"total": 1}, status="DONE")
+
+    assert state.expire() == [(done.id, "DONE")]
+    assert (await backend.get_task(stale.id)).state == TaskStatus.failed.value
+    assert await backend.clean_failed() == [stale.id]
+    assert [t.id for t in await backend.list_tasks()] == [kept.id]
+    # stale entries are skipped, only the last expiration of each task is used
+    assert state.expire(time.time() + 60) == []
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_expire_eta():
+    state = MemoryState()
+    backend = MemoryBackend(state)
+    eta = datetime.utcnow() + timedelta(seconds=60)
+    task = Task(name="add", timeout=1, state="WAITING", eta=eta, idempotency_key="k")
+    assert await backend.add_task_once(task) is task
+    # it holds its key until its eta plus its timeout
+    assert state.expire(time.time() + 30) == []
+    assert (await backend.find_by_key("k")).id == task.id
+    # never started, it is failed instead of kept forever
+    state.expire(time.time() + 62)
+    assert (await backend.get_task(task.id)).state == TaskStatus.failed.value
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_shared():
+    server = MemoryBackend.serve("memory://127.0.0.1:0")
+    try:
+        host, port = server.address
+        uri = f"memory://{host}:{port}"
+        web = await MemoryBackend.from_uri(uri)
+        worker = await MemoryBackend.from_uri(uri)
+        task = Task(name="add")
+        await web.add_task(task)
+        await worker.set_result(task.id, result={"total": 1}, status="DONE")
+        assert await web.get_result(task.id) == {"total": 1}
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_shared_wait_finished():
+    server = MemoryBackend.serve("memory://127.0.0.1:0")
+    try:
+        host, port = server.address
+        uri = f"memory://{host}:{port}"
+        web = await MemoryBackend.from_uri(uri)
+        worker = await MemoryBackend.from_uri(uri)
+        task = Task(name="add")
+        await web.add_task(task)
+        assert not await web.wait_finished(task.id, timeout=0.05)
+        assert not await web.wait_finished("missing", timeout=1)
+
+        async def finish():
+            await asyncio.sleep(0.1)
+            await worker.set_result(task.id, result={"total": 1}, status="DONE")
+
+        # the worker connection wakes up the web one, without polling
+        web.wait_slice = 5
+        started = time.monotonic()
+        asyncio.create_task(finish())
+        assert await web.wait_finished(task.id, timeout=5)
+        assert time.monotonic() - started < 1
+        await web.close()
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_shared_waiters():
+    server = MemoryBackend.serve("memory://127.0.0.1:0")
+    try:
+        host, port = server.address
+        web = await MemoryBackend.from_uri(f"memory://{host}:{port}")
+        first, second = Task(name="add"), Task(name="add")
+        await web.add_tasks([first, second])
+        # long-polls take turns in the bounded pool of waiters
+        web.max_waiters = 1
+        web.wait_slice = 0.1
+        waiting = asyncio.create_task(web.wait_finished(first.id, timeout=5))
+        await asyncio.sleep(0.05)
+        await web.set_result(second.id, result={}, status="DONE")
+        started = time.monotonic()
+        assert await web.wait_finished(second.id, timeout=5)
+        assert time.monotonic() - started < 1
+        assert web._waiter._max_workers == 1
+        waiting.cancel()
+        await web.close()
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_workers_memory_port_required():
+    with pytest.raises(BadConfigurationException):
+        MemoryBackend.serve("memory://127.0.0.1")
+    with pytest.raises(BadConfigurationException):
+        await MemoryBackend.from_uri("memory://127.0.0.1")
+    # in process
+    assert (await MemoryBackend.from_uri("memory://")).manager is None
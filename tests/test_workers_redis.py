@@ -0,0 +1,167 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from services.workers import Task, TaskStatus
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from services.ext.redis.workers import RedisBackend  # noqa: E402
+
+
+@pytest_asyncio.fixture()
+async def backend():
+    driver = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    yield RedisBackend(driver)
+    await driver.flushall()
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_lifecycle(backend: RedisBackend):
+    task = Task(name="add", params={"a": 1}, timeout=10, result_ttl=60)
+    await backend.add_task(task)
+    key = backend._key(task.id)
+    assert await backend.driver.ttl(key) == 70
+
+    await backend.update_status(task.id, TaskStatus.running.value)
+    running = await backend.get_task(task.id)
+    assert running.state == TaskStatus.running.value
+    assert running.params == {"a": 1}
+    assert running.created_at == task.created_at
+
+    await backend.set_result(task.id, result={"total": 1}, status=TaskStatus.done.value)
+    assert await backend.get_result(task.id) == {"total": 1}
+    assert await backend.driver.ttl(key) == 60
+
+    tasks = await backend.list_tasks()
+    assert [t.id for t in tasks] == [task.id]
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_missing(backend: RedisBackend):
+    # an expired task is not created again by a late update
+    assert not await backend.update_status("missing", TaskStatus.running.value)
+    await backend.set_result("missing", result={}, status=TaskStatus.done.value)
+    assert await backend.get_task("missing") is None
+    assert await backend.get_result("missing") is None
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_clean_failed(backend: RedisBackend):
+    ok = Task(name="add")
+    failed = Task(name="fail")
+    await backend.add_task(ok)
+    await backend.add_task(failed)
+    await backend.set_result(failed.id, result={}, status=TaskStatus.failed.value)
+
+    expired = Task(name="fail", result_ttl=0)
+    await backend.add_task(expired)
+    await backend.set_result(expired.id, result={}, status=TaskStatus.failed.value)
+
+    # only failed tasks past their result_ttl are removed
+    removed = await backend.clean_failed()
+    assert removed == [expired.id]
+    assert await backend.get_task(failed.id) is not None
+    assert await backend.get_task(ok.id) is not None
+    # failed tasks are kept apart, clean_failed doesn't scan the tasks
+    assert await backend.driver.zrange(backend._failed(), 0, -1) == [failed.id]
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_close(backend: RedisBackend):
+    closed = []
+    _close = backend.driver.close
+    backend.driver.close = lambda: closed.append(True) or _close()
+    await backend.close()
+    assert closed
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_lock(backend: RedisBackend):
+    assert await backend.acquire_lock("leader", "a", ttl=30)
+    assert not await backend.acquire_lock("leader", "b", ttl=30)
+    assert await backend.acquire_lock("leader", "a", ttl=30)
+    await backend.release_lock("leader", "a")
+    assert await backend.acquire_lock("leader", "b", ttl=30)
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_wait_finished(backend: RedisBackend):
+    task = Task(name="add")
+    await backend.add_task(task)
+    assert not await backend.wait_finished(task.id, timeout=0.05)
+
+    async def finish():
+        await asyncio.sleep(0.05)
+        await backend.set_result(task.id, result={"total": 1}, status="DONE")
+
+    asyncio.create_task(finish())
+    assert await backend.wait_finished(task.id, timeout=2)
+    # already finished
+    assert await backend.wait_finished(task.id, timeout=0)
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_add_task_once(backend: RedisBackend):
+    first = Task(name="add", params={"a": 1}, idempotency_key="k")
+    assert (await backend.add_task_once(first)).id == first.id
+    held = await backend.add_task_once(Task(name="add", idempotency_key="k"))
+    assert (held.id, held.params) == (first.id, {"a": 1})
+    assert await backend.driver.ttl(backend._key(first.id)) > 0
+    await backend.set_result(first.id, result={}, status=TaskStatus.failed.value)
+    retried = Task(name="add", idempotency_key="k")
+    assert (await backend.add_task_once(retried)).id == retried.id
+    assert (await backend.find_by_key("k")).id == retried.id
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_add_task_once_race(backend: RedisBackend):
+    other = Task(name="add", idempotency_key="k")
+    get = backend.driver.get
+
+    async def racy_get(key):
+        value = await get(key)
+        if value is None:
+            # another producer takes the key before the script runs
+            await backend.add_task(other)
+            await backend.driver.set(key, other.id)
+        return value
+
+    backend.driver.get = racy_get
+    held = await backend.add_task_once(Task(name="add", idempotency_key="k"))
+    assert held.id == other.id
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_group_progress(backend: RedisBackend):
+    tasks = [Task(name="add", params={"a": x}, group_id="g") for x in range(3)]
+    await backend.add_tasks(tasks + [Task(name="add")])
+    await backend.set_result(tasks[0].id, result={}, status=TaskStatus.done.value)
+    progress = await backend.group_progress("g")
+    assert progress == {TaskStatus.created.value: 2, TaskStatus.done.value: 1}
+    assert (await backend.get_task(tasks[1].id)).group_id == "g"
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_set_retry(backend: RedisBackend):
+    task = Task(name="fail", timeout=10, result_ttl=10)
+    await backend.add_task(task)
+    eta = datetime.utcnow() + timedelta(seconds=60)
+    await backend.set_retry(task.id, attempt=2, result={"error": "x"}, eta=eta)
+    stored = await backend.get_task(task.id)
+    assert (stored.state, stored.attempt) == (TaskStatus.waiting.value, 2)
+    assert await backend.driver.ttl(backend._key(task.id)) > 60
+
+
+@pytest.mark.asyncio
+async def test_workers_redis_ttl_eta(backend: RedisBackend):
+    eta = datetime.utcnow() + timedelta(seconds=3600)
+    task = Task(name="add", state="WAITING", eta=eta, idempotency_key="k")
+    await backend.add_task_once(task)
+    assert await backend.driver.ttl(backend._key(task.id)) > 3600
+    assert await backend.driver.ttl(backend._idempotency_key("k")) > 3600
+    later = Task(name="add", state="WAITING", eta=eta)
+    await backend.add_task(later)
+    assert await backend.driver.ttl(backend._key(later.id)) > 3600
@@ -0,0 +1,501 @@
+import asyncio
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from queue import Queue
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import functions
+
+from services.errors import BadConfigurationException
+from services.ext.sql.workers import SQLBackend, SQLQueue
+from services.types import Storage, TasksBackend
+from services.workers import (
+    CTX_PREFIX,
+    QueueConfig,
+    Scheduler,
+    Task,
+    TaskQueue,
+    TaskStatus,
+    init_backend,
+    init_transport,
+    result_response,
+)
+
+
+@pytest_asyncio.fixture()
+async def squeue(tmp_path):
+    uri = f"sqlite+aiosqlite:///{tmp_path}/tasks.db"
+    q = await SQLQueue.from_uri(uri, {"qname": "testing", "poll_interval": 0.01})
+    yield q
+    await q.close()
+
+
+@pytest_asyncio.fixture()
+async def backend(tmp_path):
+    conf = TasksBackend(uri=f"sqlite+aiosqlite:///{tmp_path}/tasks.db")
+    back = await init_backend(conf)
+    yield back
+    await back.close()
+
+
+async def _total_rows(q: SQLQueue) -> int:
+    async with q.engine.connect() as conn:
+        res = await conn.execute(select(functions.count()).select_from(q._queue))
+        return res.scalar_one()
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_claim(squeue: SQLQueue):
+    tasks = [Task(name="add", params={"a": x}) for x in range(3)]
+    for t in tasks:
+        await squeue.put(t, t.json())
+
+    first = await squeue.get_many(2, max_wait=0)
+    assert [Task.parse_raw(d).id for d in first] == [t.id for t in tasks[:2]]
+    assert await squeue.qsize() == 1
+
+    rest = await squeue.get_many(10, max_wait=0)
+    assert len(rest) == 1
+    assert await squeue.get_many(10, max_wait=0.02) == []
+
+    await squeue.ack([t.id for t in tasks])
+    assert await _total_rows(squeue) == 0
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_priority(squeue: SQLQueue):
+    tasks = [Task(name="add", priority=p) for p in ("low", "default", "high")]
+    for t in tasks:
+        await squeue.put(t, t.json())
+    claimed = await squeue.get_many(3, max_wait=0)
+    lanes = [Task.parse_raw(d).priority for d in claimed]
+    assert lanes == ["high", "default", "low"]
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_eta(squeue: SQLQueue):
+    later = Task(name="add", eta=datetime.utcnow() + timedelta(seconds=60))
+    await squeue.put(later, later.json())
+    assert await squeue.get_many(1, max_wait=0) == []
+    # it doesn't count until it is due
+    assert await squeue.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_backpressure(squeue: SQLQueue):
+    _conf = QueueConfig(
+        app_name="tests", transport="sql", max_depth=2, overflow="drop_oldest"
+    )
+    tq = TaskQueue(squeue, conf=_conf)
+    tasks = [await tq.submit(name="add", params={"a": x}) for x in range(3)]
+    assert await tq.depth() == 2
+    claimed = await squeue.get_many(10, max_wait=0)
+    assert [Task.parse_raw(d).id for d in claimed] == [t.id for t in tasks[1:]]
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_reclaim(squeue: SQLQueue):
+    task = Task(name="add", params={"a": 1})
+    await squeue.put(task, task.json())
+    assert len(await squeue.get_many(1, max_wait=0)) == 1
+    # the worker which claimed it never acked it
+    squeue.visibility_timeout = 0
+    assert len(await squeue.get_many(1, max_wait=0)) == 1
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_visibility(tmp_path, backend):
+    conf = QueueConfig(
+        app_name="tests",
+        qname="testing",
+        transport="sql",
+        transport_uri=f"sqlite+aiosqlite:///{tmp_path}/tasks.db",
+        visibility_timeout=30,
+        poll_interval=0.01,
+    )
+    squeue = await init_transport(conf)
+    assert squeue.visibility_timeout == 30
+    assert squeue.poll_interval == 0.01
+    tq = TaskQueue(squeue, conf=conf, backend=backend)
+    # it would be claimed again while running
+    with pytest.raises(BadConfigurationException):
+        await tq.submit(name="add", params={}, timeout=30)
+    with pytest.raises(BadConfigurationException):
+        await tq.submit_many("add", [{}, {}], timeout=60)
+    assert await _total_rows(squeue) == 0
+    async with backend.conn() as conn:
+        res = await conn.execute(select(functions.count()).select_from(backend._tasks))
+        assert res.scalar_one() == 0
+    await tq.submit(name="add", params={}, timeout=29)
+    assert await squeue.qsize() == 1
+    await squeue.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_scheduler(squeue: SQLQueue):
+    tq = TaskQueue(squeue, conf=QueueConfig(app_name="tests", transport="sql"))
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", idle_timeout=0.05)
+    started = []
+    _start_task = scheduler.start_task
+    scheduler.start_task = lambda t: started.append(_start_task(t)) or started[-1]
+    await tq.submit(name="add", params={"a": 1, "b": 1})
+    runner = loop.create_task(scheduler.run())
+
+    # the task is removed from the queue once it is acked
+    while not started or await _total_rows(squeue):
+        await asyncio.sleep(0.01)
+    runner.cancel()
+    assert started[0].result() == {"total": 2}
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_queue_scheduler_errors(squeue: SQLQueue):
+    tq = TaskQueue(squeue, conf=QueueConfig(app_name="tests", transport="sql"))
+    loop = asyncio.get_running_loop()
+    scheduler = Scheduler(tq, loop, base_package="tests", idle_timeout=0.05)
+    failures = []
+
+    def fail_once(fn):
+        async def call(*args):
+            if fn.__name__ not in failures:
+                failures.append(fn.__name__)
+                raise OperationalError("SELECT", {}, Exception("database is locked"))
+            return await fn(*args)
+
+        return call
+
+    squeue.get_many = fail_once(squeue.get_many)
+    squeue.ack = fail_once(squeue.ack)
+    await tq.submit(name="add", params={"a": 1, "b": 1})
+    runner = loop.create_task(scheduler.run())
+    # the task is run and acked after the errors
+    while await _total_rows(squeue):
+        assert not runner.done()
+        await asyncio.sleep(0.01)
+    runner.cancel()
+    assert failures == ["get_many", "ack"]
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_pool(backend: SQLBackend):
+    task = Task(name="add", params={"a": 1})
+    await backend.add_task(task)
+    await backend.update_status(task.id, TaskStatus.running.value)
+    await backend.set_result(task.id, result={"total": 1}, status="DONE")
+    rsp = await backend.get_task(task.id)
+
+    # connections are returned to the pool instead of disposing the engine
+    stats = backend.pool_status()
+    assert rsp.state == TaskStatus.done.value
+    assert stats["checkedout"] == 0
+    assert stats["checkedin"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_write_behind(tmp_path):
+    conf = TasksBackend(
+        uri=f"sqlite+aiosqlite:///{tmp_path}/tasks.db", write_behind_ms=20
+    )
+    back = await init_backend(conf)
+    executed = []
+    event.listen(
+        back.engine.sync_engine,
+        "before_cursor_execute",
+        lambda *args: executed.append(args[-1]),
+    )
+    tasks = [Task(name="add", params={"a": x}) for x in range(3)]
+    for t in tasks:
+        await back.add_task(t)
+    executed.clear()
+
+    for t in tasks:
+        await back.update_status(t.id, TaskStatus.running.value)
+        await back.set_result(t.id, result={"total": 1}, status="DONE")
+
+    # read-your-writes before the changes are flushed
+    rsp = await back.get_task(tasks[0].id)
+    assert rsp.state == TaskStatus.done.value
+    assert await back.get_result(tasks[0].id) == {"total": 1}
+
+    await asyncio.sleep(0.05)
+    # only one executemany for all the updates
+    assert executed[-1] is True
+    assert len([e for e in executed if e]) == 1
+    back._pending.clear()
+    assert (await back.get_task(tasks[2].id)).state == TaskStatus.done.value
+    await back.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_write_behind_failed(tmp_path):
+    conf = TasksBackend(
+        uri=f"sqlite+aiosqlite:///{tmp_path}/tasks.db", write_behind_ms=20
+    )
+    back = await init_backend(conf)
+    task = Task(name="add")
+    await back.add_task(task)
+    begin = back.begin
+
+    def locked():
+        back.begin = begin
+        raise OperationalError("UPDATE", {}, Exception("database is locked"))
+
+    back.begin = locked
+    await back.set_result(task.id, result={"total": 1}, status="DONE")
+    await asyncio.sleep(0.03)
+    # the batch is back, a newer update is kept over it
+    assert back.begin == begin
+    assert back._pending[task.id]["state"] == "DONE"
+    await back.update_status(task.id, TaskStatus.failed.value)
+    await asyncio.sleep(0.05)
+    assert back._pending == {}
+    stored = await back.get_task(task.id)
+    assert stored.state == TaskStatus.failed.value
+    assert await back.get_result(task.id) == {"total": 1}
+
+    back.begin = locked
+    await back.set_result(task.id, result={}, status="DONE")
+    with pytest.raises(OperationalError):
+        await back.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_clean(backend: SQLBackend):
+    stale = Task(name="add", timeout=0, result_ttl=0)
+    done = Task(name="add", result_ttl=0)
+    kept = Task(name="add")
+    for t in (stale, done, kept):
+        await backend.add_task(t)
+    await backend.set_result(done.id, result={"total": 1}, status="DONE")
+    await asyncio.sleep(0.01)
+
+    assert await backend._move_to_failed() == [stale.id]
+    assert await backend._clean_done() == [done.id]
+    assert (await backend.get_task(stale.id)).state == TaskStatus.failed.value
+    await asyncio.sleep(0.01)
+    assert await backend.clean_failed() == [stale.id]
+    assert [t.id for t in await backend.list_tasks()] == [kept.id]
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_missing(backend: SQLBackend):
+    assert await backend.get_task("missing") is None
+    assert await backend.get_result("missing") is None
+    assert not await backend.wait_finished("missing", timeout=0.2)
+    tq = TaskQueue(Queue(), conf=QueueConfig(app_name="tests"), backend=backend)
+    with pytest.raises(asyncio.TimeoutError):
+        await tq.wait_result("missing", timeout=0.2)
+    request = SimpleNamespace(app=SimpleNamespace(ctx=SimpleNamespace()))
+    setattr(request.app.ctx, f"{CTX_PREFIX}default", tq)
+    rsp = await result_response(request, "missing", timeout=0.2)
+    assert rsp.status == 404
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_lock(backend: SQLBackend):
+    assert await backend.acquire_lock("leader", "a", ttl=30)
+    assert not await backend.acquire_lock("leader", "b", ttl=30)
+    assert await backend.acquire_lock("leader", "a", ttl=0)
+    # expired, anyone can take it
+    await asyncio.sleep(0.01)
+    assert await backend.acquire_lock("leader", "b", ttl=30)
+    await backend.release_lock("leader", "b")
+    assert await backend.acquire_lock("leader", "a", ttl=30)
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_add_task_once(backend: SQLBackend):
+    first = Task(name="add", idempotency_key="k")
+    assert (await backend.add_task_once(first)).id == first.id
+    held = await backend.add_task_once(Task(name="add", idempotency_key="k"))
+    assert held.id == first.id
+    await backend.set_result(first.id, result={}, status=TaskStatus.failed.value)
+    retried = Task(name="add", idempotency_key="k")
+    assert (await backend.add_task_once(retried)).id == retried.id
+    assert (await backend.find_by_key("k")).id == retried.id
+    # the failed task is still there, without its key
+    assert (await backend.get_task(first.id)).idempotency_key is None
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_expire_eta(backend: SQLBackend):
+    eta = datetime.utcnow() + timedelta(seconds=60)
+    task = Task(name="add", timeout=0, state="WAITING", eta=eta, idempotency_key="k")
+    await backend.add_task_once(task)
+    retried = Task(name="add", timeout=0)
+    overdue = Task(name="add", timeout=0, state="WAITING", eta=datetime.utcnow())
+    await backend.add_tasks([retried, overdue])
+    await backend.set_retry(retried.id, attempt=2, result={}, eta=eta)
+    await asyncio.sleep(0.01)
+    await backend.clean()
+    assert (await backend.get_task(overdue.id)).state == TaskStatus.failed.value
+    # they are due to run, they keep their state and their key
+    assert (await backend.find_by_key("k")).id == task.id
+    assert (await backend.get_task(retried.id)).state == TaskStatus.waiting.value
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_submit_many(squeue: SQLQueue, backend: SQLBackend):
+    _conf = QueueConfig(app_name="tests", transport="sql")
+    tq = TaskQueue(squeue, conf=_conf, backend=backend)
+    group = await tq.submit_many("add", ({"a": x} for x in range(5)), chunk_size=2)
+    assert await _total_rows(squeue) == 5
+    assert await group.progress() == {TaskStatus.created.value: 5}
+    await backend.set_result(group.ids[0], result={}, status=TaskStatus.done.value)
+    assert await group.progress() == {
+        TaskStatus.created.value: 4,
+        TaskStatus.done.value: 1,
+    }
+    claimed = await squeue.get_many(10, max_wait=0)
+    assert [tq.codec.loads(d)["id"] for d in claimed] == group.ids
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_submit_many_large_chunk(
+    squeue: SQLQueue, backend: SQLBackend
+):
+    _conf = QueueConfig(app_name="tests", transport="sql")
+    tq = TaskQueue(squeue, conf=_conf, backend=backend)
+    # more bind parameters than sqlite allows in one statement
+    conn = sqlite3.connect(":memory:")
+    limit = 32766
+    if hasattr(conn, "getlimit"):  # python >= 3.11
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    conn.close()
+    total = limit // min(len(backend._tasks.c), len(squeue._queue.c)) + 1
+    group = await tq.submit_many(
+        "add", ({"a": x} for x in range(total)), chunk_size=total
+    )
+    assert len(group.ids) == total
+    assert await _total_rows(squeue) == total
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_retry(squeue: SQLQueue, backend: SQLBackend):
+    task = Task(name="fail")
+    await backend.add_task(task)
+    await squeue.put(task, task.json())
+    assert len(await squeue.get_many(1, max_wait=0)) == 1
+    task.eta = datetime.utcnow() + timedelta(seconds=60)
+    await backend.set_retry(task.id, attempt=2, result={"error": "x"}, eta=task.eta)
+    await squeue.requeue(task, task.json())
+    # the claimed row is released, to be claimed after the eta
+    assert await _total_rows(squeue) == 1
+    assert await squeue.get_many(1, max_wait=0) == []
+    stored = await backend.get_task(task.id)
+    assert (stored.state, stored.attempt) == (TaskStatus.waiting.value, 2)
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_result_store(tmp_path):
+    conf = TasksBackend(
+        uri=f"sqlite+aiosqlite:///{tmp_path}/tasks.db",
+        result_store=Storage(bucket=str(tmp_path / "results")),
+        result_max_bytes=100,
+        write_behind_ms=50,
+    )
+    back = await init_backend(conf)
+    big, small = Task(name="add", result_ttl=0), Task(name="add")
+    await back.add_tasks([big, small])
+    result = {"rows": list(range(100))}
+    await back.set_result(big.id, result=result, status=TaskStatus.done.value)
+    await back.set_result(small.id, result={"total": 1}, status="DONE")
+    assert await back.get_result(big.id) == result
+    await back.flush()
+    assert await back.get_result(big.id) == result
+    assert await back.get_result(small.id) == {"total": 1}
+    async with back.conn() as conn:
+        res = await conn.execute(select(back._tasks.c.result, back._tasks.c.result_key))
+        stored = {r.result_key: r.result for r in res.fetchall()}
+    assert stored == {None: {"total": 1}, f"tasks_state/{big.id}.json": None}
+    assert len(await back.list_tasks()) == 2
+
+    path = tmp_path / "results" / "tasks_state" / f"{big.id}.json"
+    assert path.exists()
+    await asyncio.sleep(0.01)
+    await back.clean()
+    assert not path.exists()
+    await back.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("write_behind_ms", [0, 50])
+async def test_workers_sql_backend_result_store_replaced(tmp_path, write_behind_ms):
+    conf = TasksBackend(
+        uri=f"sqlite+aiosqlite:///{tmp_path}/tasks.db",
+        result_store=Storage(bucket=str(tmp_path / "results")),
+        result_max_bytes=100,
+        write_behind_ms=write_behind_ms,
+    )
+    back = await init_backend(conf)
+    retried, stuck = Task(name="add"), Task(name="add", timeout=0)
+    await back.add_tasks([retried, stuck])
+    error = {"error": "x" * 200}
+    eta = datetime.utcnow()
+    await back.set_retry(retried.id, attempt=2, result=error, eta=eta)
+    await back.set_retry(stuck.id, attempt=2, result=error, eta=eta)
+    await back.flush()
+    paths = [
+        tmp_path / "results" / "tasks_state" / f"{t.id}.json" for t in (retried, stuck)
+    ]
+    assert all(p.exists() for p in paths)
+
+    # a small result of the next attempt is inline
+    await back.set_result(retried.id, result={"total": 1}, status="DONE")
+    assert not paths[0].exists()
+    assert await back.get_result(retried.id) == {"total": 1}
+    # a task failed by its timeout gets an inline error
+    await asyncio.sleep(0.01)
+    await back.clean()
+    assert not paths[1].exists()
+    assert (await back.get_result(stuck.id))["error"].startswith("timeout")
+    await back.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_sql_backend_upgrade(tmp_path):
+    uri = f"sqlite+aiosqlite:///{tmp_path}/tasks.db"
+    engine = SQLBackend.create_engine(uri)
+    # the table created by the first version of the backend
+    async with engine.begin() as conn:
+        await conn.execute(
+            text(
+                "CREATE TABLE tasks_state (id VARCHAR PRIMARY KEY, name VARCHAR, "
+                "params JSON, state VARCHAR, app_name VARCHAR, result JSON, "
+                "timeout INTEGER, result_ttl INTEGER, "
+                "created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+            )
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO tasks_state (id, name, params, state, app_name, "
+                "timeout, result_ttl) VALUES ('old', 'add', '{}', 'DONE', 'tests', "
+                "10, 60)"
+            )
+        )
+    await engine.dispose()
+
+    back = await init_backend(TasksBackend(uri=uri))
+    old = await back.get_task("old")
+    assert (old.state, old.attempt) == ("DONE", 1)
+    task = Task(name="add", idempotency_key="k")
+    assert (await back.add_task_once(task)).id == task.id
+    assert (
+        await back.add_task_once(Task(name="add", idempotency_key="k"))
+    ).id == task.id
+    async with back.conn() as conn:
+        res = await conn.execute(
+            select(back._tasks.c.expires_at).where(back._tasks.c.id == "old")
+        )
+        assert res.scalar_one() > time.time()
+    await back.close()
+    # already upgraded
+    back = await init_backend(TasksBackend(uri=uri))
+    await back.close()